@@ -1,6 +1,14 @@
 from flask import Flask
 from .models import db
 from .extensions import ma
+from .utils.search import search
+from .utils.cache import cache
+from .utils.idempotency import idempotency
+from .utils.cart_store import cart_store
+from .utils.rates import rates
+from .utils.auth import auth
+from .utils.passwords import passwords
+from .utils.query_budget import query_counting
 from .blueprints.users import users_bp
 from .blueprints.book_descriptions import book_descriptions_bp
 from .blueprints.payments import payments_bp
@@ -29,6 +37,14 @@ def create_app(config_name):
      db.init_app(app)
      # Extensions     
      ma.init_app(app)
+     search.init_app(app)
+     cache.init_app(app)
+     idempotency.init_app(app)
+     cart_store.init_app(app)
+     rates.init_app(app)
+     auth.init_app(app)
+     passwords.init_app(app)
+     query_counting.init_app(app)
      # Add CORS To let front access to the APIs --> allow all origins (for development)
      CORS(app)
 
@@ -1,7 +1,7 @@
 from flask import Blueprint
 
 # Creating blueprint
-book_descriptions_bp = Blueprint('book_descriptions_bp', __name__)
+book_descriptions_bp = Blueprint('book_descriptions_bp', __name__, cli_group='books')
 
 # It has to be here after creating blueprint
 from . import routes
\ No newline at end of file
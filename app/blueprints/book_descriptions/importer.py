@@ -0,0 +1,115 @@
+import csv
+import io
+import json
+from itertools import islice
+from marshmallow import ValidationError
+from sqlalchemy import select, insert, update
+from sqlalchemy.exc import SQLAlchemyError
+from app.models import db, Book_descriptions
+from app.utils.search import search
+from app.utils.cache import cache
+from .schemas import book_description_schema
+
+FORMATS = ("jsonl", "csv")
+ON_CONFLICT = ("skip", "update")
+
+
+def read_rows(stream, format):
+    """Yield (line number, row dict or None, error) from a binary JSONL or CSV stream, one row at a time."""
+    text = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+    if format == "csv":
+        reader = csv.DictReader(text)
+        for row in reader:
+            # Empty cells are missing values, so column defaults and required checks apply
+            yield reader.line_num, {key: value for key, value in row.items() if key and value not in ("", None)}, None
+        return
+    for line_number, line in enumerate(text, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            yield line_number, None, f"Invalid JSON: {e}"
+            continue
+        if not isinstance(row, dict):
+            yield line_number, None, "Each line must be a JSON object."
+            continue
+        yield line_number, row, None
+
+
+def import_chunk(rows, on_conflict):
+    """Validate, dedupe and write one chunk in a single transaction, return (counts, errors)."""
+    counts = {"inserted" : 0, "updated" : 0, "skipped" : 0, "failed" : 0}
+    errors = []
+    books = {}
+    for line, row, error in rows:
+        if error is not None:
+            counts["failed"] += 1
+            errors.append({"line" : line, "errors" : error})
+    parsed = [(line, row) for line, row, error in rows if error is None]
+    # Validate the whole chunk in one load(many=True) call, per-row load() has a high fixed cost
+    try:
+        loaded, messages = book_description_schema.load([row for line, row in parsed], many=True), {}
+    except ValidationError as e:
+        loaded, messages = e.valid_data, e.messages
+    for index, ((line, row), data) in enumerate(zip(parsed, loaded)):
+        if index in messages:
+            counts["failed"] += 1
+            errors.append({"line" : line, "errors" : messages[index]})
+        elif data["isbn"] in books:
+            # The same ISBN twice in a chunk: the first one wins, like the single add route
+            counts["skipped"] += 1
+        else:
+            books[data["isbn"]] = data
+    errors.sort(key=lambda error: error["line"])
+    if not books:
+        return counts, errors
+    # One set-based lookup for the whole chunk
+    existing = dict(db.session.execute(
+        select(Book_descriptions.isbn, Book_descriptions.id).where(Book_descriptions.isbn.in_(list(books)))
+    ).all())
+    new_rows = [data for isbn, data in books.items() if isbn not in existing]
+    changed_rows = [{"id" : existing[isbn], **data} for isbn, data in books.items() if isbn in existing] if on_conflict == "update" else []
+    try:
+        if new_rows:
+            db.session.execute(insert(Book_descriptions), new_rows)
+        if changed_rows:
+            db.session.execute(update(Book_descriptions), changed_rows)
+        if new_rows or changed_rows:
+            written = [data["isbn"] for data in new_rows + changed_rows]
+            search.index_books(db.session.scalars(select(Book_descriptions).where(Book_descriptions.isbn.in_(written))).all())
+        db.session.commit()
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        counts["failed"] += len(books)
+        errors.append({"line" : None, "errors" : f"Chunk rolled back: {getattr(e, 'orig', None) or e}"})
+        return counts, errors
+    # Keep the ORM objects of this chunk from piling up in the session
+    db.session.expunge_all()
+    cache.invalidate("books")
+    counts["inserted"] += len(new_rows)
+    counts["updated"] += len(changed_rows)
+    counts["skipped"] += len(books) - len(new_rows) - len(changed_rows)
+    return counts, errors
+
+
+def import_books(stream, format="jsonl", on_conflict="skip", chunk_size=1000):
+    """Stream a publisher feed into book_descriptions chunk by chunk.
+
+    Yields an "error" event per rejected row, a "progress" event after every chunk and a
+    final "summary" event. Only one chunk is held in memory at a time.
+    """
+    totals = {"processed" : 0, "inserted" : 0, "updated" : 0, "skipped" : 0, "failed" : 0}
+    rows = read_rows(stream, format)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        counts, errors = import_chunk(chunk, on_conflict)
+        for error in errors:
+            yield {"type" : "error", **error}
+        totals["processed"] += len(chunk)
+        for key, value in counts.items():
+            totals[key] += value
+        yield {"type" : "progress", **totals}
+    yield {"type" : "summary", **totals}
@@ -1,9 +1,30 @@
-from .schemas import book_description_schema, book_descriptions_schema
+from .schemas import book_description_schema, BookDescriptionSchema, book_fields, book_options, projected
 from app.blueprints.categories.schemas import categories_schema 
 from app.blueprints.book_descriptions import book_descriptions_bp
-from flask import request, jsonify
+from .importer import import_books, FORMATS, ON_CONFLICT
+from flask import request, jsonify, current_app, stream_with_context
 from marshmallow import ValidationError
-from app.models import db, Book_descriptions, Categories
+from app.models import db, Book_descriptions, Categories, book_categories
+from sqlalchemy import select, func
+from app.utils.pagination import keyset_paginate, page_size, CursorError
+from app.utils.search import search
+from app.utils.cache import cache, stock_tag
+from app.utils.conditional import conditional, latest
+from app.utils.streaming import ndjson_response, since_arg, EXPORT_BATCH_SIZE
+from app.utils.serializers import json_response
+from app.utils.loading import load_plan
+from app.utils.query_budget import query_budget
+from datetime import datetime
+import click
+import json
+
+# Sort orders accepted by the catalog listing, prefix with "-" for descending
+SORT_COLUMNS = {
+    "id" : Book_descriptions.id,
+    "price" : Book_descriptions.price,
+    "averageRating" : Book_descriptions.averageRating,
+    "published_date" : Book_descriptions.published_date,
+}
 
 @book_descriptions_bp.route('', methods={'POST'})
 def add_book_description():
@@ -17,13 +38,173 @@ def add_book_description():
         return book_description_schema.jsonify(existed_book), 201
     new_book = Book_descriptions(**data)
     db.session.add(new_book)
+    db.session.flush()
+    search.index_book(new_book)
     db.session.commit()
+    cache.invalidate("books")
     return book_description_schema.jsonify(new_book), 201
 
+def number_arg(args, name):
+    if args.get(name) is None:
+        return None
+    try:
+        return float(args[name])
+    except ValueError:
+        raise ValueError(f"{name} must be a number.")
+
+def in_categories(book_id_column, category_ids):
+    # Semi-join through the book_categories(category_id, book_description__id) index
+    return book_id_column.in_(
+        select(book_categories.c.book_description__id).where(book_categories.c.category_id.in_(category_ids))
+    )
+
+def catalog_filters(args):
+    """Turn the catalog filter parameters into (category ids, WHERE clauses on Book_descriptions)."""
+    category_ids = []
+    if args.get("category"):
+        try:
+            category_ids = [int(category_id) for category_id in args["category"].split(",")]
+        except ValueError:
+            raise ValueError("category must be a comma separated list of category ids.")
+    filters = []
+    if args.get("language"):
+        filters.append(Book_descriptions.language.in_(args["language"].split(",")))
+    min_price = number_arg(args, "min_price")
+    if min_price is not None:
+        filters.append(Book_descriptions.price >= min_price)
+    max_price = number_arg(args, "max_price")
+    if max_price is not None:
+        filters.append(Book_descriptions.price <= max_price)
+    min_rating = number_arg(args, "min_rating")
+    if min_rating is not None:
+        filters.append(Book_descriptions.averageRating >= min_rating)
+    if args.get("in_stock", "").lower() in ("1", "true", "yes"):
+        filters.append(Book_descriptions.stock_quantity > 0)
+    return category_ids, filters
+
+def catalog_facets(category_ids, filters):
+    """Book counts per category and per language for the current filters, one GROUP BY query each."""
+    # Count on the book_categories index alone and only join the books when a book column is filtered
+    counts = select(book_categories.c.category_id, func.count().label("count"))
+    if category_ids:
+        counts = counts.where(in_categories(book_categories.c.book_description__id, category_ids))
+    if filters:
+        counts = counts.join(Book_descriptions, Book_descriptions.id == book_categories.c.book_description__id).where(*filters)
+    counts = counts.group_by(book_categories.c.category_id).subquery()
+    categories = db.session.execute(
+        select(Categories.id, Categories.title, counts.c.count)
+        .join(counts, counts.c.category_id == Categories.id)
+        .order_by(Categories.id)
+    ).all()
+    if category_ids:
+        filters = filters + [in_categories(Book_descriptions.id, category_ids)]
+    languages = db.session.execute(
+        select(Book_descriptions.language, func.count(Book_descriptions.id))
+        .where(*filters)
+        .group_by(Book_descriptions.language)
+        .order_by(Book_descriptions.language)
+    ).all()
+    return {
+        "categories" : [{"id" : id, "title" : title, "count" : count} for id, title, count in categories],
+        "languages" : [{"language" : language, "count" : count} for language, count in languages]
+    }
+
+# Filtered browsing runs the page query plus one query per facet asked for
+CATALOG_QUERY_BUDGET = 3
+
 @book_descriptions_bp.route('', methods={'GET'})
+@query_budget(CATALOG_QUERY_BUDGET)
+@cache.cached(tags=["books", "categories"], timeout="CACHE_STOCK_TIMEOUT")
 def get_book_descriptions():
-    book_descriptions = db.session.query(Book_descriptions).all()
-    return book_descriptions_schema.jsonify(book_descriptions)
+    try:
+        category_ids, filters = catalog_filters(request.args)
+        fields = book_fields(request.args)
+    except ValueError as e:
+        return jsonify({"error" : str(e)}), 400
+    sort = request.args.get("sort", "id")
+    descending = sort.startswith("-")
+    sort_column = SORT_COLUMNS.get(sort.lstrip("-"))
+    if sort_column is None:
+        return jsonify({"error" : f"sort must be one of: {', '.join(SORT_COLUMNS)}."}), 400
+    columns = [Book_descriptions.id] if sort_column is Book_descriptions.id else [sort_column, Book_descriptions.id]
+    page_filters = filters + [in_categories(Book_descriptions.id, category_ids)] if category_ids else filters
+    # The sort key is loaded too, the next cursor is read from the last row
+    loaded = fields | {column.key for column in columns} if fields else None
+    try:
+        book_descriptions, next_cursor = keyset_paginate(
+            db.session.query(Book_descriptions).options(*book_options(loaded)).where(*page_filters),
+            columns,
+            after=request.args.get("after"),
+            limit=request.args.get("limit", type=int),
+            descending=descending,
+        )
+    except CursorError as e:
+        return jsonify({"error" : str(e)}), 400
+    response = {
+        "data" : projected(BookDescriptionSchema, fields, many=True).dump(book_descriptions),
+        "next_cursor" : next_cursor
+    }
+    # Opt-in, the facet counts group every book matching the filters and a plain page doesn't need them
+    if request.args.get("facets", "false").lower() in ("1", "true", "yes"):
+        response["facets"] = catalog_facets(category_ids, filters)
+    return json_response(response)
+
+@book_descriptions_bp.route('/import', methods={'POST'})
+def import_book_descriptions():
+    format = request.args.get("format") or ("csv" if request.mimetype == "text/csv" else "jsonl")
+    on_conflict = request.args.get("on_conflict", "skip")
+    if format not in FORMATS:
+        return jsonify({"error" : f"format must be one of: {', '.join(FORMATS)}."}), 400
+    if on_conflict not in ON_CONFLICT:
+        return jsonify({"error" : f"on_conflict must be one of: {', '.join(ON_CONFLICT)}."}), 400
+    events = import_books(request.stream, format, on_conflict, current_app.config["IMPORT_CHUNK_SIZE"])
+    # Progress, row errors and the summary are streamed back as NDJSON while the feed is read
+    body = (json.dumps(event) + "\n" for event in events)
+    return current_app.response_class(stream_with_context(body), mimetype="application/x-ndjson")
+
+@book_descriptions_bp.route('/export', methods={'GET'})
+def export_book_descriptions():
+    try:
+        since = since_arg()
+        fields = book_fields(request.args)
+    except ValueError as e:
+        return jsonify({"error" : str(e)}), 400
+    query = select(Book_descriptions).order_by(Book_descriptions.id)
+    if since:
+        query = select(Book_descriptions).where(Book_descriptions.updated_at >= since).order_by(Book_descriptions.updated_at, Book_descriptions.id)
+    query = query.options(*book_options(fields))
+    schema = projected(BookDescriptionSchema, fields)
+    def records():
+        # Runs inside the streamed response, the session of the view is gone by then
+        for book in db.session.scalars(query.execution_options(yield_per=EXPORT_BATCH_SIZE)):
+            yield schema.dump(book)
+    return ndjson_response(records())
+
+@book_descriptions_bp.route('/search', methods={'GET'})
+@query_budget(2)
+@cache.cached(tags=["books"], timeout="CACHE_STOCK_TIMEOUT")
+def search_book_descriptions():
+    try:
+        limit = page_size(request.args.get("limit", type=int))
+        fields = book_fields(request.args)
+    except ValueError as e:
+        return jsonify({"error" : str(e)}), 400
+    q = request.args.get("q", "")
+    if not q.strip():
+        return jsonify({"error" : "q is required."}), 400
+    results = search.search(q, limit, options=book_options(fields))
+    schema = projected(BookDescriptionSchema, fields)
+    response = {
+        "data" : [
+            {
+                "book" : schema.dump(book),
+                "score" : score,
+                "highlights" : {field : value for field, value in highlights.items() if fields is None or field in fields}
+            }
+            for book, score, highlights in results
+        ]
+    }
+    return json_response(response)
 
 @book_descriptions_bp.route('/<int:book_id>', methods={'PUT'})
 def update_book_description(book_id):
@@ -40,7 +221,9 @@ def update_book_description(book_id):
         return jsonify({"error" : f"isbn can not be repetitive."}), 400
     for key, value in book_description_data.items():
         setattr(book_description, key, value)
+    search.index_book(book_description)
     db.session.commit()
+    cache.invalidate("books")
     return jsonify({"message" : f"Successfully book description with id: {book_id} updated."}), 200
 
 @book_descriptions_bp.route('/<int:book_id>', methods={'DELETE'})
@@ -51,7 +234,9 @@ def delete_book_description(book_id):
     if len(book_description.cart_books)>0 or len(book_description.order_books)>0 or len(book_description.favorites)>0 or len(book_description.reviews)>0:
         return jsonify({"message" : f"You can not delete this description"}), 200
     db.session.delete(book_description)
+    search.remove_book(book_id)
     db.session.commit()
+    cache.invalidate("books")
     return jsonify({"message" : f"Successfully deleted book_description with id: {book_id}"}), 200
 
 @book_descriptions_bp.route('/<int:book_id>/add_category/<int:category_id>', methods={'PUT'})
@@ -64,7 +249,9 @@ def add_category_to_book(book_id,category_id):
         return jsonify({"error" : f"Category with id: {category_id} not found."}), 404
     if category not in book.categories:
         book.categories.append(category)
+        book.updated_at = category.updated_at = datetime.now()
         db.session.commit()
+        cache.invalidate("books", "categories")
         return jsonify({"message" : f"Successfully category with id: {category_id} added to book_description with id:{book_id}."}), 200
     else:
         return jsonify({"message" : f"{category.title} is already added in book description with id:{book_id}."}),200
@@ -79,18 +266,62 @@ def remove_category_from_book(book_id,category_id):
         return jsonify({"error" : f"Category with id: {category_id} not found."}), 404
     if category in book.categories:
         book.categories.remove(category)
+        book.updated_at = category.updated_at = datetime.now()
         db.session.commit()
+        cache.invalidate("books", "categories")
         return jsonify({"message" : f"Successfully category with id: {category_id} removed from book_description with id:{book_id}."}), 200
     else:
         return jsonify({"message" : f"{category.title} is not in book description with id:{book_id}."}),200
     
+def book_version(book_id):
+    # Version of a book detail: the book row plus its categories, in one aggregate query
+    row = db.session.execute(
+        select(Book_descriptions.updated_at, func.count(Categories.id), func.max(Categories.updated_at))
+        .select_from(Book_descriptions)
+        .outerjoin(book_categories, book_categories.c.book_description__id == Book_descriptions.id)
+        .outerjoin(Categories, Categories.id == book_categories.c.category_id)
+        .where(Book_descriptions.id == book_id)
+        .group_by(Book_descriptions.id, Book_descriptions.updated_at)
+    ).first()
+    if row is None:
+        return None
+    return (book_id, *row), latest(row[0], row[2])
+
 @book_descriptions_bp.route('/<int:book_id>', methods={'GET'})
+@query_budget(3)
+@conditional(book_version)
+@cache.cached(tags=["books", "categories", stock_tag])
 def get_book_descriptions_info(book_id):
-    book = db.session.get(Book_descriptions,book_id)
+    try:
+        fields = book_fields(request.args)
+    except ValueError as e:
+        return jsonify({"error" : str(e)}), 400
+    book = db.session.get(Book_descriptions, book_id, options=book_options(fields) + load_plan((Book_descriptions.categories,)))
     if not book:
         return jsonify({"error" : f"Book description with id: {book_id} not found."}), 404
     response = {
-        "data" : book_description_schema.dump(book),
+        "data" : projected(BookDescriptionSchema, fields).dump(book),
         "categories" : categories_schema.dump(book.categories)
     }
-    return jsonify(response), 200
\ No newline at end of file
+    return json_response(response)
+
+@book_descriptions_bp.cli.command('reindex')
+def reindex_book_descriptions():
+    """Rebuild the full-text search index from the book_descriptions table."""
+    search.rebuild()
+    click.echo("Search index rebuilt.")
+
+@book_descriptions_bp.cli.command('import')
+@click.argument('feed', type=click.File('rb'))
+@click.option('--format', type=click.Choice(FORMATS), help='Feed format, guessed from the file extension by default.')
+@click.option('--on-conflict', type=click.Choice(ON_CONFLICT), default='skip', show_default=True, help='What to do with ISBNs that already exist.')
+@click.option('--chunk-size', type=int, help='Rows per transaction (default IMPORT_CHUNK_SIZE).')
+def import_book_descriptions_command(feed, format, on_conflict, chunk_size):
+    """Import a JSONL or CSV feed of book descriptions."""
+    format = format or ("csv" if feed.name.endswith(".csv") else "jsonl")
+    chunk_size = chunk_size or current_app.config["IMPORT_CHUNK_SIZE"]
+    for event in import_books(feed, format, on_conflict, chunk_size):
+        if event["type"] == "error":
+            click.echo(f"line {event['line']}: {event['errors']}", err=True)
+        else:
+            click.echo(f"{event['type']}: {event['processed']} rows, {event['inserted']} inserted, {event['updated']} updated, {event['skipped']} skipped, {event['failed']} failed")
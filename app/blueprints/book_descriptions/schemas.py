@@ -1,10 +1,57 @@
+from functools import lru_cache
+from sqlalchemy.orm import load_only
 from app.models import Book_descriptions
 from app.extensions import ma
+from app.utils.serializers import compiled
 
 
 class BookDescriptionSchema(ma.SQLAlchemyAutoSchema):
     class Meta:
         model = Book_descriptions
+        dump_only = ("updated_at",)
 
-book_description_schema = BookDescriptionSchema()
-book_descriptions_schema = BookDescriptionSchema(many=True)
\ No newline at end of file
+book_description_schema = compiled(BookDescriptionSchema())
+book_descriptions_schema = compiled(BookDescriptionSchema(many=True))
+
+BOOK_FIELDS = tuple(book_description_schema.fields)
+
+
+def book_fields(args):
+    """The book fields picked with ?fields= or ?exclude=, None for all of them; raises ValueError.
+
+    The id is always kept so a trimmed book can still be addressed.
+    """
+    fields, exclude = args.get("fields"), args.get("exclude")
+    if not fields and not exclude:
+        return None
+    if fields and exclude:
+        raise ValueError("Use either fields or exclude, not both.")
+    names = {name.strip() for name in (fields or exclude).split(",") if name.strip()}
+    unknown = sorted(names.difference(BOOK_FIELDS))
+    if unknown:
+        raise ValueError(f"Unknown book fields: {', '.join(unknown)}. Valid fields: {', '.join(BOOK_FIELDS)}.")
+    selected = names if fields else set(BOOK_FIELDS) - names
+    return frozenset(selected | {"id"})
+
+
+def book_options(fields):
+    """Loader options making a query on Book_descriptions only SELECT the picked columns.
+
+    Books reached through relationships are trimmed with load_plan(..., only={Book_descriptions: fields}).
+    """
+    if not fields:
+        return []
+    return [load_only(*[getattr(Book_descriptions, name) for name in sorted(fields)])]
+
+
+@lru_cache(maxsize=256)
+def projected(schema_class, fields, many=False, nested=None):
+    """A compiled schema_class instance dumping only the picked book fields, built once per field set.
+
+    ``nested`` names the field holding the book when schema_class wraps one, like a review.
+    """
+    if fields is None:
+        return compiled(schema_class(many=many))
+    if nested is None:
+        return compiled(schema_class(only=fields, many=many))
+    return compiled(schema_class(many=many, exclude=[f"{nested}.{name}" for name in BOOK_FIELDS if name not in fields]))
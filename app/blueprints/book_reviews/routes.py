@@ -1,27 +1,36 @@
 from .schemas import review_schema, reviews_schema, review_users_schema
 from app.blueprints.book_reviews import reviews_bp
-from app.utils.auth import token_required
+from app.utils.auth import token_required, current_user_id, ownership, active_user
 from flask import request, jsonify
 from marshmallow import ValidationError
-from app.models import db, Users, Reviews, Book_descriptions
-from app.blueprints.book_descriptions.schemas import book_description_schema
+from app.models import db, Reviews, Book_descriptions
+from app.utils.cache import cache, stock_tag
+from app.utils.conditional import conditional, latest
+from app.utils.streaming import ndjson_response, since_arg, EXPORT_BATCH_SIZE
+from sqlalchemy import select, func, exists, delete
+from app.blueprints.book_descriptions.schemas import BookDescriptionSchema, book_fields, book_options, projected
+from app.utils.loading import load_plan
+from app.utils.query_budget import query_budget
+from app.utils.serializers import json_response
 
 @reviews_bp.route('/<int:book_description_id>', methods={'POST'})
 @token_required
 def create_review(book_description_id):
-    user_id = request.user_id
-    user = db.session.get(Users, user_id)
-    book = db.session.get(Book_descriptions, book_description_id)
-    if not user:
+    user_id = current_user_id()
+    # Each user can add only one review for each book
+    user_exists, book_exists, existed_review = db.session.execute(select(
+        active_user(user_id),
+        exists().where(Book_descriptions.id == book_description_id),
+        exists().where(Reviews.user_id == user_id, Reviews.book_description_id == book_description_id),
+    )).one()
+    if not user_exists:
         return jsonify({"error" : f"User not found."}), 404
-    if not book:
+    if not book_exists:
         return jsonify({"error" : f"Book not found."}), 404
     try:
         review_data = review_schema.load(request.json)
     except ValidationError as e:
         return jsonify({"error_message" : e.messages}), 400
-    # Each user can add only one review for each book 
-    existed_review = db.session.query(Reviews).where((Reviews.user_id == user_id) & (Reviews.book_description_id == book_description_id)).first()
     if existed_review:
         return jsonify({"error" : f"You've already added a review for this book."}), 400
     review_data["user_id"] = user_id
@@ -29,25 +38,63 @@ def create_review(book_description_id):
     new_review = Reviews(**review_data)
     db.session.add(new_review)
     db.session.commit()
+    cache.invalidate("reviews")
     return review_schema.jsonify(new_review), 201
 
+def book_reviews_version(book_description_id):
+    # The book row plus its reviews, in one aggregate query on the reviews(book_description_id) index
+    row = db.session.execute(
+        select(Book_descriptions.updated_at, func.count(Reviews.id), func.max(Reviews.id), func.max(Reviews.updated_at))
+        .select_from(Book_descriptions)
+        .outerjoin(Reviews, Reviews.book_description_id == Book_descriptions.id)
+        .where(Book_descriptions.id == book_description_id)
+        .group_by(Book_descriptions.id, Book_descriptions.updated_at)
+    ).first()
+    if row is None:
+        return None
+    return (book_description_id, *row), latest(row[0], row[3])
+
 @reviews_bp.route('/book/<int:book_description_id>', methods={'GET'})
+@query_budget(3)
+@conditional(book_reviews_version)
+@cache.cached(tags=["books", "reviews", lambda book_description_id: stock_tag(book_description_id)])
 def get_reviews(book_description_id):
-    book = db.session.get(Book_descriptions, book_description_id)
+    try:
+        fields = book_fields(request.args)
+    except ValueError as e:
+        return jsonify({"error" : str(e)}), 400
+    book = db.session.get(Book_descriptions, book_description_id, options=book_options(fields) + load_plan((Book_descriptions.reviews, Reviews.user)))
     if not book:
         return jsonify({"error" : f"Book not found."}), 404
     response = {
-        "book_info" : book_description_schema.dump(book),
+        "book_info" : projected(BookDescriptionSchema, fields).dump(book),
         "reviews" : review_users_schema.dump(book.reviews)
     }
-    return jsonify(response), 200
+    return json_response(response)
+
+@reviews_bp.route('/export', methods={'GET'})
+def export_reviews():
+    try:
+        since = since_arg()
+    except ValueError as e:
+        return jsonify({"error" : str(e)}), 400
+    query = select(Reviews).order_by(Reviews.id)
+    if since:
+        query = select(Reviews).where(Reviews.updated_at >= since).order_by(Reviews.updated_at, Reviews.id)
+    def records():
+        # Runs inside the streamed response, the session of the view is gone by then
+        for review in db.session.scalars(query.execution_options(yield_per=EXPORT_BATCH_SIZE)):
+            yield review_schema.dump(review)
+    return ndjson_response(records())
 
 @reviews_bp.route('/all')
+@cache.cached(tags=["reviews"])
 def get_all_reviews():
     reviews = db.session.query(Reviews).all()
     return reviews_schema.jsonify(reviews), 200
 
 @reviews_bp.route('/<int:review_id>')
+@cache.cached(tags=["reviews"])
 def get_review(review_id):
     review = db.session.get(Reviews, review_id)
     return review_schema.jsonify(review), 200
@@ -55,38 +102,36 @@ def get_review(review_id):
 @reviews_bp.route('<int:review_id>', methods={'PUT'})
 @token_required
 def update_review(review_id):
-    user_id = request.user_id
-    user = db.session.get(Users, user_id)
-    review = db.session.get(Reviews, review_id)
-    if not review:
+    user_exists, found, owned = ownership(Reviews, review_id)
+    if not found:
         return jsonify({"error" : f"Review not found."}), 404
-    if not user:
+    if not user_exists:
         return jsonify({"error" : f"User not found."}), 404
-    if review not in user.reviews:
+    if not owned:
         return jsonify({"error" : f"You can not update this review."}), 404
     try:
         review_data = review_schema.load(request.json)
     except ValidationError as e:
         return jsonify({"error_message" : e.messages}), 400
+    review = db.session.get(Reviews, review_id)
     for key, value in review_data.items():
         setattr(review, key, value)
     db.session.commit()
+    cache.invalidate("reviews")
     return jsonify({"message" : "Your review successfully updated"}), 200
 
 @reviews_bp.route('<int:review_id>', methods={'DELETE'})
 @token_required
 def delete_payment(review_id):
-    user_id = request.user_id
-    user = db.session.get(Users, user_id)
-    review = db.session.get(Reviews, review_id)
-    if not review:
+    user_exists, found, owned = ownership(Reviews, review_id)
+    if not found:
         return jsonify({"error" : f"Review not found."}), 404
-    if not user:
+    if not user_exists:
         return jsonify({"error" : f"User not found."}), 404
-    if review in user.reviews:
-        user.reviews.remove(review)
-        db.session.delete(review)
+    if owned:
+        db.session.execute(delete(Reviews).where(Reviews.id == review_id))
         db.session.commit()
+        cache.invalidate("reviews")
         return jsonify({"message" : "Your review successfully deleted"}), 200
     else:
         return jsonify({"message": "This review in not in your reviews"}), 200
\ No newline at end of file
@@ -2,25 +2,27 @@ from app.models import Reviews
 from app.extensions import ma
 from app.blueprints.book_descriptions.schemas import BookDescriptionSchema
 from app.blueprints.users.schemas import UserSchema
+from app.utils.serializers import compiled
 
 class ReviewSchema(ma.SQLAlchemyAutoSchema):
     class Meta:
         model = Reviews
+        dump_only = ("updated_at",)
 
-review_schema = ReviewSchema()
-reviews_schema = ReviewSchema(many=True)
+review_schema = compiled(ReviewSchema())
+reviews_schema = compiled(ReviewSchema(many=True))
 
 class UserReviewSchema(ma.SQLAlchemyAutoSchema):
     book_description = ma.Nested(BookDescriptionSchema)
     class Meta:
         model = Reviews
 
-user_reviews_schema = UserReviewSchema(many=True)
+user_reviews_schema = compiled(UserReviewSchema(many=True))
 
 class ReviewUserSchema(ma.SQLAlchemyAutoSchema):
     user = ma.Nested(UserSchema(exclude=['created_at', 'email', 'password', 'phone']))
     class Meta:
         model = Reviews
 
-review_users_schema = ReviewUserSchema(many=True)
+review_users_schema = compiled(ReviewUserSchema(many=True))
 
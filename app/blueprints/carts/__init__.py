@@ -1,7 +1,7 @@
 from flask import Blueprint
 
 # Creating blueprint
-carts_bp = Blueprint('carts_bp', __name__)
+carts_bp = Blueprint('carts_bp', __name__, cli_group='carts')
 
 # It has to be here after creating blueprint
 from . import routes
\ No newline at end of file
@@ -0,0 +1,123 @@
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import select, update, delete, func, case
+from app.models import db, Reservations, Book_descriptions
+from app.utils.cache import cache, stock_tag
+from app.utils.upsert import upsert
+
+
+class ReservationError(Exception):
+    pass
+
+
+def hold_stock(quantities):
+    """Take {book_id: quantity} copies off the stock with one conditional UPDATE; False if a book hasn't enough.
+
+    A book is only decremented when its own row covers the quantity, no count over the
+    reservations is needed.
+    """
+    quantity = case(quantities, value=Book_descriptions.id)
+    result = db.session.execute(
+        update(Book_descriptions)
+        .where(Book_descriptions.id.in_(quantities), Book_descriptions.stock_quantity >= quantity)
+        .values(stock_quantity=Book_descriptions.stock_quantity - quantity)
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount == len(quantities)
+
+
+def return_stock(book_id, quantity):
+    db.session.execute(
+        update(Book_descriptions)
+        .where(Book_descriptions.id == book_id)
+        .values(stock_quantity=Book_descriptions.stock_quantity + quantity)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def reserve(cart_id, quantities):
+    """Hold {book_id: quantity} copies for a cart and push its expiry back; raises ReservationError when sold out.
+
+    The reservation rows are upserted before the book rows are updated, the order the
+    sweeper and the checkout lock them in. Runs in the caller's transaction, the caller commits.
+    """
+    expires_at = datetime.now() + timedelta(seconds=current_app.config["RESERVATION_TTL"])
+    db.session.execute(upsert(
+        Reservations,
+        [{"cart_id" : cart_id, "book_description_id" : book_id, "quantity" : quantity, "expires_at" : expires_at} for book_id, quantity in sorted(quantities.items())],
+        ["cart_id", "book_description_id"],
+        lambda new: {"quantity" : Reservations.quantity + new.quantity, "expires_at" : new.expires_at}
+    ))
+    if not hold_stock(quantities):
+        raise ReservationError("This book is out of stock." if len(quantities) == 1 else "Some of these books are out of stock.")
+
+
+def release(cart_id, book_id, quantity=1):
+    """Give back up to quantity reserved copies of a cart line (fewer if part of it expired)."""
+    reservation = db.session.scalars(
+        select(Reservations).where(Reservations.cart_id == cart_id, Reservations.book_description_id == book_id).with_for_update()
+    ).first()
+    if reservation is None:
+        return
+    released = min(quantity, reservation.quantity)
+    if released == reservation.quantity:
+        db.session.delete(reservation)
+    else:
+        reservation.quantity -= released
+    db.session.flush()
+    return_stock(book_id, released)
+
+
+def reserved_quantity(cart_id):
+    """Correlated subquery: the copies of the outer query's book reserved by a cart."""
+    return (
+        select(func.coalesce(func.sum(Reservations.quantity), 0))
+        .where(Reservations.cart_id == cart_id, Reservations.book_description_id == Book_descriptions.id)
+        .scalar_subquery()
+    )
+
+
+def release_cart(cart_id):
+    """Give back every copy a cart holds, e.g. before the cart is deleted."""
+    rows = db.session.execute(
+        select(Reservations.book_description_id, Reservations.quantity).where(Reservations.cart_id == cart_id).with_for_update()
+    ).all()
+    for book_id, quantity in rows:
+        return_stock(book_id, quantity)
+    db.session.execute(delete(Reservations).where(Reservations.cart_id == cart_id))
+
+
+def sweep_expired(batch_size=None, now=None):
+    """Return the stock of expired reservations to the books, batch_size reservations per transaction.
+
+    Each batch locks its reservations with FOR UPDATE SKIP LOCKED where the database has it,
+    so a checkout converting one of them is left alone and several sweepers can run at once.
+    Returns the number of reservations released.
+    """
+    batch_size = batch_size or current_app.config["RESERVATION_SWEEP_BATCH"]
+    now = now or datetime.now()
+    released, books = 0, set()
+    while True:
+        batch = db.session.execute(
+            select(Reservations.id, Reservations.book_description_id, Reservations.quantity)
+            .where(Reservations.expires_at <= now)
+            .order_by(Reservations.expires_at, Reservations.id)
+            .limit(batch_size)
+            .with_for_update(skip_locked=True)
+        ).all()
+        if not batch:
+            break
+        returned = {}
+        for reservation_id, book_id, quantity in batch:
+            returned[book_id] = returned.get(book_id, 0) + quantity
+        for book_id in sorted(returned):
+            return_stock(book_id, returned[book_id])
+        books.update(returned)
+        db.session.execute(delete(Reservations).where(Reservations.id.in_([row.id for row in batch])))
+        db.session.commit()
+        released += len(batch)
+        if len(batch) < batch_size:
+            break
+    if books:
+        cache.invalidate(*map(stock_tag, books))
+    return released
@@ -1,98 +1,142 @@
 from app.blueprints.carts import carts_bp
-from .schemas import cart_schema
-from app.utils.auth import token_required
+from .schemas import cart_update_schema
+from app.utils.auth import token_required, current_user, current_user_id
 from flask import request, jsonify
-from app.models import db,Users, Carts, Cart_books, Book_descriptions
-from app.blueprints.book_descriptions.schemas import book_description_schema
+from marshmallow import ValidationError
+from app.models import db, Carts, user_addresses
+from sqlalchemy import select, exists
+from app.blueprints.book_descriptions.schemas import BookDescriptionSchema, book_fields, projected
+from app.utils.query_budget import query_budget
+from app.utils.serializers import json_response
+from app.utils.cache import cache, stock_tag
+from app.utils.idempotency import idempotency
+from app.utils.cart_store import cart_store
+from .reservations import sweep_expired, ReservationError
+from .store import apply_deltas, cart_contents, cart_lines, CartError
+from app.blueprints.orders.history import SHIPPING_METHODS
+from app.blueprints.orders.pricing import quote_cart
+import click
+import time
 
 @carts_bp.route('',methods={'GET'})
+# One more than without the cart store, which reads the cart and its lines apart on a miss
+@query_budget(3)
 @token_required
 def get_cart_books():
-    user_id = request.user_id
-    user = db.session.get(Users, user_id)
-    if not user:
-        return jsonify({"error" : f"User not found."}), 404
-    cart = db.session.query(Carts).where(Carts.user_id == user_id).first()
-    if not cart:
+    try:
+        fields = book_fields(request.args)
+    except ValueError as e:
+        return jsonify({"error" : str(e)}), 400
+    contents = cart_contents(current_user_id(), fields)
+    if not contents:
+        # Only a user without a cart may have been deleted
+        if not current_user():
+            return jsonify({"error" : f"User not found."}), 404
         return ({"message" : "There is no cart for you"}), 200
-    if len(cart.cart_books) == 0:
+    cart_info, lines = contents
+    if len(lines) == 0:
         return ({"message" : "Your cart is empty"}), 200
     response = {
-        "cart_info": cart_schema.dump(cart),
+        "cart_info": cart_info,
         "cart_books": [
             {
-                "book": book_description_schema.dump(book.book_description),
-                "quantity": book.quantity
+                "book": projected(BookDescriptionSchema, fields).dump(book),
+                "quantity": quantity
             }
-            for book in cart.cart_books
+            for book, quantity in lines
         ]
     }
-    return jsonify(response), 200
+    return json_response(response)
+
+@carts_bp.route('/quote',methods={'GET'})
+# 2 without the cart store, which writes the user's unflushed edits first
+@query_budget(5)
+@token_required
+def quote_cart_totals():
+    shipping_method = request.args.get("shipping_method", "InStore")
+    if shipping_method not in SHIPPING_METHODS:
+        return jsonify({"error" : f"shipping_method must be among: {', '.join(SHIPPING_METHODS)}."}), 400
+    address_id = request.args.get("address_id", type=int)
+    user_id = current_user_id()
+    if cart_store.enabled:
+        cart_store.flush(user_id)
+    cart_id, address_owned = db.session.execute(select(
+        select(Carts.id).where(Carts.user_id == user_id).scalar_subquery(),
+        exists().where(user_addresses.c.user_id == user_id, user_addresses.c.address_id == address_id),
+    )).one()
+    if address_id is not None and not address_owned:
+        return jsonify({"error" : "Address not found."}), 404
+    if cart_id is None:
+        return ({"message" : "There is no cart for you"}), 200
+    lines, totals = quote_cart(cart_id, shipping_method, address_id)
+    return jsonify({"cart_id" : cart_id, "address_id" : address_id, "shipping_method" : shipping_method, "lines" : lines, **totals}), 200
+
+@carts_bp.route('',methods={'PATCH'})
+@token_required
+@idempotency.idempotent
+def update_cart():
+    try:
+        data = cart_update_schema.load(request.json)
+    except ValidationError as e:
+        return jsonify({"error_message" : e.messages}), 400
+    deltas = {}
+    for item in data["items"]:
+        deltas[item["book_description_id"]] = deltas.get(item["book_description_id"], 0) + item["quantity"]
+    user_id = current_user_id()
+    try:
+        apply_deltas(user_id, deltas)
+    except ReservationError as e:
+        return jsonify({"error" : str(e)}), 409
+    except CartError as e:
+        return jsonify({"error" : e.message}), e.status
+    # Stock is part of the book payloads, only these books' views are dropped
+    cache.invalidate(*map(stock_tag, deltas))
+    return jsonify({"message" : "Your cart is updated", "cart_books" : cart_lines(user_id)}), 200
 
 @carts_bp.route('/add_book/<int:book_description_id>',methods={'PUT'})
 @token_required
+@idempotency.idempotent
+@query_budget(6)
 def add_book_to_cart(book_description_id):
-    user_id = request.user_id
-    user = db.session.get(Users, user_id)
-    book = db.session.get(Book_descriptions, book_description_id)
-    if not user:
-        return jsonify({"error" : f"User not found."}), 404
-    if not book:
-        return jsonify({"error" : f"Book Description not found."}), 404
-    existed_cart = db.session.query(Carts).where(Carts.user_id == user_id).first()
-    if not existed_cart:
-        new_cart = Carts(user_id=user_id)
-        db.session.add(new_cart)
-        db.session.commit()
-        data = {
-            "cart_id" : new_cart.id,
-            "book_description_id" : book_description_id,
-            "quantity" : 1
-        }
-        new_cart_book = Cart_books(**data)
-        db.session.add(new_cart_book)
-        new_cart.cart_books.append(new_cart_book)
-        db.session.commit()
-        return ({"message" : "The book added to your cart"}), 200
-    existing_book_in_cart = db.session.query(Cart_books).where((Cart_books.cart_id == existed_cart.id) & (Cart_books.book_description_id == book_description_id)).first()
-    if existing_book_in_cart:
-        existing_book_in_cart.quantity += 1
-        db.session.commit()
-        return ({"message" : "The book quantity added"}), 200
-    data = {
-            "cart_id" : existed_cart.id,
-            "book_description_id" : book_description_id,
-            "quantity" : 1
-        }
-    new_cart_book = Cart_books(**data)
-    db.session.add(new_cart_book)
-    existed_cart.cart_books.append(new_cart_book)
-    db.session.commit()
+    try:
+        apply_deltas(current_user_id(), {book_description_id : 1})
+    except ReservationError as e:
+        return jsonify({"error" : str(e)}), 409
+    except CartError as e:
+        return jsonify({"error" : e.message}), e.status
+    cache.invalidate(stock_tag(book_description_id))
     return ({"message" : "The book added to your cart"}), 200
 
 @carts_bp.route('/remove_book/<int:book_description_id>',methods={'PUT'})
 @token_required
+@idempotency.idempotent
+@query_budget(7)
 def remove_book_from_cart(book_description_id):
-    user_id = request.user_id
-    user = db.session.get(Users, user_id)
-    book = db.session.get(Book_descriptions, book_description_id)
-    if not user:
-        return jsonify({"error" : f"User not found."}), 404
-    if not book:
-        return jsonify({"error" : f"Book Description not found."}), 404
-    cart = db.session.query(Carts).where(Carts.user_id == user_id).first()
-    if not cart:
-        return jsonify({"error" : f"Cart not found."}), 404
-    existing_book = db.session.query(Cart_books).where((Cart_books.cart_id == cart.id) & (Cart_books.book_description_id == book_description_id)).first()
-    if not existing_book:
-        return jsonify({"error" : f"Book is not in your cart."}), 404
-    if existing_book.quantity > 1:
-        existing_book.quantity -= 1
-        db.session.commit()
+    try:
+        outcome = apply_deltas(current_user_id(), {book_description_id : -1})
+    except CartError as e:
+        return jsonify({"error" : e.message}), e.status
+    cache.invalidate(stock_tag(book_description_id))
+    if outcome[book_description_id] == "decreased":
         return ({"message" : "The book quantity decreased"}), 200
-    cart.cart_books.remove(existing_book)
-    db.session.delete(existing_book)
-    db.session.commit()
     return ({"message" : "The book removed from your cart"}), 200
 
+@carts_bp.cli.command('sweep-reservations')
+@click.option('--batch-size', type=int, help='Reservations per transaction (default RESERVATION_SWEEP_BATCH).')
+@click.option('--interval', type=float, help='Keep sweeping every INTERVAL seconds instead of once.')
+def sweep_reservations_command(batch_size, interval):
+    """Return the stock of expired cart reservations to the books."""
+    while True:
+        released = sweep_expired(batch_size)
+        click.echo(f"{released} expired reservations released.")
+        if not interval:
+            break
+        time.sleep(interval)
 
+@carts_bp.cli.command('flush')
+def flush_cart_store_command():
+    """Write the carts edited in the cart store to the database."""
+    if not cart_store.enabled:
+        click.echo("CART_STORE is \"database\", there is nothing to flush.")
+        return
+    click.echo(f"{cart_store.flush()} carts written.")
@@ -1,10 +1,22 @@
-from app.models import Carts, Cart_books
+from app.models import Carts
 from app.extensions import ma
+from marshmallow import fields, validate
+from app.utils.serializers import compiled
 
 
 class CartSchema(ma.SQLAlchemyAutoSchema):
     class Meta:
         model = Carts
 
-cart_schema = CartSchema()
+cart_schema = compiled(CartSchema())
 
+
+class CartItemDeltaSchema(ma.Schema):
+    book_description_id = fields.Integer(required=True)
+    # Copies to add, or to remove when negative
+    quantity = fields.Integer(required=True, validate=validate.NoneOf([0]))
+
+class CartUpdateSchema(ma.Schema):
+    items = fields.List(fields.Nested(CartItemDeltaSchema), required=True, validate=validate.Length(min=1, max=100))
+
+cart_update_schema = CartUpdateSchema()
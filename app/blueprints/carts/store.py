@@ -0,0 +1,189 @@
+from sqlalchemy import select, update, delete, case, func
+from sqlalchemy.exc import SQLAlchemyError
+from app.models import db, Carts, Cart_books, Book_descriptions
+from app.utils.auth import active_user
+from app.utils.cart_store import cart_store
+from app.utils.loading import load_plan
+from app.utils.upsert import upsert
+from app.blueprints.book_descriptions.schemas import book_options
+from .schemas import cart_schema
+from .reservations import reserve, release, ReservationError
+
+# Relationships serialized by the cart payloads
+CART_GRAPH = [(Carts.cart_books, Cart_books.book_description)]
+
+
+class CartError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def find_cart(user_id, book_ids):
+    """Check the user and books exist and return the id of the user's cart (None if they have none), in one query."""
+    user_exists, cart_id, found = db.session.execute(select(
+        active_user(user_id),
+        select(Carts.id).where(Carts.user_id == user_id).scalar_subquery(),
+        select(func.count()).select_from(Book_descriptions).where(Book_descriptions.id.in_(book_ids)).scalar_subquery(),
+    )).one()
+    if not user_exists:
+        raise CartError("User not found.", 404)
+    if found != len(book_ids):
+        raise CartError("Book Description not found.", 404)
+    return cart_id
+
+
+def create_cart(user_id):
+    # Two first adds racing each other both end up with the cart one of them created
+    db.session.execute(upsert(Carts, {"user_id" : user_id}, ["user_id"]))
+    return db.session.scalars(select(Carts).where(Carts.user_id == user_id)).one()
+
+
+def load_cart(user_id, cart_id=None):
+    """The live cart of a user from the cart store, read from the database on a miss. None if they have no cart."""
+    cart = cart_store.get(user_id)
+    if cart is not None and (cart_id is None or cart["cart_id"] == cart_id):
+        return cart
+    row = db.session.scalars(select(Carts).where(Carts.user_id == user_id)).first()
+    if row is None:
+        return None
+    lines = db.session.execute(select(Cart_books.book_description_id, Cart_books.quantity).where(Cart_books.cart_id == row.id)).all()
+    if cart is not None:
+        # Left behind by a cart checked out through another worker
+        cart_store.evict(user_id)
+    return cart_store.load(user_id, {"cart_id" : row.id, "cart_info" : cart_schema.dump(row), "lines" : {str(book_id) : quantity for book_id, quantity in lines}})
+
+
+def apply_deltas(user_id, deltas):
+    """Add (positive) or remove (negative) quantities of books, {book_id: delta}, to the user's cart.
+
+    Additions are held with reservations and written with one upsert of every line
+    (INSERT ... ON CONFLICT DO UPDATE quantity = quantity + n), removals with one UPDATE
+    and one DELETE of the lines that reach zero, whatever the number of books. With the
+    cart store enabled only the reservations are written, the lines are edited in the
+    store and flushed later. Commits, or rolls back and raises CartError / ReservationError;
+    returns {book_id: "added" | "decreased" | "removed"}.
+    """
+    deltas = {book_id : delta for book_id, delta in deltas.items() if delta}
+    try:
+        cart_id = find_cart(user_id, list(deltas))
+        added = {book_id : delta for book_id, delta in sorted(deltas.items()) if delta > 0}
+        removed = {book_id : -delta for book_id, delta in sorted(deltas.items()) if delta < 0}
+        if removed and cart_id is None:
+            raise CartError("Cart not found.", 404)
+        if cart_store.enabled:
+            return apply_to_store(user_id, cart_id, added, removed)
+        outcome = {}
+        if removed:
+            # Reservations first, the lock order of the sweeper and the checkout
+            for book_id, quantity in removed.items():
+                release(cart_id, book_id, quantity)
+            lines = dict(db.session.execute(
+                select(Cart_books.book_description_id, Cart_books.quantity)
+                .where(Cart_books.cart_id == cart_id, Cart_books.book_description_id.in_(removed))
+                .with_for_update()
+            ).all())
+            if len(lines) != len(removed):
+                raise CartError("Book is not in your cart.", 404)
+            outcome.update({book_id : "decreased" if lines[book_id] > quantity else "removed" for book_id, quantity in removed.items()})
+            db.session.execute(
+                update(Cart_books)
+                .where(Cart_books.cart_id == cart_id, Cart_books.book_description_id.in_(removed))
+                .values(quantity=Cart_books.quantity - case(removed, value=Cart_books.book_description_id))
+                .execution_options(synchronize_session=False)
+            )
+            db.session.execute(
+                delete(Cart_books)
+                .where(Cart_books.cart_id == cart_id, Cart_books.quantity <= 0)
+                .execution_options(synchronize_session=False)
+            )
+        if added:
+            if cart_id is None:
+                cart_id = create_cart(user_id).id
+            reserve(cart_id, added)
+            db.session.execute(upsert(
+                Cart_books,
+                [{"cart_id" : cart_id, "book_description_id" : book_id, "quantity" : quantity} for book_id, quantity in added.items()],
+                ["cart_id", "book_description_id"],
+                lambda new: {"quantity" : Cart_books.quantity + new.quantity}
+            ))
+            outcome.update({book_id : "added" for book_id in added})
+        db.session.commit()
+        return outcome
+    except (CartError, ReservationError, SQLAlchemyError):
+        db.session.rollback()
+        raise
+
+
+def apply_to_store(user_id, cart_id, added, removed):
+    # The stock is held in the database like without the store, overselling can't wait for a flush
+    cart = load_cart(user_id, cart_id) if cart_id is not None else None
+    if any(str(book_id) not in (cart["lines"] if cart else {}) for book_id in removed):
+        raise CartError("Book is not in your cart.", 404)
+    for book_id, quantity in removed.items():
+        release(cart_id, book_id, quantity)
+    if added:
+        if cart is None:
+            row = create_cart(user_id)
+            cart_id = row.id
+            cart = {"cart_id" : cart_id, "cart_info" : cart_schema.dump(row), "lines" : {}}
+        reserve(cart_id, added)
+    db.session.commit()
+    outcome = {}
+    def edit(live):
+        live = live if live is not None and live["cart_id"] == cart_id else cart
+        lines = live["lines"]
+        for book_id, quantity in removed.items():
+            left = lines.get(str(book_id), 0) - quantity
+            outcome[book_id] = "decreased" if left > 0 else "removed"
+            if left > 0:
+                lines[str(book_id)] = left
+            else:
+                lines.pop(str(book_id), None)
+        for book_id, quantity in added.items():
+            lines[str(book_id)] = lines.get(str(book_id), 0) + quantity
+            outcome[book_id] = "added"
+        return live
+    cart_store.update(user_id, edit)
+    return outcome
+
+
+def cart_contents(user_id, fields=None, user=None):
+    """The cart info and [(book, quantity)] lines of a user's cart, None if they have no cart.
+
+    Without the cart store, pass the user if their cart is already loaded with CART_GRAPH.
+    """
+    if cart_store.enabled:
+        live = load_cart(user_id)
+        if live is None:
+            return None
+        quantities = {int(book_id) : quantity for book_id, quantity in live["lines"].items()}
+        books = db.session.scalars(
+            select(Book_descriptions).where(Book_descriptions.id.in_(quantities)).options(*book_options(fields)).order_by(Book_descriptions.id)
+        ).all()
+        return live["cart_info"], [(book, quantities[book.id]) for book in books]
+    if user is not None:
+        cart = user.cart
+    else:
+        cart = db.session.scalars(
+            select(Carts).options(*load_plan(*CART_GRAPH, only={Book_descriptions : fields})).where(Carts.user_id == user_id)
+        ).first()
+    if cart is None:
+        return None
+    return cart_schema.dump(cart), [(line.book_description, line.quantity) for line in cart.cart_books]
+
+
+def cart_lines(user_id):
+    if cart_store.enabled:
+        cart = load_cart(user_id)
+        return [{"book_description_id" : int(book_id), "quantity" : quantity} for book_id, quantity in sorted(cart["lines"].items(), key=lambda line: int(line[0]))]
+    return [
+        {"book_description_id" : book_id, "quantity" : quantity}
+        for book_id, quantity in db.session.execute(
+            select(Cart_books.book_description_id, Cart_books.quantity)
+            .join(Carts, Carts.id == Cart_books.cart_id)
+            .where(Carts.user_id == user_id)
+            .order_by(Cart_books.book_description_id)
+        )
+    ]
@@ -2,7 +2,12 @@ from .schemas import category_schema, categories_schema
 from app.blueprints.categories import categories_bp
 from flask import request, jsonify
 from marshmallow import ValidationError
-from app.models import db, Categories
+from app.models import db, Categories, book_categories
+from app.utils.streaming import ndjson_response, since_arg, EXPORT_BATCH_SIZE
+from itertools import groupby
+from app.utils.cache import cache
+from app.utils.conditional import conditional
+from sqlalchemy import select, func
 
 @categories_bp.route('', methods={'POST'})
 def add_category():
@@ -17,9 +22,42 @@ def add_category():
     new_category = Categories(**data)
     db.session.add(new_category)
     db.session.commit()
+    cache.invalidate("categories")
     return category_schema.jsonify(new_category), 201
 
+@categories_bp.route('/export', methods={'GET'})
+def export_categories():
+    try:
+        since = since_arg()
+    except ValueError as e:
+        return jsonify({"error" : str(e)}), 400
+    # One pass over categories joined to their memberships, grouped back per category while streaming
+    query = (
+        select(Categories.id, Categories.title, Categories.updated_at, book_categories.c.book_description__id)
+        .outerjoin(book_categories, book_categories.c.category_id == Categories.id)
+        .order_by(Categories.id, book_categories.c.book_description__id)
+    )
+    if since:
+        query = query.where(Categories.updated_at >= since)
+    def records():
+        rows = db.session.execute(query.execution_options(yield_per=EXPORT_BATCH_SIZE))
+        for (id, title, updated_at), members in groupby(rows, key=lambda row: (row.id, row.title, row.updated_at)):
+            yield {
+                "id" : id,
+                "title" : title,
+                "updated_at" : updated_at.isoformat() if updated_at else None,
+                "book_ids" : [row.book_description__id for row in members if row.book_description__id is not None]
+            }
+    return ndjson_response(records())
+
+def categories_version():
+    # Any insert, update or delete changes the count, the highest id or the latest update
+    row = db.session.execute(select(func.count(Categories.id), func.max(Categories.id), func.max(Categories.updated_at))).one()
+    return tuple(row), row[2]
+
 @categories_bp.route('', methods={'GET'})
+@conditional(categories_version)
+@cache.cached(tags=["categories"])
 def get_categories():
     categories = db.session.query(Categories).all()
     return categories_schema.jsonify(categories)
@@ -40,6 +78,7 @@ def update_category(category_id):
     for key, value in category_data.items():
         setattr(category, key, value)
     db.session.commit()
+    cache.invalidate("categories")
     return jsonify({"message" : f"Successfully category with id: {category_id} updated."}), 200
 
 @categories_bp.route('/<int:category_id>', methods={'DELETE'})
@@ -49,4 +88,5 @@ def delete_category(category_id):
         return jsonify({"error" : f"This Category with id: {category_id} not found."}), 404
     db.session.delete(category)
     db.session.commit()
+    cache.invalidate("categories")
     return jsonify({"message" : f"Successfully deleted book_description with id: {category_id}"}), 200
\ No newline at end of file
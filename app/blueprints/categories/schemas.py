@@ -1,10 +1,12 @@
 from app.models import Categories
 from app.extensions import ma
+from app.utils.serializers import compiled
 
 
 class CategorySchema(ma.SQLAlchemyAutoSchema):
     class Meta:
         model = Categories
+        dump_only = ("updated_at",)
 
-category_schema = CategorySchema()
-categories_schema = CategorySchema(many=True)
\ No newline at end of file
+category_schema = compiled(CategorySchema())
+categories_schema = compiled(CategorySchema(many=True))
\ No newline at end of file
@@ -1,55 +1,69 @@
 from .schemas import book_favorites_schema
 from app.blueprints.favorites import favorites_bp
-from app.utils.auth import token_required
+from app.utils.auth import token_required, current_user_id, ownership, active_user
 from flask import request, jsonify
-from app.models import db, Users, Favorites, Book_descriptions
-from app.blueprints.book_descriptions.schemas import book_description_schema
+from app.models import db, Favorites, Book_descriptions
+from sqlalchemy import select, delete
+from app.blueprints.book_descriptions.schemas import BookDescriptionSchema, book_fields, book_options, projected
+from app.utils.loading import load_plan
+from app.utils.query_budget import query_budget
+from app.utils.serializers import json_response
 
 # Add a book to favorites
 @favorites_bp.route('/<int:book_description_id>', methods=['POST'])
 @token_required
 def add_favorite(book_description_id):
-	user_id = int(request.user_id)
-	user = db.session.get(Users, user_id)
-	book = db.session.get(Book_descriptions, book_description_id)
-	if not user:
+	user_id = current_user_id()
+	user_exists, title, existed_favorite = favorite_state(user_id, book_description_id)
+	if not user_exists:
 		return jsonify({"error": "User not found."}), 404
-	if not book:
+	if title is None:
 		return jsonify({"error": "Book not found."}), 404
-	existed_favorite = db.session.query(Favorites).where((Favorites.user_id == user_id) & (Favorites.book_description_id == book_description_id)).first()
 	if existed_favorite:
 		return jsonify({"error": "Book already in favorites."}), 400
 	favorite = Favorites(user_id=user_id, book_description_id=book_description_id)
 	db.session.add(favorite)
 	db.session.commit()
-	return jsonify({"message": f"{book.title} added to your favorites."}), 200
+	return jsonify({"message": f"{title} added to your favorites."}), 200
+
+def favorite_state(user_id, book_description_id):
+	# Whether the user exists, the book's title (None if there's no such book) and the id of the
+	# user's favorite of it, in one query
+	return db.session.execute(select(
+		active_user(user_id),
+		select(Book_descriptions.title).where(Book_descriptions.id == book_description_id).scalar_subquery(),
+		select(Favorites.id).where(Favorites.user_id == user_id, Favorites.book_description_id == book_description_id).limit(1).scalar_subquery(),
+	)).one()
 
 # Get all favorites for a book
 @favorites_bp.route('/book/<int:book_description_id>', methods=['GET'])
+@query_budget(2)
 def get_book_favorites(book_description_id):
-	book = db.session.get(Book_descriptions, book_description_id)
+	try:
+		fields = book_fields(request.args)
+	except ValueError as e:
+		return jsonify({"error": str(e)}), 400
+	book = db.session.get(Book_descriptions, book_description_id, options=book_options(fields) + load_plan((Book_descriptions.favorites, Favorites.user)))
 	if not book:
 		return jsonify({"error": "Book not found."}), 404
 	response = {
-        "book_info" : book_description_schema.dump(book),
+        "book_info" : projected(BookDescriptionSchema, fields).dump(book),
         "favorites" : book_favorites_schema.dump(book.favorites)
     }
-	return jsonify(response), 200
+	return json_response(response)
 
 # Remove a book from favorites
 @favorites_bp.route('/<int:favorite_id>', methods=['DELETE'])
 @token_required
 def delete_favorite(favorite_id):
-	user_id = int(request.user_id)
-	user = db.session.get(Users, user_id)
-	favorite = db.session.get(Favorites, favorite_id)
-	if not favorite:
+	user_exists, found, owned = ownership(Favorites, favorite_id)
+	if not found:
 		return jsonify({"error": "Favorite not found."}), 404
-	if not user:
+	if not user_exists:
 		return jsonify({"error": "User not found."}), 404
-	if favorite.user_id != user_id:
+	if not owned:
 		return jsonify({"error": "You can only delete your own favorites."}), 403
-	db.session.delete(favorite)
+	db.session.execute(delete(Favorites).where(Favorites.id == favorite_id))
 	db.session.commit()
 	return jsonify({"message": "Book removed from favorites successfully."}), 200
 
@@ -57,19 +71,17 @@ def delete_favorite(favorite_id):
 @favorites_bp.route('/<int:book_description_id>', methods=['PUT'])
 @token_required
 def toggle_favorite(book_description_id):
-	user_id = int(request.user_id)
-	user = db.session.get(Users, user_id)
-	book = db.session.get(Book_descriptions, book_description_id)
-	if not user:
+	user_id = current_user_id()
+	user_exists, title, existed_favorite = favorite_state(user_id, book_description_id)
+	if not user_exists:
 		return jsonify({"error": "User not found."}), 404
-	if not book:
+	if title is None:
 		return jsonify({"error": "Book not found."}), 404
-	existed_favorite = db.session.query(Favorites).where((Favorites.user_id == user_id) & (Favorites.book_description_id == book_description_id)).first()
 	if existed_favorite:
-		db.session.delete(existed_favorite)
+		db.session.execute(delete(Favorites).where(Favorites.id == existed_favorite))
 		db.session.commit()
 		return jsonify({"message": "Book removed from favorites successfully."}), 200
 	favorite = Favorites(user_id=user_id, book_description_id=book_description_id)
 	db.session.add(favorite)
 	db.session.commit()
-	return jsonify({"message": f"{book.title} added to your favorites."}), 200
+	return jsonify({"message": f"{title} added to your favorites."}), 200
@@ -2,13 +2,14 @@ from app.models import Favorites
 from app.extensions import ma
 from app.blueprints.book_descriptions.schemas import BookDescriptionSchema
 from app.blueprints.users.schemas import UserSchema
+from app.utils.serializers import compiled
 
 class FavoriteSchema(ma.SQLAlchemyAutoSchema):
     class Meta:
         model = Favorites
 
-favorite_schema = FavoriteSchema()
-favorites_schema = FavoriteSchema(many=True)
+favorite_schema = compiled(FavoriteSchema())
+favorites_schema = compiled(FavoriteSchema(many=True))
 
 
 class UserFavoriteSchema(ma.SQLAlchemyAutoSchema):
@@ -16,11 +17,11 @@ class UserFavoriteSchema(ma.SQLAlchemyAutoSchema):
     class Meta:
         model = Favorites
 
-user_favorites_schema = UserFavoriteSchema(many=True)
+user_favorites_schema = compiled(UserFavoriteSchema(many=True))
 
 class BookFavoriteSchema(ma.SQLAlchemyAutoSchema):
     user = ma.Nested(UserSchema)
     class Meta:
         model = Favorites
 
-book_favorites_schema = BookFavoriteSchema(many=True)
\ No newline at end of file
+book_favorites_schema = compiled(BookFavoriteSchema(many=True))
\ No newline at end of file
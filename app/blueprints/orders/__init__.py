@@ -1,7 +1,7 @@
 from flask import Blueprint
 
 # Creating blueprint
-orders_bp = Blueprint('orders_bp', __name__)
+orders_bp = Blueprint('orders_bp', __name__, cli_group='orders')
 
 # It has to be here after creating blueprint
 from . import routes
\ No newline at end of file
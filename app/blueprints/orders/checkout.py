@@ -0,0 +1,121 @@
+from sqlalchemy import select, insert, update, delete, exists, func, literal
+from sqlalchemy.exc import SQLAlchemyError
+from app.models import db, Orders, Order_books, Carts, Cart_books, Addresses, Payments, Book_descriptions, Reservations, user_addresses
+from app.utils.auth import active_user
+from app.utils.cache import cache, stock_tag
+from app.utils.cart_store import cart_store
+from app.blueprints.carts.reservations import reserved_quantity
+from .pricing import cart_quantities, price_cart
+from .history import LINE_SNAPSHOT
+
+
+class CheckoutError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def check_ownership(user_id, cart_id, address_id, payment_id):
+    """Check the user, cart, address and payment exist and belong together, in one query."""
+    row = db.session.execute(select(
+        active_user(user_id),
+        select(Carts.user_id).where(Carts.id == cart_id).scalar_subquery(),
+        exists().where(Addresses.id == address_id),
+        exists().where(Payments.id == payment_id),
+        select(Payments.user_id).where(Payments.id == payment_id).scalar_subquery(),
+        exists().where(user_addresses.c.user_id == user_id, user_addresses.c.address_id == address_id),
+    )).one()
+    user_exists, cart_owner, address_exists, payment_exists, payment_owner, address_owned = row
+    if not user_exists:
+        raise CheckoutError("User not found.", 404)
+    if cart_owner is None:
+        raise CheckoutError("Cart not found.", 404)
+    if not address_exists:
+        raise CheckoutError("Address not found.", 404)
+    if not payment_exists:
+        raise CheckoutError("Payment Method not found.", 404)
+    if cart_owner != user_id:
+        raise CheckoutError("Cart does not belong to you.")
+    if payment_owner != user_id:
+        raise CheckoutError("Payment method does not belong to you.")
+    if not address_owned:
+        raise CheckoutError("Address does not belong to you.")
+
+
+def reserve_stock(cart_id, count):
+    """Take the cart quantities off the stock; raise if any book doesn't have enough left.
+
+    Copies the cart already holds through its reservations are off the stock already, only
+    the remainder (e.g. of a reservation that expired) is taken. One conditional UPDATE: a
+    book is only decremented when its stock covers the cart, so two checkouts racing for the
+    last copies can't both succeed.
+    """
+    quantity = (
+        select(func.sum(Cart_books.quantity))
+        .where(Cart_books.cart_id == cart_id, Cart_books.book_description_id == Book_descriptions.id)
+        .scalar_subquery()
+    ) - reserved_quantity(cart_id)
+    result = db.session.execute(
+        update(Book_descriptions)
+        .where(Book_descriptions.id.in_(select(Cart_books.book_description_id).where(Cart_books.cart_id == cart_id)))
+        .where(Book_descriptions.stock_quantity >= quantity)
+        .values(stock_quantity=Book_descriptions.stock_quantity - quantity)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount != count:
+        raise CheckoutError("Not enough stock for some of the books in your cart.", 409)
+
+
+def checkout(user_id, cart_id, address_id, payment_id, shipping_method):
+    """Turn a cart into an order in a single transaction and return the new order.
+
+    Ownership is checked with one query, the cart's reservations then its rows are locked in
+    book order (FOR UPDATE on databases that have it, the order reserve() and the sweeper
+    lock them in), priced with one aggregate, the stock is decremented with a
+    conditional UPDATE, the line items and a snapshot of their books are copied with
+    INSERT ... SELECT and the cart is cleared. Nothing is written unless everything succeeds.
+    """
+    if cart_store.enabled:
+        # The lines edited in the cart store since its last flush
+        cart_store.flush(user_id)
+    try:
+        check_ownership(user_id, cart_id, address_id, payment_id)
+        # Keeps the sweeper from returning the stock the order is about to take
+        db.session.execute(
+            select(Reservations.id).where(Reservations.cart_id == cart_id).order_by(Reservations.book_description_id).with_for_update()
+        ).all()
+        # A second checkout of the same cart waits here, then finds it empty
+        locked = db.session.scalars(
+            select(Cart_books.book_description_id)
+            .join(Book_descriptions, Book_descriptions.id == Cart_books.book_description_id)
+            .where(Cart_books.cart_id == cart_id)
+            .order_by(Cart_books.book_description_id)
+            .with_for_update()
+        ).all()
+        if not locked:
+            raise CheckoutError("Your cart is empty.")
+        count, totals = price_cart(cart_id, shipping_method, address_id)
+        reserve_stock(cart_id, count)
+        order = Orders(user_id=user_id, address_id=address_id, payment_id=payment_id, shipping_method=shipping_method, status="Pending", **totals)
+        db.session.add(order)
+        db.session.flush()
+        lines = cart_quantities(cart_id).subquery()
+        # The lines keep the book as sold, history reads never go back to book_descriptions
+        db.session.execute(insert(Order_books).from_select(
+            ["order_id", "book_description_id", "quantity", *LINE_SNAPSHOT],
+            select(literal(order.id), lines.c.book_description_id, lines.c.quantity, *LINE_SNAPSHOT.values())
+            .join(Book_descriptions, Book_descriptions.id == lines.c.book_description_id)
+        ))
+        db.session.execute(delete(Cart_books).where(Cart_books.cart_id == cart_id))
+        db.session.execute(delete(Reservations).where(Reservations.cart_id == cart_id))
+        db.session.execute(delete(Carts).where(Carts.id == cart_id))
+        db.session.commit()
+    except (CheckoutError, SQLAlchemyError):
+        db.session.rollback()
+        raise
+    if cart_store.enabled:
+        cart_store.evict(user_id)
+    # Stock is part of the book payloads
+    cache.invalidate(*map(stock_tag, locked))
+    return order
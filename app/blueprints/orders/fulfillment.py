@@ -0,0 +1,201 @@
+import threading
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import select, update, func
+from app.models import db, Orders, Order_books, Book_descriptions
+
+# Statuses an order can move to from each status, every status change goes through transition()
+ORDER_TRANSITIONS = {
+    "Pending" : ("Processing", "Cancelled"),
+    "Processing" : ("Shipped", "Cancelled"),
+    "Shipped" : ("Returned",),
+    "Cancelled" : (),
+    "Returned" : (),
+}
+# Column stamped when an order enters a status
+TRANSITION_TIMESTAMPS = {
+    "Processing" : Orders.processing_at,
+    "Shipped" : Orders.shipped_at,
+    "Cancelled" : Orders.cancelled_at,
+    "Returned" : Orders.returned_at,
+}
+# Statuses the workers take orders out of, and the column of when an order entered each one
+QUEUES = {"Pending" : Orders.created_at, "Processing" : Orders.processing_at}
+
+
+class TransitionError(Exception):
+    def __init__(self, message, status=409):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def allowed_from(status):
+    return [source for source, targets in ORDER_TRANSITIONS.items() if status in targets]
+
+
+def restock(order_ids):
+    """Put the copies of orders back on the shelf, with one correlated UPDATE; the caller commits."""
+    if not order_ids:
+        return
+    quantity = (
+        select(func.sum(Order_books.quantity))
+        .where(Order_books.order_id.in_(order_ids), Order_books.book_description_id == Book_descriptions.id)
+        .scalar_subquery()
+    )
+    db.session.execute(
+        update(Book_descriptions)
+        .where(Book_descriptions.id.in_(select(Order_books.book_description_id).where(Order_books.order_id.in_(order_ids))))
+        .values(stock_quantity=Book_descriptions.stock_quantity + quantity)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def transition(order_ids, status, now=None):
+    """Move orders to status and stamp when, in one UPDATE guarded by their current status.
+
+    Orders whose status doesn't allow the move, or was changed by someone else meanwhile,
+    are left alone. Cancelled orders give their copies back to the stock, the caller
+    invalidates the "books" cache once committed. Returns how many orders moved; the caller commits.
+    """
+    if not order_ids:
+        return 0
+    if status == "Cancelled":
+        # Locked first, so only the orders this UPDATE moves are restocked
+        order_ids = db.session.scalars(
+            select(Orders.id).where(Orders.id.in_(order_ids), Orders.status.in_(allowed_from(status))).with_for_update()
+        ).all()
+        restock(order_ids)
+        if not order_ids:
+            return 0
+    result = db.session.execute(
+        update(Orders)
+        .where(Orders.id.in_(order_ids), Orders.status.in_(allowed_from(status)))
+        .values({Orders.status : status, TRANSITION_TIMESTAMPS[status] : now or datetime.now()})
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount
+
+
+def transition_order(order, status, now=None):
+    """Move one loaded order to status, raising TransitionError if its status doesn't allow it."""
+    if status not in ORDER_TRANSITIONS[order.status]:
+        raise TransitionError(f"A {order.status.lower()} order can not be {status.lower()}.")
+    if not transition([order.id], status, now):
+        raise TransitionError("The order status changed meanwhile, try again.")
+    db.session.expire(order)
+
+
+def pipeline():
+    # (status claimed, status reached, seconds an order spends in the first one before moving on)
+    return [
+        ("Pending", "Processing", 0),
+        ("Processing", "Shipped", current_app.config["FULFILLMENT_PROCESSING_TIME"]),
+    ]
+
+
+def advance_batch(source, target, batch_size, wait=0, now=None):
+    """Claim up to batch_size orders that spent wait seconds in source and move them to target.
+
+    The batch is locked with FOR UPDATE SKIP LOCKED where the database has it, so workers
+    claim disjoint batches and a customer cancelling an order is never blocked. Commits;
+    returns the seconds each moved order spent in source.
+    """
+    now = now or datetime.now()
+    # Orders made Processing before the timestamps existed count from their creation
+    entered = func.coalesce(QUEUES[source], Orders.created_at)
+    # Oldest first on the (status, created_at, id) index
+    batch = db.session.execute(
+        select(Orders.id, entered)
+        .where(Orders.status == source, entered <= now - timedelta(seconds=wait))
+        .order_by(Orders.created_at, Orders.id)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    ).all()
+    moved = transition([order_id for order_id, _ in batch], target, now)
+    db.session.commit()
+    if moved < len(batch):
+        # Another worker without SKIP LOCKED got some of them first, which ones doesn't matter for the waits
+        batch = batch[:moved]
+    return [(now - since).total_seconds() for _, since in batch]
+
+
+class FulfillmentStats:
+    """Orders moved and how long they waited, per pipeline step, shared by the threads of a pool."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.steps = {}
+
+    def record(self, source, target, waits):
+        if not waits:
+            return
+        with self.lock:
+            step = self.steps.setdefault(f"{source} -> {target}", {"orders" : 0, "total_wait" : 0.0, "max_wait" : 0.0})
+            step["orders"] += len(waits)
+            step["total_wait"] += sum(waits)
+            step["max_wait"] = max(step["max_wait"], max(waits))
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                name : {"orders" : step["orders"], "average_wait_seconds" : round(step["total_wait"] / step["orders"], 3), "max_wait_seconds" : round(step["max_wait"], 3)}
+                for name, step in self.steps.items()
+            }
+
+
+def fulfill(batch_size=None, stats=None, now=None):
+    """Run one batch through each step of the pipeline; return how many orders moved."""
+    batch_size = batch_size or current_app.config["FULFILLMENT_BATCH"]
+    moved = 0
+    for source, target, wait in pipeline():
+        waits = advance_batch(source, target, batch_size, wait, now)
+        if stats is not None:
+            stats.record(source, target, waits)
+        moved += len(waits)
+    return moved
+
+
+def work(app, batch_size, interval, stats, stop):
+    # One worker of the pool: drain the queues, then poll every interval seconds until stopped
+    with app.app_context():
+        while not stop.is_set():
+            try:
+                moved = fulfill(batch_size, stats)
+            except Exception:
+                db.session.rollback()
+                app.logger.exception("Fulfilling orders failed, retrying in %s seconds.", interval)
+                moved = 0
+            finally:
+                db.session.remove()
+            if not moved:
+                stop.wait(interval)
+
+
+def start_workers(app, workers=None, batch_size=None, interval=None, stats=None, stop=None):
+    """Start a pool of fulfillment threads; set stop to end them. Returns the threads."""
+    workers = workers or app.config["FULFILLMENT_WORKERS"]
+    batch_size = batch_size or app.config["FULFILLMENT_BATCH"]
+    interval = interval or app.config["FULFILLMENT_INTERVAL"]
+    threads = [
+        threading.Thread(target=work, args=(app, batch_size, interval, stats, stop), name=f"fulfillment-{number}", daemon=True)
+        for number in range(workers)
+    ]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def queue_metrics(now=None):
+    """Depth and age of the oldest order of each fulfillment queue, in one query."""
+    now = now or datetime.now()
+    rows = db.session.execute(
+        select(Orders.status, func.count(), func.min(Orders.created_at), func.min(func.coalesce(Orders.processing_at, Orders.created_at)))
+        .where(Orders.status.in_(QUEUES))
+        .group_by(Orders.status)
+    ).all()
+    metrics = {status : {"depth" : 0, "oldest_age_seconds" : None} for status in QUEUES}
+    for status, depth, oldest_created, oldest_processing in rows:
+        oldest = oldest_created if status == "Pending" else oldest_processing
+        metrics[status] = {"depth" : depth, "oldest_age_seconds" : round((now - oldest).total_seconds(), 3)}
+    return metrics
@@ -0,0 +1,126 @@
+from datetime import datetime
+from sqlalchemy import select, update, func, case
+from app.models import db, Orders, Order_books, Book_descriptions
+
+ORDER_STATUSES = ("Pending", "Processing", "Shipped", "Cancelled", "Returned")
+SHIPPING_METHODS = ("InStore", "Out-for-Delivery", "Delivered", "Delayed", "Returned")
+# Orders whose money was given back don't count in the spend
+REFUNDED_STATUSES = ("Cancelled", "Returned")
+# Book columns copied onto an order line at checkout, order_books column -> book_descriptions column
+LINE_SNAPSHOT = {
+    "unit_price" : Book_descriptions.price,
+    "title" : Book_descriptions.title,
+    "author" : Book_descriptions.author,
+    "isbn" : Book_descriptions.isbn,
+    "image_link" : Book_descriptions.image_link,
+}
+# Book fields of an order line payload, book field -> order_books column
+LINE_BOOK_FIELDS = {"id" : "book_description_id", "title" : "title", "author" : "author", "isbn" : "isbn", "image_link" : "image_link", "price" : "unit_price"}
+
+
+def datetime_arg(args, name):
+    """An ISO 8601 date or datetime query parameter, None when absent; raises ValueError when malformed."""
+    value = args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"{name} must be an ISO 8601 date or datetime.")
+
+
+def choices_arg(args, name, choices):
+    # Comma separated values of a query parameter, each one of choices
+    values = args[name].split(",")
+    if any(value not in choices for value in values):
+        raise ValueError(f"{name} must be among: {', '.join(choices)}.")
+    return values
+
+
+def order_filters(args):
+    """Turn the order filter parameters into WHERE clauses on Orders.
+
+    ``status`` and ``shipping_method`` are comma separated lists, ``since`` and ``until``
+    bound created_at (since inclusive, until exclusive).
+    """
+    filters = []
+    if args.get("status"):
+        filters.append(Orders.status.in_(choices_arg(args, "status", ORDER_STATUSES)))
+    if args.get("shipping_method"):
+        filters.append(Orders.shipping_method.in_(choices_arg(args, "shipping_method", SHIPPING_METHODS)))
+    since = datetime_arg(args, "since")
+    if since:
+        filters.append(Orders.created_at >= since)
+    until = datetime_arg(args, "until")
+    if until:
+        filters.append(Orders.created_at < until)
+    return filters
+
+
+def order_summary(user_id):
+    """Order count, lifetime spend and items purchased of a user, summed by one aggregate query."""
+    # Items per order are summed first, joining order_books directly would repeat each total
+    items = (
+        select(Order_books.order_id, func.sum(Order_books.quantity).label("quantity"))
+        .join(Orders, Orders.id == Order_books.order_id)
+        .where(Orders.user_id == user_id)
+        .group_by(Order_books.order_id)
+        .subquery()
+    )
+    kept = Orders.status.not_in(REFUNDED_STATUSES)
+    order_count, lifetime_spend, items_purchased = db.session.execute(
+        select(
+            func.count(Orders.id),
+            func.coalesce(func.sum(case((kept, Orders.total), else_=0)), 0),
+            func.coalesce(func.sum(case((kept, items.c.quantity), else_=0)), 0),
+        )
+        .select_from(Orders)
+        .outerjoin(items, items.c.order_id == Orders.id)
+        .where(Orders.user_id == user_id)
+    ).one()
+    return {
+        "order_count" : order_count,
+        "lifetime_spend" : round(lifetime_spend, 2),
+        "items_purchased" : items_purchased
+    }
+
+
+def order_lines(order, fields=None):
+    """The order_books payload of an order, the books read from the line snapshots.
+
+    ``fields`` (from book_fields) picks among the snapshot fields, the other book fields
+    aren't kept by an order.
+    """
+    names = [name for name in LINE_BOOK_FIELDS if fields is None or name in fields]
+    return [
+        {"book" : {name : getattr(line, LINE_BOOK_FIELDS[name]) for name in names}, "quantity" : line.quantity}
+        for line in order.order_books
+    ]
+
+
+def backfill_snapshots(chunk_size=1000):
+    """Copy the current book columns onto order lines checked out before the snapshots, chunk_size lines per transaction.
+
+    The price copied is the book's current one, the price these lines sold at wasn't recorded.
+    Returns the number of lines filled in.
+    """
+    filled = 0
+    last_id = 0
+    while True:
+        ids = db.session.scalars(
+            select(Order_books.id).where(Order_books.title.is_(None), Order_books.id > last_id).order_by(Order_books.id).limit(chunk_size)
+        ).all()
+        if not ids:
+            return filled
+        db.session.execute(
+            update(Order_books)
+            .where(Order_books.id.in_(ids))
+            .values({
+                column : select(book_column).where(Book_descriptions.id == Order_books.book_description_id).scalar_subquery()
+                for column, book_column in LINE_SNAPSHOT.items()
+            })
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        filled += len(ids)
+        last_id = ids[-1]
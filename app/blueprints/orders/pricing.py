@@ -0,0 +1,81 @@
+from decimal import Decimal, ROUND_HALF_UP
+from sqlalchemy import select, func
+from app.models import db, Cart_books, Book_descriptions, Addresses
+from app.utils.rates import rates
+
+
+def cart_quantities(cart_id):
+    # Quantity of each book in the cart, a book added twice counts once with both quantities
+    return (
+        select(Cart_books.book_description_id, func.sum(Cart_books.quantity).label("quantity"))
+        .where(Cart_books.cart_id == cart_id)
+        .group_by(Cart_books.book_description_id)
+    )
+
+
+def address_columns(address_id):
+    # State and country of the shipping address, as scalar subqueries riding along the cart query
+    return (
+        select(Addresses.state).where(Addresses.id == address_id).scalar_subquery().label("state"),
+        select(Addresses.country).where(Addresses.id == address_id).scalar_subquery().label("country"),
+    )
+
+
+def money(amount):
+    # Cents rounded half up like a till, round() would turn 2.175 into 2.17 through its float error
+    return float(Decimal(str(amount)).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP))
+
+
+def totals(subtotal, shipping_method, state=None, country=None):
+    """Tax, shipping cost and total of a subtotal, with the rates of the address and shipping method."""
+    subtotal = money(subtotal)
+    tax = money(subtotal * rates.tax_rate(country, state))
+    shipping_cost = rates.shipping_cost(shipping_method)
+    return {
+        "subtotal" : subtotal,
+        "tax" : tax,
+        "shipping_cost" : shipping_cost,
+        "total" : money(subtotal + tax + shipping_cost)
+    }
+
+
+def price_cart(cart_id, shipping_method, address_id=None):
+    """Number of books and subtotal, tax, shipping cost and total of a cart, in one aggregate query.
+
+    The subtotal is summed by the database and the address read in the same statement, only
+    the rates are applied in Python, once per cart.
+    """
+    lines = cart_quantities(cart_id).subquery()
+    count, subtotal, state, country = db.session.execute(
+        select(func.count(), func.coalesce(func.sum(lines.c.quantity * Book_descriptions.price), 0), *address_columns(address_id))
+        .select_from(lines)
+        .join(Book_descriptions, Book_descriptions.id == lines.c.book_description_id)
+    ).one()
+    return count, totals(subtotal, shipping_method, state, country)
+
+
+def quote_cart(cart_id, shipping_method, address_id=None):
+    """The priced lines of a cart and its totals, in one query.
+
+    Each row carries its line total, and the subtotal as a window sum over every line, so the
+    lines and the totals come from the same snapshot. Returns ([line], totals); no lines for
+    an empty cart.
+    """
+    lines = cart_quantities(cart_id).subquery()
+    line_total = lines.c.quantity * Book_descriptions.price
+    rows = db.session.execute(
+        select(
+            lines.c.book_description_id, lines.c.quantity, Book_descriptions.price,
+            line_total.label("line_total"), func.sum(line_total).over().label("subtotal"), *address_columns(address_id)
+        )
+        .select_from(lines)
+        .join(Book_descriptions, Book_descriptions.id == lines.c.book_description_id)
+        .order_by(lines.c.book_description_id)
+    ).all()
+    if not rows:
+        return [], totals(0, shipping_method)
+    priced = [
+        {"book_description_id" : row.book_description_id, "quantity" : row.quantity, "price" : row.price, "line_total" : money(row.line_total)}
+        for row in rows
+    ]
+    return priced, totals(rows[0].subtotal, shipping_method, rows[0].state, rows[0].country)
@@ -1,111 +1,216 @@
 from app.blueprints.orders import orders_bp
 from .schemas import order_schema
-from app.utils.auth import token_required
-from flask import request, jsonify
+from app.utils.auth import token_required, current_user, current_user_id
+from flask import request, jsonify, current_app
 from marshmallow import ValidationError
-from app.models import db, Users, Orders,Order_books, Carts, Cart_books, Addresses, Payments
-from app.blueprints.book_descriptions.schemas import book_description_schema
+from app.models import db, Orders, Order_books
+from sqlalchemy import select
+from sqlalchemy.exc import OperationalError, IntegrityError
+from app.blueprints.book_descriptions.schemas import book_fields
+from app.utils.loading import load_plan
+from app.utils.query_budget import query_budget
+from app.utils.serializers import json_response
+from app.utils.cache import cache
+from app.utils.idempotency import idempotency
+from app.utils.pagination import keyset_paginate, CursorError
+from app.utils.streaming import ndjson_response, EXPORT_BATCH_SIZE
+from .checkout import checkout, CheckoutError
+from .history import order_filters, order_lines, backfill_snapshots
+from .fulfillment import transition_order, restock, TransitionError, fulfill, start_workers, queue_metrics, FulfillmentStats
+from itertools import groupby
+import threading
+import click
+import time
+
+# Relationships serialized by the order payloads, the lines carry their books' snapshot
+ORDER_GRAPH = [(Orders.order_books,)]
 
 # After checkout cart the order will be created 
 @orders_bp.route('/<int:cart_id>/address/<int:address_id>/payment/<int:payment_id>',methods={'POST'})
 @token_required
+@idempotency.idempotent
+# Under @idempotent so the key store's own queries aren't counted in the view's budget.
+# 12 without the cart store, 3 more when it writes the cart before the checkout.
+@query_budget(15)
 def create_order(cart_id,address_id,payment_id):
-    user_id = request.user_id
-    user = db.session.get(Users, user_id)
-    cart = db.session.get(Carts, cart_id)
-    address = db.session.get(Addresses, address_id)
-    payment = db.session.get(Payments, payment_id)
-    if not user:
-        return jsonify({"error" : f"User not found."}), 404
-    if not cart:
-        return jsonify({"error" : f"Cart not found."}), 404
-    if not address:
-        return jsonify({"error" : f"Address not found."}), 404
-    if not payment:
-        return jsonify({"error" : f"Payment Method not found."}), 404
-    # check if cart belongs to user
-    if cart.user_id != int(user_id):
-        return jsonify({"error" : f"Cart does not belong to you."}), 400
-    # check if payments belongs to user
-    if payment.user_id != int(user_id):
-        return jsonify({"error" : f"Payment method does not belong to you."}), 400
-    if user not in address.users:
-        return jsonify({"error" : f"Address does not belong to you."}), 400
+    try:
+        fields = book_fields(request.args)
+    except ValueError as e:
+        return jsonify({"error" : str(e)}), 400
     try:
         data = order_schema.load(request.json)
-        print("datttttaaaaaaaaaaaaa",data)
     except ValidationError as e:
         return jsonify({"error_message" : e.messages}), 400
-    data["user_id"] = user_id
-    data["payment_id"] = payment_id
-    data["address_id"] = address_id
-    new_order = Orders(**data)
-    db.session.add(new_order)
-    db.session.commit()
-    # Add books to order
-    for book in cart.cart_books:
-        order_book_data = {
-            "order_id" : new_order.id,
-            "book_description_id" : book.book_description_id,
-            "quantity" : book.quantity
-        }
-        new_order_book = Order_books(**order_book_data)
-        db.session.add(new_order_book)
-        new_order.order_books.append(new_order_book)
-    db.session.commit()
+    # Totals and status are worked out by the checkout, only the shipping method is taken from the client
+    try:
+        new_order = checkout(current_user_id(), cart_id, address_id, payment_id, data.get("shipping_method", "InStore"))
+    except CheckoutError as e:
+        return jsonify({"error" : e.message}), e.status
+    except OperationalError:
+        # A lock wait timed out or the database went away, the checkout was rolled back
+        return jsonify({"error" : "The store is busy, try your checkout again."}), 503
+    except IntegrityError:
+        return jsonify({"error" : "Your cart changed during checkout, try again."}), 409
     response = {
         "order_info": order_schema.dump(new_order),
-        "order_books" : [
-            {
-                "book": book_description_schema.dump(book.book_description),
-                "quantity": book.quantity
-            }
-            for book in new_order.order_books
-        ]
+        "order_books" : order_lines(new_order, fields)
+    }
+    return json_response(response, 201)
+
+@orders_bp.route('/<int:order_id>',methods={'GET'})
+@query_budget(2)
+@token_required
+def get_order(order_id):
+    try:
+        fields = book_fields(request.args)
+    except ValueError as e:
+        return jsonify({"error" : str(e)}), 400
+    # The receipt, read from orders and order_books alone
+    order = db.session.get(Orders, order_id, options=load_plan(*ORDER_GRAPH))
+    if not order:
+        return jsonify({"error" : f"Order not found."}), 404
+    if order.user_id != current_user_id():
+        return jsonify({"error" : f"This order does not belong to you."}), 400
+    response = {
+        "order_info": order_schema.dump(order),
+        "order_books" : order_lines(order, fields)
     }
-    # clear cart and delete cart
-    db.session.query(Cart_books).where(Cart_books.cart_id==cart.id).delete()
-    db.session.query(Carts).where(Carts.id == cart.id).delete()
-    db.session.commit()
-    return jsonify(response), 201
+    return json_response(response)
 
 @orders_bp.route('/<int:order_id>',methods={'DELETE'})
 @token_required
 def delete_order(order_id):
-    user_id = request.user_id
-    user = db.session.get(Users, user_id)
     order = db.session.get(Orders, order_id)
-    if not user:
-        return jsonify({"error" : f"User not found."}), 404
-    if not order:
-        return jsonify({"error" : f"Order not found."}), 404
-    if order.user_id != int(user_id):
+    # The user of one of their own orders exists, only look them up when it isn't one
+    if not order or order.user_id != current_user_id():
+        if not current_user():
+            return jsonify({"error" : f"User not found."}), 404
+        if not order:
+            return jsonify({"error" : f"Order not found."}), 404
         return jsonify({"error" : f"You can not cancel this order, because its not belongs to you."}), 400
-    # clear order books and delete order
-    if(order.status == "Pending"):   
+    # clear order books and delete order, unless a fulfillment worker claimed it meanwhile
+    if(order.status == "Pending"):
+        # Its copies go back on the shelf in the same transaction
+        restock([order.id])
         db.session.query(Order_books).where(Order_books.order_id==order.id).delete()
-        db.session.query(Orders).where(Orders.id == order.id).delete()
+        if db.session.query(Orders).where(Orders.id == order.id, Orders.status == "Pending").delete():
+            db.session.commit()
+            # Stock is part of the book payloads
+            cache.invalidate("books")
+            return ({"message" : "Successfully, Your order deleted"}), 200
+        db.session.rollback()
+        db.session.refresh(order)
+    if(order.status == "Processing"):
+        try:
+            transition_order(order, "Cancelled")
+        except TransitionError:
+            db.session.rollback()
+            return jsonify({"error" : f"You can not cancel this order, because its already been shipped."}), 400
         db.session.commit()
-        return ({"message" : "Successfully, Your order deleted"}), 200
-    elif(order.status == "Processing"):
-        order.status = "Cancelled"
+        cache.invalidate("books")
         return({"message" : "Your order status changed"})
     return jsonify({"error" : f"You can not cancel this order, because its already been shipped."}), 400
 
+def admin_order_filters(args):
+    filters = order_filters(args)
+    if args.get("user_id"):
+        try:
+            filters.append(Orders.user_id == int(args["user_id"]))
+        except ValueError:
+            raise ValueError("user_id must be an integer.")
+    return filters
+
 @orders_bp.route('',methods={'GET'})
+@query_budget(2)
+@token_required
 def get_all_orders():
-    orders = db.session.query(Orders).all()
-    response = [
-        {
-            "order_info": order_schema.dump(order),
-            "order_books": [
-                {
-                    "book": book_description_schema.dump(book.book_description),
-                    "quantity": book.quantity
-                }
-                for book in order.order_books
-            ]
-        }
-        for order in orders
-    ]
-    return jsonify(response), 200
\ No newline at end of file
+    try:
+        fields = book_fields(request.args)
+        filters = admin_order_filters(request.args)
+    except ValueError as e:
+        return jsonify({"error" : str(e)}), 400
+    # Newest first; each filter has a (column, created_at, id) index so a page costs the same
+    # however many orders there are
+    try:
+        orders, next_cursor = keyset_paginate(
+            db.session.query(Orders).options(*load_plan(*ORDER_GRAPH)).where(*filters),
+            [Orders.created_at, Orders.id],
+            after=request.args.get("after"),
+            limit=request.args.get("limit", type=int),
+            descending=True,
+        )
+    except CursorError as e:
+        return jsonify({"error" : str(e)}), 400
+    response = {
+        "data" : [
+            {
+                "order_info": order_schema.dump(order),
+                "order_books": order_lines(order, fields)
+            }
+            for order in orders
+        ],
+        "next_cursor" : next_cursor
+    }
+    return json_response(response)
+
+@orders_bp.route('/export', methods={'GET'})
+@token_required
+def export_orders():
+    try:
+        filters = admin_order_filters(request.args)
+    except ValueError as e:
+        return jsonify({"error" : str(e)}), 400
+    # One pass over the orders joined to their lines, grouped back per order while streaming
+    query = (
+        select(Orders, Order_books.book_description_id, Order_books.title, Order_books.unit_price, Order_books.quantity)
+        .outerjoin(Order_books, Order_books.order_id == Orders.id)
+        .where(*filters)
+        .order_by(Orders.created_at, Orders.id, Order_books.id)
+    )
+    def records():
+        # Runs inside the streamed response, the session of the view is gone by then
+        rows = db.session.execute(query.execution_options(yield_per=EXPORT_BATCH_SIZE))
+        for order, lines in groupby(rows, key=lambda row: row.Orders):
+            yield {
+                **order_schema.dump(order),
+                "order_books" : [
+                    {"book_description_id" : line.book_description_id, "title" : line.title, "unit_price" : line.unit_price, "quantity" : line.quantity}
+                    for line in lines if line.book_description_id is not None
+                ]
+            }
+    return ndjson_response(records())
+
+@orders_bp.route('/fulfillment', methods={'GET'})
+@query_budget(1)
+@token_required
+def get_fulfillment_metrics():
+    return jsonify({"queues" : queue_metrics()}), 200
+
+@orders_bp.cli.command('fulfill')
+@click.option('--workers', type=int, help='Worker threads (default FULFILLMENT_WORKERS).')
+@click.option('--batch-size', type=int, help='Orders claimed per transaction (default FULFILLMENT_BATCH).')
+@click.option('--interval', type=float, help='Keep fulfilling, reporting every INTERVAL seconds, instead of draining the queues once.')
+def fulfill_command(workers, batch_size, interval):
+    """Move Pending orders to Processing and, after FULFILLMENT_PROCESSING_TIME, to Shipped."""
+    stats = FulfillmentStats()
+    if not interval:
+        while fulfill(batch_size, stats):
+            pass
+        click.echo(f"{stats.snapshot()}")
+        return
+    stop = threading.Event()
+    threads = start_workers(current_app._get_current_object(), workers, batch_size, interval, stats, stop)
+    try:
+        while True:
+            time.sleep(interval)
+            click.echo(f"queues {queue_metrics()}, moved {stats.snapshot()}")
+    except KeyboardInterrupt:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+@orders_bp.cli.command('backfill-snapshots')
+@click.option('--chunk-size', type=int, default=1000, show_default=True, help='Order lines per transaction.')
+def backfill_snapshots_command(chunk_size):
+    """Fill in the book snapshot of order lines checked out before it was recorded."""
+    click.echo(f"{backfill_snapshots(chunk_size)} order lines filled in.")
@@ -1,8 +1,9 @@
 from app.extensions import ma
-from app.models import Orders, Order_books
+from app.models import Orders
+from app.utils.serializers import compiled
 
 class OrderSchema(ma.SQLAlchemyAutoSchema):
     class Meta:
         model = Orders
 
-order_schema = OrderSchema()
+order_schema = compiled(OrderSchema())
@@ -1,8 +1,9 @@
 from app.blueprints.payments import payments_bp
-from app.utils.auth import token_required
+from app.utils.auth import token_required, current_user, current_user_id, ownership
 from flask import request, jsonify
 from marshmallow import ValidationError
-from app.models import db, Users, Payments
+from sqlalchemy import select, update, delete, exists
+from app.models import db, Payments, Orders
 from .schemas import payment_schema, payments_schema
 from app.blueprints.users.schemas import users_schema
 
@@ -11,9 +12,8 @@ import traceback
 @payments_bp.route('', methods={'POST'})
 @token_required
 def create_payment():
-    user_id = request.user_id
-    user = db.session.get(Users, user_id)
-    if not user:
+    user_id = current_user_id()
+    if not current_user():
         return jsonify({"error" : f"User not found."}), 404
     try:
         payment_data = payment_schema.load(request.json)
@@ -32,8 +32,7 @@ def create_payment():
 @payments_bp.route('', methods={'GET'})
 @token_required
 def get_payments():
-    user_id = request.user_id
-    user = db.session.get(Users, user_id)
+    user = current_user()
     if not user:
         return jsonify({"error" : f"User not found."}), 404
     return payments_schema.jsonify(user.payments), 200
@@ -46,14 +45,13 @@ def get_all_payments():
 @payments_bp.route('<int:payment_id>', methods={'PUT'})
 @token_required
 def update_payment(payment_id):
-    user_id = request.user_id
-    user = db.session.get(Users, user_id)
-    payment = db.session.get(Payments, payment_id)
-    if not payment:
+    user_id = current_user_id()
+    user_exists, found, owned = ownership(Payments, payment_id)
+    if not found:
         return jsonify({"error" : f"Payment not found."}), 404
-    if not user:
+    if not user_exists:
         return jsonify({"error" : f"User not found."}), 404
-    if payment not in user.payments:
+    if not owned:
         return jsonify({"error" : f"You can not update this payment method."}), 404
     try:
         payment_data = payment_schema.load(request.json)
@@ -64,27 +62,24 @@ def update_payment(payment_id):
     if existed_payment:
         return jsonify({"error" : f"{payment_data["card_number"]} is duplicated."}), 400
     payment_data["user_id"] = user_id
-    for key, value in payment_data.items():
-        setattr(payment, key, value)
+    db.session.execute(update(Payments).where(Payments.id == payment_id).values(**payment_data))
     db.session.commit()
     return jsonify({"message" : "Your card data successfully updated"}), 200
 
 @payments_bp.route('<int:payment_id>', methods={'DELETE'})
 @token_required
 def delete_payment(payment_id):
-    user_id = request.user_id
-    user = db.session.get(Users, user_id)
-    payment = db.session.get(Payments, payment_id)
-    if not payment:
+    user_exists, found, owned = ownership(Payments, payment_id)
+    if not found:
         return jsonify({"error" : f"Payment not found."}), 404
-    if not user:
+    if not user_exists:
         return jsonify({"error" : f"User not found."}), 404
-    if payment in user.payments:
-        print("payment in user.payments")
-        user.payments.remove(payment)
-        if len(payment.orders) == 0:
-            print("len(payment.orders) == 0")
-            db.session.delete(payment)
+    if owned:
+        # Orders paid with it keep it, detached from the user
+        if db.session.scalar(select(exists().where(Orders.payment_id == payment_id))):
+            db.session.execute(update(Payments).where(Payments.id == payment_id).values(user_id=None))
+        else:
+            db.session.execute(delete(Payments).where(Payments.id == payment_id))
         db.session.commit()
         return jsonify({"message" : "Your card information successfully deleted from payments methods"}), 200
     else:
@@ -1,7 +1,7 @@
 from flask import Blueprint
 
 # Creating blueprint
-users_bp = Blueprint('users_bp', __name__)
+users_bp = Blueprint('users_bp', __name__, cli_group='users')
 
 # It has to be here after creating blueprint
 from . import routes
\ No newline at end of file
@@ -0,0 +1,41 @@
+from app.models import Users
+from app.blueprints.orders.history import datetime_arg
+
+# Columns of the user directory, the password hash is never selected
+DIRECTORY_COLUMNS = [Users.id, Users.first_name, Users.last_name, Users.email, Users.phone, Users.created_at]
+
+
+def prefix_range(column, prefix):
+    # column >= "ab" AND column < "ac" rather than LIKE "ab%", a plain range any btree index serves
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return [column >= prefix, column < upper]
+
+
+def email_prefix(args):
+    return (args.get("email") or "").strip()
+
+
+def directory_filters(args):
+    """Turn the directory filter parameters into WHERE clauses on Users.
+
+    ``email`` is a prefix of the address, ``since`` and ``until`` bound created_at (since
+    inclusive, until exclusive). Accounts waiting for their purge are left out.
+    """
+    filters = [Users.deleted_at.is_(None)]
+    if email_prefix(args):
+        filters.extend(prefix_range(Users.email, email_prefix(args)))
+    since = datetime_arg(args, "since")
+    if since:
+        filters.append(Users.created_at >= since)
+    until = datetime_arg(args, "until")
+    if until:
+        filters.append(Users.created_at < until)
+    return filters
+
+
+def directory_order(args):
+    # An email prefix walks the email index, anything else the newest accounts first
+    if email_prefix(args):
+        return [Users.email, Users.id], False
+    return [Users.created_at, Users.id], True
+
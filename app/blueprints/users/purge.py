@@ -0,0 +1,200 @@
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import select, update, delete, exists, func, union_all, or_, and_
+from app.models import (db, Users, Addresses, user_addresses, Payments, Orders, Order_books, Carts, Cart_books,
+                        Reviews, Favorites, Idempotency_keys, Account_purges)
+from app.blueprints.carts.reservations import release_cart
+from app.blueprints.orders.fulfillment import restock, allowed_from
+from app.utils.cache import cache
+
+
+def delete_rows(model, where, limit):
+    if limit is None:
+        return db.session.execute(delete(model).where(*where).execution_options(synchronize_session=False)).rowcount
+    # The chunk's ids are read first, MySQL can't DELETE from a table it selects from with a LIMIT
+    ids = db.session.scalars(select(model.id).where(*where).limit(limit)).all()
+    if not ids:
+        return 0
+    return db.session.execute(delete(model).where(model.id.in_(ids)).execution_options(synchronize_session=False)).rowcount
+
+
+def purge_cart(user_id, limit):
+    # A cart is a few lines, always removed whole; its reserved copies go back on the shelf
+    cart_id = db.session.scalar(select(Carts.id).where(Carts.user_id == user_id))
+    if cart_id is None:
+        return 0
+    release_cart(cart_id)
+    deleted = db.session.execute(delete(Cart_books).where(Cart_books.cart_id == cart_id)).rowcount
+    db.session.execute(delete(Carts).where(Carts.id == cart_id))
+    return deleted + 1
+
+
+def restock_orders(where):
+    # Orders not shipped yet still hold their copies, locked so fulfillment can't ship them meanwhile
+    held = select(Orders.id).where(where, Orders.status.in_(allowed_from("Cancelled"))).with_for_update()
+    restock(db.session.scalars(held).all())
+
+
+def purge_orders(user_id, limit):
+    orders = select(Orders.id).where(Orders.user_id == user_id)
+    if limit is None:
+        restock_orders(Orders.user_id == user_id)
+        deleted = db.session.execute(delete(Order_books).where(Order_books.order_id.in_(orders.scalar_subquery())).execution_options(synchronize_session=False)).rowcount
+        return deleted + db.session.execute(delete(Orders).where(Orders.user_id == user_id).execution_options(synchronize_session=False)).rowcount
+    # Whole orders per chunk, so an order never loses only part of its lines
+    orders = db.session.scalars(orders.limit(max(1, limit // 10))).all()
+    if not orders:
+        return 0
+    restock_orders(Orders.id.in_(orders))
+    deleted = db.session.execute(delete(Order_books).where(Order_books.order_id.in_(orders)).execution_options(synchronize_session=False)).rowcount
+    return deleted + db.session.execute(delete(Orders).where(Orders.id.in_(orders)).execution_options(synchronize_session=False)).rowcount
+
+
+def purge_reviews(user_id, limit):
+    return delete_rows(Reviews, [Reviews.user_id == user_id], limit)
+
+
+def purge_favorites(user_id, limit):
+    return delete_rows(Favorites, [Favorites.user_id == user_id], limit)
+
+
+def purge_idempotency_keys(user_id, limit):
+    return delete_rows(Idempotency_keys, [Idempotency_keys.user_id == user_id], limit)
+
+
+def purge_payments(user_id, limit):
+    # A card still on someone else's order is only detached, the order keeps pointing at it
+    used = exists().where(Orders.payment_id == Payments.id)
+    detached = db.session.execute(
+        update(Payments).where(Payments.user_id == user_id, used).values(user_id=None).execution_options(synchronize_session=False)
+    ).rowcount
+    return detached + delete_rows(Payments, [Payments.user_id == user_id, ~used], limit)
+
+
+def purge_addresses(user_id, limit):
+    # Addresses nobody else uses and no order ships to are deleted, the others only unlinked
+    others = user_addresses.alias()
+    shared = exists().where(others.c.address_id == Addresses.id, others.c.user_id != user_id)
+    ordered = exists().where(Orders.address_id == Addresses.id)
+    orphans = db.session.scalars(
+        select(Addresses.id)
+        .join(user_addresses, user_addresses.c.address_id == Addresses.id)
+        .where(user_addresses.c.user_id == user_id, ~shared, ~ordered)
+    ).all()
+    unlinked = db.session.execute(delete(user_addresses).where(user_addresses.c.user_id == user_id)).rowcount
+    if orphans:
+        db.session.execute(delete(Addresses).where(Addresses.id.in_(orphans)).execution_options(synchronize_session=False))
+    return unlinked + len(orphans)
+
+
+def purge_user(user_id, limit):
+    return db.session.execute(delete(Users).where(Users.id == user_id).execution_options(synchronize_session=False)).rowcount
+
+
+# Children before the rows they reference, the user last
+PURGE_STEPS = [
+    ("cart", purge_cart),
+    ("orders", purge_orders),
+    ("reviews", purge_reviews),
+    ("favorites", purge_favorites),
+    ("idempotency_keys", purge_idempotency_keys),
+    ("payments", purge_payments),
+    ("addresses", purge_addresses),
+    ("user", purge_user),
+]
+
+# Steps that put copies back on the shelf, the "books" cache is invalidated once they commit
+RESTOCKING_STEPS = {"cart", "orders"}
+
+
+def account_size(user_id, limit):
+    """Rows an account's history spans, counted up to limit + 1 so a huge account costs no more than a small one."""
+    rows = union_all(
+        select(Order_books.id).join(Orders, Orders.id == Order_books.order_id).where(Orders.user_id == user_id),
+        select(Orders.id).where(Orders.user_id == user_id),
+        select(Reviews.id).where(Reviews.user_id == user_id),
+        select(Favorites.id).where(Favorites.user_id == user_id),
+    ).limit(limit + 1).subquery()
+    return db.session.scalar(select(func.count()).select_from(rows))
+
+
+def delete_account(user_id):
+    """Delete an account and everything of it with one set-based statement per table.
+
+    Copies held by the cart and by orders not shipped yet go back to the stock. Runs in the
+    caller's transaction, so a failure leaves the account whole; the caller commits and then
+    invalidates the "books" and "reviews" caches. Returns the rows deleted.
+    """
+    return sum(step(user_id, None) for _, step in PURGE_STEPS)
+
+
+def schedule_purge(user, now=None):
+    """Lock the account and queue its deletion for the purge job; the caller commits."""
+    user.deleted_at = now or datetime.now()
+    purge = Account_purges(user_id=user.id, created_at=user.deleted_at)
+    db.session.add(purge)
+    return purge
+
+
+def run_purge(purge_id, chunk_size):
+    """Purge one claimed account chunk_size rows per transaction, recording the step and progress as it goes."""
+    purge = db.session.get(Account_purges, purge_id)
+    steps = [name for name, _ in PURGE_STEPS]
+    # A job taken over from a dead worker, or retried after failing, goes on from the step it had reached
+    start = steps.index(purge.step) if purge.step in steps else 0
+    try:
+        for name, step in PURGE_STEPS[start:]:
+            purge.step = name
+            # Each step deletes nothing once its rows are gone
+            while deleted := step(purge.user_id, chunk_size):
+                purge.rows_deleted += deleted
+                purge.heartbeat_at = datetime.now()
+                db.session.commit()
+                if name in RESTOCKING_STEPS:
+                    cache.invalidate("books")
+    except Exception as e:
+        db.session.rollback()
+        purge.status, purge.error, purge.finished_at = "Failed", str(e)[:500], datetime.now()
+        db.session.commit()
+        current_app.logger.exception("Purging account %s failed.", purge.user_id)
+        return purge
+    purge.status, purge.finished_at = "Done", datetime.now()
+    db.session.commit()
+    cache.invalidate("reviews")
+    return purge
+
+
+def claimable(now):
+    """Jobs a worker may take: pending ones, and those left Running by a dead worker or Failed, while they have attempts left."""
+    retry = func.coalesce(Account_purges.attempts, 0) < current_app.config["USER_PURGE_ATTEMPTS"]
+    lease = now - timedelta(seconds=current_app.config["USER_PURGE_LEASE"])
+    return or_(
+        Account_purges.status == "Pending",
+        and_(Account_purges.status == "Running", Account_purges.heartbeat_at < lease, retry),
+        and_(Account_purges.status == "Failed", retry),
+    )
+
+
+def claim_purge(now=None):
+    now = now or datetime.now()
+    # FOR UPDATE SKIP LOCKED where the database has it, so several purge workers never take the same job
+    purge = db.session.scalars(
+        select(Account_purges).where(claimable(now)).order_by(Account_purges.id).limit(1).with_for_update(skip_locked=True)
+    ).first()
+    if purge is None:
+        db.session.rollback()
+        return None
+    purge.status, purge.started_at, purge.heartbeat_at = "Running", now, now
+    purge.attempts = (purge.attempts or 0) + 1
+    db.session.commit()
+    return purge.id
+
+
+def purge_accounts(chunk_size=None):
+    """Run every claimable purge job until none is left. Returns the jobs run, a retried job once per run."""
+    chunk_size = chunk_size or current_app.config["USER_PURGE_CHUNK"]
+    purged = []
+    while (purge_id := claim_purge()) is not None:
+        purged.append(run_purge(purge_id, chunk_size))
+    return purged
+
@@ -1,19 +1,33 @@
 from app.blueprints.users import users_bp
-from .schemas import user_schema, user_credential_schema, users_schema
+from .schemas import user_schema, user_credential_schema, user_directory_schema
 from app.blueprints.addresses.schemas import addresses_schema
 from app.blueprints.payments.schemas import payments_schema
-from app.blueprints.book_reviews.schemas import user_reviews_schema
-from app.blueprints.favorites.schemas import user_favorites_schema
+from app.blueprints.book_reviews.schemas import UserReviewSchema
+from app.blueprints.favorites.schemas import UserFavoriteSchema
 from app.blueprints.orders.schemas import order_schema
-from app.blueprints.carts.schemas import cart_schema
-from app.blueprints.book_descriptions.schemas import book_description_schema
-from flask import request, jsonify
+from app.blueprints.book_descriptions.schemas import BookDescriptionSchema, book_fields, projected
+from app.blueprints.orders.routes import ORDER_GRAPH
+from app.blueprints.orders.history import order_filters, order_summary, order_lines
+from app.blueprints.carts.store import cart_contents, CART_GRAPH
+from app.utils.loading import load_plan
+from app.utils.pagination import keyset_paginate, CursorError
+from app.utils.query_budget import query_budget
+from flask import request, jsonify, current_app
+from sqlalchemy import select
+import click
 from marshmallow import ValidationError
-from app.models import db, Users, user_addresses, Order_books, Cart_books, Payments, Orders, Carts, Reviews, Favorites
-from werkzeug.security import generate_password_hash, check_password_hash
-from app.utils.auth import encode_token, token_required
+from app.models import db, Users, Account_purges, Orders, Reviews, Favorites, Book_descriptions
+from app.utils.passwords import passwords
+from app.utils.auth import encode_token, token_required, current_user, current_user_id
+from app.utils.cache import cache
+from app.utils.serializers import json_response
+from app.utils.streaming import ndjson_response, EXPORT_BATCH_SIZE
+from app.utils.cart_store import cart_store
+from .purge import account_size, delete_account, schedule_purge, purge_accounts
+from .directory import DIRECTORY_COLUMNS, directory_filters, directory_order
 
-import traceback
+from datetime import datetime
+import time
 
 
 # Create a User 
@@ -27,7 +41,7 @@ def create_user():
     existed_user_email = db.session.query(Users).where(Users.email == data["email"]).first()
     if existed_user_email:
         return jsonify({"error" : f"{data["email"]} is already associated with an account."}), 400
-    data["password"] = generate_password_hash(data["password"])
+    data["password"] = passwords.hash(data["password"])
     new_user = Users(**data)
     db.session.add(new_user)
     db.session.commit()
@@ -43,8 +57,12 @@ def login():
         credential_data = user_credential_schema.load(request.json)
     except ValidationError as e:
         return jsonify({"error_message" : e.messages}), 400
-    existed_user = db.session.query(Users).where(Users.email == credential_data["email"]).first()
-    if existed_user and check_password_hash(existed_user.password, credential_data["password"]):
+    existed_user = db.session.query(Users).where(Users.email == credential_data["email"], Users.deleted_at.is_(None)).first()
+    if existed_user and passwords.check(existed_user.password, credential_data["password"]):
+        # Hashed with the parameters of the day while the password is at hand
+        if passwords.needs_rehash(existed_user.password):
+            existed_user.password = passwords.hash(credential_data["password"])
+            db.session.commit()
         user_token = encode_token(existed_user.id)
         response = {
             "message" : f"Successfully logged in. Welcome {existed_user.first_name}",
@@ -56,16 +74,45 @@ def login():
         return jsonify({"error message" : "Invalid email or password."}), 400
 
 @users_bp.route('', methods=["GET"])
+@query_budget(1)
+@token_required
 def get_all_users():
-    users = db.session.query(Users).all()
-    return users_schema.jsonify(users), 200
+    try:
+        filters = directory_filters(request.args)
+    except ValueError as e:
+        return jsonify({"error" : str(e)}), 400
+    columns, descending = directory_order(request.args)
+    try:
+        users, next_cursor = keyset_paginate(
+            db.session.query(*DIRECTORY_COLUMNS).where(*filters),
+            columns,
+            after=request.args.get("after"),
+            limit=request.args.get("limit", type=int),
+            descending=descending,
+        )
+    except CursorError as e:
+        return jsonify({"error" : str(e)}), 400
+    return json_response({"data" : user_directory_schema.dump(users), "next_cursor" : next_cursor})
+
+@users_bp.route('/export', methods=["GET"])
+@token_required
+def export_users():
+    try:
+        filters = directory_filters(request.args)
+    except ValueError as e:
+        return jsonify({"error" : str(e)}), 400
+    query = select(*DIRECTORY_COLUMNS).where(*filters).order_by(Users.id)
+    def records():
+        # Runs inside the streamed response, the session of the view is gone by then
+        for batch in db.session.execute(query.execution_options(yield_per=EXPORT_BATCH_SIZE)).partitions():
+            yield from user_directory_schema.dump(batch)
+    return ndjson_response(records())
 
 
 @users_bp.route('/profile', methods={'GET'})
 @token_required
 def get_user():
-    user_id = request.user_id
-    user = db.session.get(Users, user_id)
+    user = current_user()
     if not user:
         return jsonify({"error" : f"User not found."}), 404
     response = {
@@ -78,70 +125,58 @@ def get_user():
 @users_bp.route('', methods={'DELETE'})
 @token_required
 def delete_user():
-    try:
-        user_id = request.user_id
-        user = db.session.get(Users, user_id)
-        if not user:
-            return jsonify({"error" : f"User not found."}), 404
-        if user.cart:
-            for item in user.cart.cart_books:
-                db.session.delete(item)
-            db.session.commit()
-            db.session.delete(user.cart)
-            db.session.commit()
-        if len(user.orders) > 0:
-            for order in user.orders:
-                for item in order.order_books:
-                    db.session.delete(item)
-                db.session.commit()
-                db.session.delete(order)
-                db.session.commit()
-        if len(user.reviews) > 0:
-            db.session.query(Reviews).filter(Reviews.user_id == user.id).delete()
-            db.session.commit()
-        if len(user.favorites) > 0 :
-            db.session.query(Favorites).filter(Favorites.user_id == user.id).delete()
-            db.session.commit()
-        if len(user.payments) > 0 :
-            db.session.query(Payments).filter(Payments.user_id == user.id).delete()
-            db.session.commit()
-        if len(user.addresses) > 0:
-            for address in user.addresses:
-                if len(address.orders) > 0:
-                    db.session.query(user_addresses).filter(user_addresses.c.user_id == user.id).delete()
-                    db.session.commit()
-                else:
-                    db.session.delete(address)
-                    db.session.commit()
-
-        # Delete the user after all related objects are removed
-        db.session.delete(user)
+    user = current_user()
+    if not user:
+        return jsonify({"error" : f"User not found."}), 404
+    if cart_store.enabled:
+        cart_store.evict(user.id)
+    # A bounded count, the request costs the same whatever the size of the account
+    if account_size(user.id, current_app.config["USER_PURGE_THRESHOLD"]) > current_app.config["USER_PURGE_THRESHOLD"]:
+        purge = schedule_purge(user)
         db.session.commit()
-        return jsonify({"message": "Your account was successfully deleted."}), 200
-    except Exception as e:
-        print("Error in delete_user:", e)
-        print(traceback.format_exc())
-        return jsonify({"error": "Internal server error", "details": str(e)}), 500
+        return jsonify({"message" : "Your account is being deleted.", "deletion" : purge_schema(purge)}), 202
+    delete_account(user.id)
+    db.session.commit()
+    # Their held copies are back in stock, their reviews are gone and reviews embed the user's name
+    cache.invalidate("books", "reviews")
+    return jsonify({"message": "Your account was successfully deleted."}), 200
+
+# Progress of the caller's account deletion
+@users_bp.route('/deletion', methods=['GET'])
+@token_required
+def get_user_deletion():
+    purge = db.session.scalars(
+        select(Account_purges).where(Account_purges.user_id == current_user_id()).order_by(Account_purges.id.desc()).limit(1)
+    ).first()
+    if not purge:
+        return jsonify({"error" : "There is no deletion of your account."}), 404
+    return jsonify(purge_schema(purge)), 200
 
 @users_bp.route('', methods=["PUT"])
 @token_required
 def update_user_profile():
-    user_id = request.user_id
-    user = db.session.get(Users, user_id)
+    user_id = current_user_id()
+    user = current_user()
     if not user:
         return jsonify({"error" : f"User not found."}), 404
     try:
-        user_data = user_schema.load(request.json)
+        # Leaving the password out keeps it, and saves hashing it again
+        user_data = user_schema.load(request.json, partial=("password",))
     except ValidationError as e:
         return jsonify({"error message" : e.messages}), 400
     # Check the email User wants to update not be taken with another mechanic
     existing_email = db.session.query(Users).where(Users.email == user_data["email"], Users.id != user_id).first()
     if existing_email:
         return jsonify({"error" : f"{user_data["email"]} is already taken with another mechanic."}), 400
-    user_data["password"] = generate_password_hash(user_data["password"])
+    if "password" in user_data:
+        user_data["password"] = passwords.hash(user_data["password"])
+    # Reviews show the author's name, touch them so their ETags change
+    if (user_data["first_name"], user_data["last_name"]) != (user.first_name, user.last_name):
+        db.session.query(Reviews).where(Reviews.user_id == user.id).update({"updated_at" : datetime.now()})
     for key, value in user_data.items():
         setattr(user, key, value)
     db.session.commit()
+    cache.invalidate("reviews")
     response = {
         "message" : f"Successfully your profile updated.",
         "user_data" : user_schema.dump(user),
@@ -149,78 +184,130 @@ def update_user_profile():
     return jsonify(response), 200
 
 @users_bp.route('/reviews', methods=["GET"])
+@query_budget(2)
 @token_required
 def get_user_reviews():
-    user_id = request.user_id
-    user = db.session.get(Users, user_id)
+    try:
+        fields = book_fields(request.args)
+    except ValueError as e:
+        return jsonify({"error" : str(e)}), 400
+    user = current_user(options=load_plan((Users.reviews, Reviews.book_description), only={Book_descriptions : fields}))
     if not user:
         return jsonify({"error" : f"User not found."}), 404
     response = {
         "user" : user_schema.dump(user),
-        "user_reviews" : user_reviews_schema.dump(user.reviews)
+        "user_reviews" : projected(UserReviewSchema, fields, many=True, nested="book_description").dump(user.reviews)
         }
-    return jsonify(response), 200
+    return json_response(response)
 
 # Get all favorites for a user
 @users_bp.route('/favorites', methods=['GET'])
+@query_budget(2)
 @token_required
 def get_user_favorites():
-	user_id = int(request.user_id)
-	user = db.session.get(Users, user_id)
+	try:
+		fields = book_fields(request.args)
+	except ValueError as e:
+		return jsonify({"error": str(e)}), 400
+	user = current_user(options=load_plan((Users.favorites, Favorites.book_description), only={Book_descriptions : fields}))
 	if not user:
 		return jsonify({"error": "User not found."}), 404
 	response = {
             "user" : user_schema.dump(user),
-            "user_favorites" : user_favorites_schema.dump(user.favorites)
+            "user_favorites" : projected(UserFavoriteSchema, fields, many=True, nested="book_description").dump(user.favorites)
         }
-	return jsonify(response), 200
+	return json_response(response)
 
 @users_bp.route('/orders', methods={'GET'})
+@query_budget(4)
 @token_required
 def get_user_orders():
-    user_id = int(request.user_id)
-    user = db.session.get(Users, user_id)
+    try:
+        fields = book_fields(request.args)
+        filters = order_filters(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    user_id = current_user_id()
+    user = current_user()
     if not user:
         return jsonify({"error": "User not found."}), 404
-    
+    # Newest first, served by the (user_id, created_at, id) index
+    try:
+        orders, next_cursor = keyset_paginate(
+            db.session.query(Orders).options(*load_plan(*ORDER_GRAPH)).where(Orders.user_id == user_id, *filters),
+            [Orders.created_at, Orders.id],
+            after=request.args.get("after"),
+            limit=request.args.get("limit", type=int),
+            descending=True,
+        )
+    except CursorError as e:
+        return jsonify({"error": str(e)}), 400
     response = {
         "user" : user_schema.dump(user),
+        "summary" : order_summary(user_id),
         "user_orders" : [
             {
             "order_info": order_schema.dump(order),
-            "order_books": [
-                {
-                    "book": book_description_schema.dump(book.book_description),
-                    "quantity": book.quantity
-                }
-                for book in order.order_books
-            ]} for order in user.orders ]
+            "order_books": order_lines(order, fields)} for order in orders ],
+        "next_cursor" : next_cursor
     }
-    return jsonify(response), 200
+    return json_response(response)
 
 @users_bp.route('/carts', methods={'GET'})
+# Two more with the cart store, on a miss it reads the cart, its lines and the books apart
+@query_budget(4)
 @token_required
 def get_user_cart():
-    user_id = int(request.user_id)
-    user = db.session.get(Users, user_id)
+    try:
+        fields = book_fields(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    user_id = current_user_id()
+    # The live cart is read from the cart store when there is one
+    options = [] if cart_store.enabled else load_plan(*[(Users.cart, *path) for path in CART_GRAPH], only={Book_descriptions : fields})
+    user = current_user(options=options)
     if not user:
         return jsonify({"error": "User not found."}), 404
-    if not user.cart:
+    contents = cart_contents(user_id, fields, user)
+    if not contents:
          return jsonify({"message": "There is no cart for you."}), 200
-    if len(user.cart.cart_books) == 0:
+    cart_info, lines = contents
+    if len(lines) == 0:
         return jsonify({"message": "Your cart is empty."}), 200
     response = {
         "user" : user_schema.dump(user),
         "user_cart" :
             {
-                "cart_info": cart_schema.dump(user.cart),
+                "cart_info": cart_info,
                 "cart_books": [
                     {
-                        "book": book_description_schema.dump(book.book_description),
-                        "quantity": book.quantity
+                        "book": projected(BookDescriptionSchema, fields).dump(book),
+                        "quantity": quantity
                     }
-                    for book in user.cart.cart_books
+                    for book, quantity in lines
                 ]
             }
     }
-    return jsonify(response), 200
+    return json_response(response)
+
+def purge_schema(purge):
+    return {
+        "id" : purge.id,
+        "status" : purge.status,
+        "step" : purge.step,
+        "rows_deleted" : purge.rows_deleted,
+        "created_at" : purge.created_at.isoformat(),
+        "finished_at" : purge.finished_at.isoformat() if purge.finished_at else None,
+    }
+
+@users_bp.cli.command('purge')
+@click.option('--chunk-size', type=int, help='Rows deleted per transaction (default USER_PURGE_CHUNK).')
+@click.option('--interval', type=float, help='Keep purging, polling every INTERVAL seconds, instead of draining the queue once.')
+def purge_command(chunk_size, interval):
+    """Delete the accounts too large to delete within their DELETE /users request."""
+    while True:
+        for purge in purge_accounts(chunk_size):
+            click.echo(f"account {purge.user_id}: {purge.status.lower()}, {purge.rows_deleted} rows deleted")
+        if not interval:
+            return
+        time.sleep(interval)
@@ -5,7 +5,11 @@ from app.extensions import ma
 class UserSchema(ma.SQLAlchemyAutoSchema):
     class Meta:
         model = Users
+        # Set by the account deletion only
+        exclude = ("deleted_at",)
 
 user_schema = UserSchema()
 users_schema = UserSchema(many=True)
 user_credential_schema = UserSchema(exclude=['first_name', 'last_name', 'phone'])
+# Rows of the user directory, which never selects the password
+user_directory_schema = UserSchema(many=True, only=("id", "first_name", "last_name", "email", "phone", "created_at"))
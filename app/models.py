@@ -1,6 +1,6 @@
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import String, DateTime,Date, Boolean, Integer, Table, Column, ForeignKey, CheckConstraint, Float
+from sqlalchemy import String, DateTime,Date, Boolean, Integer, Table, Column, ForeignKey, CheckConstraint, Float, Index, LargeBinary
 from datetime import datetime, date
 import random
 
@@ -18,6 +18,9 @@ user_addresses = Table(
     Base.metadata,
     Column("user_id", Integer, ForeignKey("users.id"), nullable=True),
     Column("address_id", Integer, ForeignKey("addresses.id"), nullable=False),
+    # Ownership checks (user -> address) and whether anyone else still uses an address
+    Index("ix_user_addresses_user_address", "user_id", "address_id"),
+    Index("ix_user_addresses_address_user", "address_id", "user_id"),
 )
 
 book_categories = Table(
@@ -25,10 +28,17 @@ book_categories = Table(
     Base.metadata,
     Column("book_description__id", Integer, ForeignKey("book_descriptions.id"), nullable=False),
     Column("category_id", Integer, ForeignKey("categories.id"), nullable=False),
+    # Category filter (category -> books) and category facet / book detail (book -> categories)
+    Index("ix_book_categories_category_book", "category_id", "book_description__id"),
+    Index("ix_book_categories_book_category", "book_description__id", "category_id"),
 )
 
 class Users(Base):
     __tablename__ = "users"
+    __table_args__ = (
+        # The user directory, newest first, paginated on (created_at, id)
+        Index("ix_users_created_at_id", "created_at", "id"),
+    )
 
     id : Mapped[int] = mapped_column(primary_key=True)
     first_name : Mapped[str] = mapped_column(String(150), nullable=False)
@@ -36,7 +46,9 @@ class Users(Base):
     email : Mapped[str] = mapped_column(String(500), nullable=False, unique=True)
     password : Mapped[str] = mapped_column(String(200), nullable=False)
     phone : Mapped[str] = mapped_column(String(50),nullable=False)
-    created_at : Mapped[datetime] = mapped_column(DateTime, default=datetime.now())
+    created_at : Mapped[datetime] = mapped_column(DateTime, default=datetime.now)
+    # Set when the account was deleted and is waiting for its purge job, it can't be used anymore
+    deleted_at : Mapped[datetime] = mapped_column(DateTime, nullable=True)
 
     # Relationship with addresses
     addresses : Mapped[list["Addresses"]] = relationship("Addresses", secondary="user_addresses", back_populates="users")
@@ -70,6 +82,10 @@ class Addresses(Base):
 
 class Payments(Base):
     __tablename__ = "payments"
+    __table_args__ = (
+        # A user's payment methods, and whether they already saved a card
+        Index("ix_payments_user_card_number", "user_id", "card_number"),
+    )
 
     id : Mapped[int] = mapped_column(primary_key=True)
     user_id : Mapped[int] = mapped_column(Integer, ForeignKey("users.id"), nullable=True)
@@ -86,18 +102,31 @@ class Payments(Base):
 
 class Orders(Base):
     __tablename__ = "orders"
+    __table_args__ = (
+        # A user's order history, newest first, paginated on (created_at, id)
+        Index("ix_orders_user_created_at_id", "user_id", "created_at", "id"),
+        # The admin order list, unfiltered or filtered by status or shipping method
+        Index("ix_orders_created_at_id", "created_at", "id"),
+        Index("ix_orders_status_created_at_id", "status", "created_at", "id"),
+        Index("ix_orders_shipping_method_created_at_id", "shipping_method", "created_at", "id"),
+    )
 
     id : Mapped[int] = mapped_column(primary_key=True)
     user_id : Mapped[int] = mapped_column(Integer, ForeignKey("users.id"), nullable=False)
     payment_id : Mapped[int] = mapped_column(Integer, ForeignKey("payments.id"), nullable=False)
     address_id : Mapped[int] = mapped_column(Integer, ForeignKey("addresses.id"), nullable=False)
-    created_at : Mapped[datetime] = mapped_column(DateTime, default=datetime.now())
+    created_at : Mapped[datetime] = mapped_column(DateTime, default=datetime.now)
     status : Mapped[str] = mapped_column(String(50),CheckConstraint("status IN ('Pending', 'Processing', 'Shipped', 'Cancelled', 'Returned')"), nullable=False, default="Pending")
     shipping_method : Mapped[str] = mapped_column(String(50), CheckConstraint("shipping_method IN ('InStore', 'Out-for-Delivery','Delivered', 'Delayed', 'Returned')"),default='InStore')
     subtotal : Mapped[float] = mapped_column(Float, nullable=False, default=0)
     tax : Mapped[float] = mapped_column(Float, nullable=False, default=0)
     shipping_cost : Mapped[float] = mapped_column(Float, nullable=False, default=0)
     total : Mapped[float] = mapped_column(Float, nullable=False, default=0)
+    # When the order entered each status after Pending, stamped by the fulfillment transitions
+    processing_at : Mapped[datetime] = mapped_column(DateTime, nullable=True)
+    shipped_at : Mapped[datetime] = mapped_column(DateTime, nullable=True)
+    cancelled_at : Mapped[datetime] = mapped_column(DateTime, nullable=True)
+    returned_at : Mapped[datetime] = mapped_column(DateTime, nullable=True)
 
     # Relationship with user
     user : Mapped["Users"] = relationship("Users", back_populates="orders")
@@ -113,22 +142,32 @@ class Carts(Base):
 
     id : Mapped[int] = mapped_column(primary_key=True)
     user_id : Mapped[int] = mapped_column(ForeignKey("users.id"), unique=True, nullable=False)
-    created_at : Mapped[datetime] = mapped_column(DateTime, default=datetime.now())
+    created_at : Mapped[datetime] = mapped_column(DateTime, default=datetime.now)
 
     # Relationship with users
     user : Mapped["Users"] = relationship("Users", back_populates="cart")
     # Relationship with cart_books
     cart_books : Mapped[list["Cart_books"]] = relationship("Cart_books", back_populates="cart") 
+    # Relationship with reservations
+    reservations : Mapped[list["Reservations"]] = relationship("Reservations", back_populates="cart")
 
 class Reviews(Base):
     __tablename__ = "reviews"
+    __table_args__ = (
+        Index("ix_reviews_book_description_id", "book_description_id"),
+        # A user's reviews, and whether they already reviewed a book
+        Index("ix_reviews_user_book", "user_id", "book_description_id"),
+        # Incremental exports
+        Index("ix_reviews_updated_at_id", "updated_at", "id"),
+    )
 
     id : Mapped[int] = mapped_column(primary_key=True)
     user_id : Mapped[int] = mapped_column(ForeignKey("users.id"), nullable=False)
     book_description_id : Mapped[int] = mapped_column(ForeignKey("book_descriptions.id"), nullable=False)
     rating : Mapped[float] = mapped_column(Float,nullable=False, default=0)
     comment : Mapped[str] = mapped_column(String)
-    created_at : Mapped[datetime] = mapped_column(DateTime, default=datetime.now())
+    created_at : Mapped[datetime] = mapped_column(DateTime, default=datetime.now)
+    updated_at : Mapped[datetime] = mapped_column(DateTime, nullable=True, default=datetime.now, onupdate=datetime.now)
 
     # Relationship with user
     user : Mapped["Users"] = relationship("Users", back_populates="reviews")
@@ -137,6 +176,10 @@ class Reviews(Base):
 
 class Favorites(Base):
     __tablename__ = "favorites"
+    __table_args__ = (
+        # A user's favorites, and whether a book already is one
+        Index("ix_favorites_user_book", "user_id", "book_description_id"),
+    )
 
     id : Mapped[int] = mapped_column(primary_key=True)
     user_id : Mapped[int] = mapped_column(ForeignKey("users.id"), nullable=False)
@@ -149,6 +192,16 @@ class Favorites(Base):
 
 class Book_descriptions(Base):
     __tablename__ = "book_descriptions"
+    # Composite (sort key, id) indexes used by the keyset paginated catalog listing, and a
+    # covering index for filtered browsing so the filters and facet counts never touch the table
+    __table_args__ = (
+        Index("ix_book_descriptions_price_id", "price", "id"),
+        Index("ix_book_descriptions_average_rating_id", "averageRating", "id"),
+        Index("ix_book_descriptions_published_date_id", "published_date", "id"),
+        Index("ix_book_descriptions_browse", "language", "price", "averageRating", "stock_quantity", "id"),
+        # Incremental exports
+        Index("ix_book_descriptions_updated_at_id", "updated_at", "id"),
+    )
 
     id : Mapped[int] = mapped_column(primary_key=True)
     title : Mapped[str] = mapped_column(String(400), nullable=False)
@@ -165,6 +218,7 @@ class Book_descriptions(Base):
     stock_quantity : Mapped[int] = mapped_column(Integer, nullable=False, default=20)
     averageRating : Mapped[float] = mapped_column(Float,nullable=False)
     ratingsCount : Mapped[int] = mapped_column(Integer,nullable=False)
+    updated_at : Mapped[datetime] = mapped_column(DateTime, nullable=True, default=datetime.now, onupdate=datetime.now)
 
     # Relationship with favorites
     favorites : Mapped[list["Favorites"]] = relationship("Favorites", back_populates="book_description")
@@ -179,6 +233,10 @@ class Book_descriptions(Base):
 
 class Cart_books(Base):
     __tablename__ = "cart_books"
+    __table_args__ = (
+        # One line per book, adding a book again upserts its quantity
+        Index("ux_cart_books_cart_book", "cart_id", "book_description_id", unique=True),
+    )
 
     id : Mapped[int] = mapped_column(primary_key=True)
     cart_id : Mapped[int] = mapped_column(ForeignKey("carts.id"), nullable=False)
@@ -190,13 +248,42 @@ class Cart_books(Base):
     # Relationship with book_descriptions
     book_description : Mapped["Book_descriptions"] = relationship("Book_descriptions", back_populates="cart_books")
 
+class Reservations(Base):
+    """Stock held for a cart line, taken off stock_quantity until checkout, removal or expiry."""
+    __tablename__ = "reservations"
+    __table_args__ = (
+        Index("ux_reservations_cart_book", "cart_id", "book_description_id", unique=True),
+        # The sweeper walks expired reservations in batches
+        Index("ix_reservations_expires_at_id", "expires_at", "id"),
+    )
+
+    id : Mapped[int] = mapped_column(primary_key=True)
+    cart_id : Mapped[int] = mapped_column(ForeignKey("carts.id"), nullable=False)
+    book_description_id : Mapped[int] = mapped_column(ForeignKey("book_descriptions.id"), nullable=False)
+    quantity : Mapped[int] = mapped_column(Integer, nullable=False, default=1)
+    expires_at : Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
+    # Relationship with carts
+    cart : Mapped["Carts"] = relationship("Carts", back_populates="reservations")
+
 class Order_books(Base):
     __tablename__ = "order_books"
+    __table_args__ = (
+        # Lines of a page of orders, loaded with order_id IN (...)
+        Index("ix_order_books_order_id", "order_id"),
+    )
 
     id : Mapped[int] = mapped_column(primary_key=True)
     order_id : Mapped[int] = mapped_column(ForeignKey("orders.id"), nullable=False)
     book_description_id : Mapped[int] = mapped_column(ForeignKey("book_descriptions.id"), nullable=False)
     quantity : Mapped[int] = mapped_column(Integer, nullable=False, default=1)
+    # The book as it was sold, copied at checkout so history reads neither join the book
+    # nor change when it is edited (null on lines older than the snapshot until backfilled)
+    unit_price : Mapped[float] = mapped_column(Float, nullable=True)
+    title : Mapped[str] = mapped_column(String(400), nullable=True)
+    author : Mapped[str] = mapped_column(String(200), nullable=True)
+    isbn : Mapped[str] = mapped_column(String(15), nullable=True)
+    image_link : Mapped[str] = mapped_column(String(900), nullable=True)
 
     # Relationship with carts
     order : Mapped["Orders"] = relationship("Orders", back_populates="order_books")
@@ -208,6 +295,51 @@ class Categories(Base):
 
     id : Mapped[int] = mapped_column(primary_key=True)
     title : Mapped[str] = mapped_column(String(250), nullable=False)
+    updated_at : Mapped[datetime] = mapped_column(DateTime, nullable=True, default=datetime.now, onupdate=datetime.now)
 
     # Relationship with book_description
-    book_descriptions : Mapped[list["Book_descriptions"]] = relationship("Book_descriptions",secondary="book_categories",back_populates="categories")
\ No newline at end of file
+    book_descriptions : Mapped[list["Book_descriptions"]] = relationship("Book_descriptions",secondary="book_categories",back_populates="categories")
+
+
+class Idempotency_keys(Base):
+    """Response stored for an Idempotency-Key, replayed when a client retries the request."""
+    __tablename__ = "idempotency_keys"
+    __table_args__ = (
+        Index("ux_idempotency_keys_user_key", "user_id", "key", unique=True),
+        Index("ix_idempotency_keys_expires_at", "expires_at"),
+    )
+
+    id : Mapped[int] = mapped_column(primary_key=True)
+    # No foreign key, the store never joins the business tables
+    user_id : Mapped[int] = mapped_column(Integer, nullable=False)
+    key : Mapped[str] = mapped_column(String(255), nullable=False)
+    # sha256 of the method, path and body the key was first used with
+    fingerprint : Mapped[str] = mapped_column(String(64), nullable=False)
+    # None while the first request is still running
+    status_code : Mapped[int] = mapped_column(Integer, nullable=True)
+    mimetype : Mapped[str] = mapped_column(String(100), nullable=True)
+    body : Mapped[bytes] = mapped_column(LargeBinary, nullable=True)
+    expires_at : Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
+class Account_purges(Base):
+    """Background deletion of an account too large to delete within its DELETE /users request."""
+    __tablename__ = "account_purges"
+    __table_args__ = (
+        Index("ix_account_purges_status_id", "status", "id"),
+        Index("ix_account_purges_user_id", "user_id"),
+    )
+
+    id : Mapped[int] = mapped_column(primary_key=True)
+    # No foreign key, the job outlives the user it deletes
+    user_id : Mapped[int] = mapped_column(Integer, nullable=False)
+    status : Mapped[str] = mapped_column(String(20), CheckConstraint("status IN ('Pending', 'Running', 'Done', 'Failed')"), nullable=False, default="Pending")
+    # Step being purged and rows deleted so far, the progress shown by GET /users/deletion
+    step : Mapped[str] = mapped_column(String(50), nullable=True)
+    rows_deleted : Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    error : Mapped[str] = mapped_column(String(500), nullable=True)
+    created_at : Mapped[datetime] = mapped_column(DateTime, nullable=False, default=datetime.now)
+    started_at : Mapped[datetime] = mapped_column(DateTime, nullable=True)
+    finished_at : Mapped[datetime] = mapped_column(DateTime, nullable=True)
+    # Runs so far and when the running one last committed, a job gone quiet past its lease is taken over
+    attempts : Mapped[int] = mapped_column(Integer, nullable=True, default=0)
+    heartbeat_at : Mapped[datetime] = mapped_column(DateTime, nullable=True)
@@ -1,16 +1,22 @@
 from datetime import datetime, timedelta, timezone
+from collections import OrderedDict
 from jose import jwt
 from functools import wraps
-from flask import request,jsonify
+from flask import request, jsonify, current_app
+from sqlalchemy import select, exists
+from app.models import db, Users, Addresses, user_addresses
+import hashlib
 import jose
 import os
+import threading
+import time
 
 
 SECRET_KEY = os.environ.get('SECRET_KEY') or 'SUPER SECRET secret key'
 
 def encode_token(id):
     payload = {
-        'iat' : datetime.now(timezone.utc), #issued 
+        'iat' : datetime.now(timezone.utc), #issued
         'exp' : datetime.now(timezone.utc) + timedelta(days=0, hours=1), #expiration data
         'sub' : str(id),
     }
@@ -19,21 +25,197 @@ def encode_token(id):
     return token
 
 
+class ExpiredToken(Exception):
+    pass
+
+
+class InvalidToken(Exception):
+    pass
+
+
+class JoseBackend:
+    """python-jose, the library the tokens are issued with."""
+
+    def decode(self, token):
+        try:
+            return jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
+        except jose.exceptions.ExpiredSignatureError:
+            raise ExpiredToken()
+        except jose.exceptions.JWTError:
+            raise InvalidToken()
+
+
+class PyJWTBackend:
+    """PyJWT, several times faster than python-jose at verifying HS256 tokens."""
+
+    def __init__(self):
+        try:
+            import jwt as pyjwt
+        except ImportError:
+            raise RuntimeError("JWT_BACKEND pyjwt needs the PyJWT package (pip install pyjwt).")
+        self.jwt = pyjwt
+
+    def decode(self, token):
+        try:
+            return self.jwt.decode(token, SECRET_KEY, algorithms=['HS256'], options={"require" : ["exp", "sub"]})
+        except self.jwt.ExpiredSignatureError:
+            raise ExpiredToken()
+        except self.jwt.InvalidTokenError:
+            raise InvalidToken()
+
+
+JWT_BACKENDS = {"jose" : JoseBackend, "pyjwt" : PyJWTBackend}
+
+
+class VerifiedTokens:
+    """Claims of tokens already verified, least recently used evicted first beyond max_size.
+
+    Keyed by the SHA-256 of the token, so the tokens themselves aren't kept, and each entry
+    expires with its token's exp. Every gunicorn worker has its own.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()   # digest -> (exp, claims)
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, digest, now):
+        with self.lock:
+            entry = self.entries.get(digest)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self.entries[digest]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(digest)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, digest, claims):
+        with self.lock:
+            self.entries[digest] = (claims["exp"], claims)
+            self.entries.move_to_end(digest)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size" : len(self.entries),
+                "hits" : self.hits,
+                "misses" : self.misses,
+                "evictions" : self.evictions,
+                "hit_rate" : round(self.hits / lookups, 4) if lookups else None,
+            }
+
+
+class Auth:
+    """Verifies bearer tokens with the JWT_BACKEND, remembering up to TOKEN_CACHE_SIZE of them.
+
+    A session sending the same token request after request pays for the signature and
+    claims checks once; TOKEN_CACHE_SIZE 0 verifies every request.
+    """
+
+    def init_app(self, app):
+        backend = app.config.get("JWT_BACKEND", "jose")
+        if backend not in JWT_BACKENDS:
+            raise ValueError(f"Unknown JWT_BACKEND {backend}.")
+        app.extensions["auth"] = {
+            "backend" : JWT_BACKENDS[backend](),
+            "tokens" : VerifiedTokens(app.config.get("TOKEN_CACHE_SIZE", 10000)),
+        }
+
+    def verify(self, token):
+        """The claims of a token, raising ExpiredToken or InvalidToken."""
+        state = current_app.extensions["auth"]
+        tokens = state["tokens"]
+        if not tokens.max_size:
+            return state["backend"].decode(token)
+        digest = hashlib.sha256(token.encode()).digest()
+        claims = tokens.get(digest, time.time())
+        if claims is None:
+            claims = state["backend"].decode(token)
+            # A token that never expires isn't remembered, it couldn't be aged out
+            if "exp" in claims:
+                tokens.put(digest, claims)
+        return claims
+
+    def stats(self):
+        """Hit rate of the verified token cache of this worker."""
+        return current_app.extensions["auth"]["tokens"].stats()
+
+
+auth = Auth()
+
+
+def bearer_token(header):
+    # "Bearer <token>", None for anything else rather than an IndexError on a malformed header
+    scheme, _, token = header.strip().partition(" ")
+    token = token.strip()
+    if scheme.lower() != "bearer" or not token or " " in token:
+        return None
+    return token
+
+
 def token_required(f):
     @wraps(f)
     def decorator(*args, **kwargs):
-        token = None
-
-        if 'Authorization' in request.headers:
-            token = request.headers['Authorization'].split()[1]
-        if not token:
+        header = request.headers.get('Authorization')
+        if not header:
             return jsonify({"error": "token missing from authorization headers"}), 401
+        token = bearer_token(header)
+        if not token:
+            return jsonify({"error": "authorization header must be: Bearer <token>"}), 401
         try:
-            data = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
+            data = auth.verify(token)
             request.user_id = data['sub']
-        except jose.exceptions.ExpiredSignatureError:
+        except ExpiredToken:
             return jsonify({'message':'token is expired'}), 403
-        except jose.exceptions.JWTError:
+        except InvalidToken:
             return jsonify({'message':'invalid token'}), 401
         return f(*args, **kwargs)
-    return decorator
\ No newline at end of file
+    return decorator
+
+
+def current_user_id():
+    """The id of the authenticated user, for handlers that don't need the user loaded."""
+    return int(request.user_id)
+
+
+def current_user(options=None):
+    """The authenticated user, loaded once per request with options; None if they were deleted.
+
+    Kept on the request rather than g: tests reuse one app context for several requests.
+    """
+    if not hasattr(request, "current_user"):
+        user = db.session.get(Users, current_user_id(), options=options)
+        # An account waiting for its purge job is gone as far as requests go
+        request.current_user = user if user is None or user.deleted_at is None else None
+    return request.current_user
+
+
+def active_user(user_id):
+    """EXISTS clause for a user who is there and not waiting for their purge job.
+
+    Every user existence probe goes through it: a deleted account's token stays valid until
+    it expires, and rows it wrote after its purge step ran would block the purge.
+    """
+    return exists().where(Users.id == user_id, Users.deleted_at.is_(None))
+
+
+def ownership(model, object_id, user_id=None):
+    """(user exists, object exists, object belongs to the user) for one row of model, in one query.
+
+    Three indexed EXISTS instead of loading the user and a whole collection of theirs to test
+    membership. Addresses belong to users through user_addresses, the other models through
+    their user_id column.
+    """
+    user_id = current_user_id() if user_id is None else user_id
+    if model is Addresses:
+        owned = exists().where(user_addresses.c.address_id == object_id, user_addresses.c.user_id == user_id)
+    else:
+        owned = exists().where(model.id == object_id, model.user_id == user_id)
+    return db.session.execute(select(active_user(user_id), exists().where(model.id == object_id), owned)).one()
@@ -0,0 +1,186 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import current_app, request, make_response
+
+
+class LRUBackend:
+    """In-process cache bounded by the total size of the stored values, least recently used evicted first.
+
+    Every gunicorn worker has its own entries and tag versions, so a write only invalidates
+    the entries of the worker that served it. No entry outlives max_timeout seconds
+    (CACHE_LOCAL_TIMEOUT), which bounds how long the other workers serve what they had;
+    with more than one worker use a shared backend.
+    """
+
+    def __init__(self, max_bytes, max_timeout=0):
+        self.max_bytes = max_bytes
+        self.max_timeout = max_timeout
+        self.size = 0
+        self.entries = OrderedDict()   # key -> (expires_at, value)
+        self.versions = {}             # tag -> version
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                self._pop(key)
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout):
+        if len(value) > self.max_bytes:
+            return
+        if self.max_timeout:
+            timeout = min(timeout or self.max_timeout, self.max_timeout)
+        with self.lock:
+            if key in self.entries:
+                self._pop(key)
+            self.entries[key] = (time.monotonic() + timeout if timeout else None, value)
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                self._pop(next(iter(self.entries)))
+
+    def _pop(self, key):
+        expires_at, value = self.entries.pop(key)
+        self.size -= len(value)
+
+    def get_versions(self, tags):
+        with self.lock:
+            return [self.versions.get(tag, 0) for tag in tags]
+
+    def bump(self, tags):
+        with self.lock:
+            for tag in tags:
+                self.versions[tag] = self.versions.get(tag, 0) + 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+class RedisBackend:
+    """Cache shared by every worker; Redis evicts entries itself (maxmemory-policy allkeys-lru)."""
+
+    def __init__(self, url, prefix):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("CACHE_TYPE RedisCache needs the redis package (pip install redis).")
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value, timeout):
+        self.client.set(self.prefix + key, value, ex=timeout or None)
+
+    def get_versions(self, tags):
+        return [int(version or 0) for version in self.client.mget([f"{self.prefix}tag:{tag}" for tag in tags])]
+
+    def bump(self, tags):
+        pipeline = self.client.pipeline()
+        for tag in tags:
+            pipeline.incr(f"{self.prefix}tag:{tag}")
+        pipeline.execute()
+
+    def clear(self):
+        keys = list(self.client.scan_iter(f"{self.prefix}*"))
+        if keys:
+            self.client.delete(*keys)
+
+
+class NullBackend:
+    def get(self, key):
+        return None
+
+    def set(self, key, value, timeout):
+        pass
+
+    def get_versions(self, tags):
+        return [0 for tag in tags]
+
+    def bump(self, tags):
+        pass
+
+    def clear(self):
+        pass
+
+
+def stock_tag(book_id):
+    # Tag of the views showing one book's stock, bumped by the cart holds and checkouts of that book
+    return f"stock:{book_id}"
+
+
+class Cache:
+    """Response cache for read endpoints with tag based invalidation.
+
+    Every cached response is stored under its tags' current versions. Write handlers call
+    invalidate(tag) after committing, which bumps the version so the old entries are never
+    read again and simply age out of the backend. No TTL is needed for correctness, except
+    for the stock shown by pages of many books: cart holds and checkouts only bump the
+    stock_tag() of their books, the pages listing books expire after CACHE_STOCK_TIMEOUT.
+    """
+
+    def init_app(self, app):
+        cache_type = app.config.get("CACHE_TYPE", "SimpleCache")
+        if cache_type == "SimpleCache":
+            backend = LRUBackend(app.config.get("CACHE_MAX_BYTES", 64 * 1024 * 1024), app.config.get("CACHE_LOCAL_TIMEOUT", 0))
+        elif cache_type == "RedisCache":
+            backend = RedisBackend(app.config["CACHE_REDIS_URL"], app.config.get("CACHE_KEY_PREFIX", "book_store:"))
+        elif cache_type == "NullCache":
+            backend = NullBackend()
+        else:
+            raise ValueError(f"Unknown CACHE_TYPE {cache_type}.")
+        app.extensions["cache"] = backend
+
+    @property
+    def backend(self):
+        return current_app.extensions["cache"]
+
+    def cached(self, tags, timeout="CACHE_DEFAULT_TIMEOUT"):
+        """Cache successful GET responses of a view, keyed by path and query string.
+
+        A tag may be a function of the view arguments, e.g. stock_tag for a view taking book_id.
+        ``timeout`` names the config value of the seconds an entry lives, 0 until invalidated.
+        """
+        def decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                if request.method != "GET":
+                    return f(*args, **kwargs)
+                backend = self.backend
+                versions = backend.get_versions([tag(**kwargs) if callable(tag) else tag for tag in tags])
+                key = "view:" + hashlib.sha1(
+                    f"{request.full_path}|{versions}".encode()
+                ).hexdigest()
+                stored = backend.get(key)
+                if stored is not None:
+                    header, body = stored.split(b"\n", 1)
+                    status, mimetype = header.decode().split(" ", 1)
+                    return current_app.response_class(body, status=int(status), mimetype=mimetype)
+                response = make_response(f(*args, **kwargs))
+                if response.status_code == 200 and not response.is_streamed:
+                    stored = f"{response.status_code} {response.mimetype}\n".encode() + response.get_data()
+                    backend.set(key, stored, current_app.config.get(timeout, 0))
+                return response
+            return wrapper
+        return decorator
+
+    def invalidate(self, *tags):
+        self.backend.bump(tags)
+
+    def clear(self):
+        self.backend.clear()
+
+
+cache = Cache()
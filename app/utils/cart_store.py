@@ -0,0 +1,224 @@
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+from flask import current_app
+from sqlalchemy import select, insert, delete
+from app.models import db, Carts, Cart_books
+
+
+class MemoryBackend:
+    """Live carts in a dict of this worker. Edits not flushed yet are lost if the worker dies."""
+
+    def __init__(self):
+        self.entries = {}   # user_id -> JSON of the cart
+        self.dirty = {}     # user_id -> version not flushed yet
+        self.version = 0
+        self.lock = threading.Lock()
+
+    def get(self, user_id):
+        with self.lock:
+            entry = self.entries.get(user_id)
+        return None if entry is None else json.loads(entry)
+
+    def load(self, user_id, cart):
+        with self.lock:
+            self.entries.setdefault(user_id, json.dumps(cart))
+
+    def update(self, user_id, edit):
+        with self.lock:
+            entry = self.entries.get(user_id)
+            cart = edit(None if entry is None else json.loads(entry))
+            self.entries[user_id] = json.dumps(cart)
+            self.version += 1
+            self.dirty[user_id] = self.version
+            return cart
+
+    def dirty_carts(self, limit, user_id=None):
+        with self.lock:
+            user_ids = [user_id] if user_id is not None else list(self.dirty)[:limit]
+            return [(user_id, self.dirty[user_id], json.loads(self.entries[user_id])) for user_id in user_ids if user_id in self.dirty]
+
+    def mark_clean(self, user_id, version):
+        with self.lock:
+            # An edit made while the cart was being flushed keeps it dirty
+            if self.dirty.get(user_id) == version:
+                del self.dirty[user_id]
+
+    def evict(self, user_id):
+        with self.lock:
+            self.entries.pop(user_id, None)
+            self.dirty.pop(user_id, None)
+
+
+class SqliteBackend:
+    """Live carts in a local SQLite file shared by the workers of the host.
+
+    Every edit is committed to the file, so a worker that dies loses nothing: the carts it
+    hadn't flushed are still marked dirty and the next flush writes them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        with self.connection() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS carts (user_id INTEGER PRIMARY KEY, entry TEXT NOT NULL, version INTEGER NOT NULL, dirty INTEGER NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS ix_carts_dirty ON carts (dirty)")
+
+    def connection(self):
+        # sqlite3 connections can't be shared between threads
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    def get(self, user_id):
+        row = self.connection().execute("SELECT entry FROM carts WHERE user_id = ?", (user_id,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def load(self, user_id, cart):
+        self.connection().execute("INSERT OR IGNORE INTO carts VALUES (?, ?, 0, 0)", (user_id, json.dumps(cart)))
+
+    def update(self, user_id, edit):
+        connection = self.connection()
+        # Takes the write lock first, edits of the same cart from two workers can't interleave
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT entry FROM carts WHERE user_id = ?", (user_id,)).fetchone()
+            cart = edit(None if row is None else json.loads(row[0]))
+            connection.execute(
+                "INSERT INTO carts VALUES (?, ?, 1, 1) ON CONFLICT (user_id) DO UPDATE SET entry = excluded.entry, version = version + 1, dirty = 1",
+                (user_id, json.dumps(cart))
+            )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return cart
+
+    def dirty_carts(self, limit, user_id=None):
+        if user_id is not None:
+            rows = self.connection().execute("SELECT user_id, version, entry FROM carts WHERE user_id = ? AND dirty = 1", (user_id,))
+        else:
+            rows = self.connection().execute("SELECT user_id, version, entry FROM carts WHERE dirty = 1 LIMIT ?", (limit,))
+        return [(user_id, version, json.loads(entry)) for user_id, version, entry in rows]
+
+    def mark_clean(self, user_id, version):
+        self.connection().execute("UPDATE carts SET dirty = 0 WHERE user_id = ? AND version = ?", (user_id, version))
+
+    def evict(self, user_id):
+        self.connection().execute("DELETE FROM carts WHERE user_id = ?", (user_id,))
+
+
+class CartStore:
+    """Write-behind store for the live carts, enabled with CART_STORE "memory" or "sqlite".
+
+    Cart edits update the store and the carts they touched are written to cart_books in
+    batches by a background thread every CART_FLUSH_INTERVAL seconds, and synchronously
+    for a cart being checked out. A cart is ``{"cart_id", "cart_info", "lines"}``, lines
+    mapping book ids (as strings) to quantities. With CART_STORE "database" (the default)
+    the store is disabled and cart edits are written to cart_books directly.
+    """
+
+    def init_app(self, app):
+        cart_store = app.config.get("CART_STORE", "database")
+        if cart_store == "database":
+            backend = None
+        elif cart_store == "memory":
+            backend = MemoryBackend()
+        elif cart_store == "sqlite":
+            backend = SqliteBackend(os.path.join(app.instance_path, app.config.get("CART_STORE_PATH", "carts.db")))
+        else:
+            raise ValueError(f"Unknown CART_STORE {cart_store}.")
+        app.extensions["cart_store"] = {"backend" : backend, "flusher" : None}
+        if backend is not None:
+            atexit.register(self.flush_on_exit, app)
+
+    @property
+    def backend(self):
+        return current_app.extensions["cart_store"]["backend"]
+
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    def get(self, user_id):
+        return self.backend.get(user_id)
+
+    def load(self, user_id, cart):
+        """Add a cart read from the database, unless an edit put a newer one in the store first."""
+        self.backend.load(user_id, cart)
+        return self.backend.get(user_id)
+
+    def update(self, user_id, edit):
+        """Apply edit(cart) -> cart atomically and schedule the cart to be flushed."""
+        self.start_flusher()
+        return self.backend.update(user_id, edit)
+
+    def evict(self, user_id):
+        self.backend.evict(user_id)
+
+    def flush(self, user_id=None):
+        """Write dirty carts to cart_books, only user_id's if given; return how many were written."""
+        written = 0
+        while True:
+            batch = self.backend.dirty_carts(current_app.config.get("CART_FLUSH_BATCH", 200), user_id)
+            if not batch:
+                return written
+            carts = {cart["cart_id"] : cart for owner, version, cart in batch}
+            # A cart checked out or deleted meanwhile is not written back
+            existing = set(db.session.scalars(select(Carts.id).where(Carts.id.in_(carts)).with_for_update()))
+            db.session.execute(delete(Cart_books).where(Cart_books.cart_id.in_(existing)))
+            rows = [
+                {"cart_id" : cart_id, "book_description_id" : int(book_id), "quantity" : quantity}
+                for cart_id in sorted(existing) for book_id, quantity in sorted(carts[cart_id]["lines"].items())
+            ]
+            if rows:
+                db.session.execute(insert(Cart_books), rows)
+            db.session.commit()
+            for owner, version, cart in batch:
+                if cart["cart_id"] in existing:
+                    self.backend.mark_clean(owner, version)
+                else:
+                    self.backend.evict(owner)
+            written += len(batch)
+            if user_id is not None:
+                return written
+
+    def start_flusher(self):
+        interval = current_app.config.get("CART_FLUSH_INTERVAL", 5)
+        state = current_app.extensions["cart_store"]
+        # Started lazily so each forked worker gets its own thread
+        if not interval or (state["flusher"] is not None and state["flusher"][0] == os.getpid()):
+            return
+        app = current_app._get_current_object()
+        thread = threading.Thread(target=self.flush_forever, args=(app, interval), name="cart-flusher", daemon=True)
+        state["flusher"] = (os.getpid(), thread)
+        thread.start()
+
+    def flush_forever(self, app, interval):
+        while True:
+            time.sleep(interval)
+            with app.app_context():
+                try:
+                    self.flush()
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception("Flushing the cart store failed, retrying in %s seconds.", interval)
+                finally:
+                    db.session.remove()
+
+    def flush_on_exit(self, app):
+        with app.app_context():
+            try:
+                self.flush()
+            except Exception:
+                app.logger.exception("Flushing the cart store on exit failed.")
+
+
+cart_store = CartStore()
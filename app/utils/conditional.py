@@ -0,0 +1,42 @@
+import hashlib
+from functools import wraps
+from flask import request, make_response
+
+
+def conditional(version):
+    """Strong ETag / If-None-Match support for a read view.
+
+    ``version(**view_kwargs)`` returns ``(version values, last modified datetime)`` from a
+    small aggregate query, or None when the resource doesn't exist (the view then answers
+    404 itself). When the client already has the current version the view is not called:
+    no ORM objects are loaded and nothing is serialized, the answer is an empty 304.
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            current = version(**kwargs)
+            if current is None:
+                return f(*args, **kwargs)
+            values, last_modified = current
+            # The query string picks the representation (?fields=...), each one has its own tag
+            etag = hashlib.sha1(repr(values).encode() + b"?" + request.query_string).hexdigest()
+            if request.if_none_match.contains(etag):
+                response = make_response("", 304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            # Clients may keep the response but have to revalidate it before every use
+            response.cache_control.public = True
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
+
+
+def latest(*timestamps):
+    timestamps = [timestamp for timestamp in timestamps if timestamp is not None]
+    return max(timestamps) if timestamps else None
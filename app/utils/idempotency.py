@@ -0,0 +1,142 @@
+import hashlib
+import time
+from datetime import datetime, timedelta
+from functools import wraps
+from flask import current_app, request, jsonify, make_response
+from sqlalchemy import select, insert, update, delete
+from sqlalchemy.exc import IntegrityError
+from flask.cli import AppGroup
+import click
+from app.models import db, Idempotency_keys
+from app.utils.auth import current_user_id
+
+HEADER = "Idempotency-Key"
+
+
+class Idempotency:
+    """Idempotency-Key support for write endpoints a client may retry.
+
+    The first request with a key claims it by inserting a row, the unique (user_id, key)
+    index making that the lock: a concurrent duplicate can't insert, waits for the first
+    request to finish and replays its response. Responses are kept IDEMPOTENCY_TTL seconds
+    and only touch the idempotency_keys table, never the business tables. A claim whose
+    request died is taken over after IDEMPOTENCY_LOCK_TIMEOUT seconds.
+    """
+
+    def init_app(self, app):
+        app.cli.add_command(idempotency_cli)
+
+    def idempotent(self, f):
+        """Use under @token_required, keys are scoped to the authenticated user."""
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            key = request.headers.get(HEADER)
+            if key is None:
+                return f(*args, **kwargs)
+            if not key or len(key) > 255:
+                return jsonify({"error" : f"{HEADER} must be 1 to 255 characters."}), 400
+            user_id = current_user_id()
+            fingerprint = hashlib.sha256(
+                request.method.encode() + b" " + request.full_path.encode() + b"\n" + request.get_data()
+            ).hexdigest()
+            stored = self.claim(user_id, key, fingerprint)
+            if stored is not None:
+                return stored
+            try:
+                response = make_response(f(*args, **kwargs))
+            except BaseException:
+                self.release(user_id, key)
+                raise
+            if response.status_code >= 500 or response.is_streamed:
+                # Not a result worth replaying, let the retry run again
+                self.release(user_id, key)
+            else:
+                self.store(user_id, key, response)
+            return response
+        return wrapper
+
+    def claim(self, user_id, key, fingerprint):
+        """Claim the key for this request and return None, or return the response to send instead."""
+        config = current_app.config
+        deadline = time.monotonic() + config["IDEMPOTENCY_WAIT"]
+        delay = 0.01
+        while True:
+            now = datetime.now()
+            try:
+                with db.engine.begin() as connection:
+                    connection.execute(insert(Idempotency_keys).values(
+                        user_id=user_id, key=key, fingerprint=fingerprint,
+                        expires_at=now + timedelta(seconds=config["IDEMPOTENCY_LOCK_TIMEOUT"])
+                    ))
+                return None
+            except IntegrityError:
+                pass
+            with db.engine.connect() as connection:
+                row = connection.execute(
+                    select(Idempotency_keys.fingerprint, Idempotency_keys.status_code, Idempotency_keys.mimetype, Idempotency_keys.body, Idempotency_keys.expires_at)
+                    .where(Idempotency_keys.user_id == user_id, Idempotency_keys.key == key)
+                ).first()
+            if row is None:
+                continue
+            if row.expires_at <= now:
+                # An old response, or a claim whose request never finished
+                with db.engine.begin() as connection:
+                    connection.execute(delete(Idempotency_keys).where(
+                        Idempotency_keys.user_id == user_id, Idempotency_keys.key == key, Idempotency_keys.expires_at <= now
+                    ))
+                continue
+            if row.fingerprint != fingerprint:
+                return jsonify({"error" : f"This {HEADER} was already used for a different request."}), 422
+            if row.status_code is not None:
+                response = current_app.response_class(row.body, status=row.status_code, mimetype=row.mimetype)
+                response.headers["Idempotent-Replayed"] = "true"
+                return response
+            if time.monotonic() >= deadline:
+                response = jsonify({"error" : f"A request with this {HEADER} is still in progress."})
+                response.headers["Retry-After"] = "1"
+                return response, 409
+            time.sleep(delay)
+            delay = min(delay * 2, 0.25)
+
+    def store(self, user_id, key, response):
+        with db.engine.begin() as connection:
+            connection.execute(
+                update(Idempotency_keys)
+                .where(Idempotency_keys.user_id == user_id, Idempotency_keys.key == key)
+                .values(
+                    status_code=response.status_code, mimetype=response.mimetype, body=response.get_data(),
+                    expires_at=datetime.now() + timedelta(seconds=current_app.config["IDEMPOTENCY_TTL"])
+                )
+            )
+
+    def release(self, user_id, key):
+        with db.engine.begin() as connection:
+            connection.execute(delete(Idempotency_keys).where(Idempotency_keys.user_id == user_id, Idempotency_keys.key == key))
+
+    def purge_expired(self, batch_size=1000):
+        """Delete expired keys batch_size rows per transaction, return how many were deleted."""
+        purged = 0
+        while True:
+            now = datetime.now()
+            with db.engine.begin() as connection:
+                ids = connection.scalars(
+                    select(Idempotency_keys.id).where(Idempotency_keys.expires_at <= now).order_by(Idempotency_keys.expires_at).limit(batch_size)
+                ).all()
+                if ids:
+                    connection.execute(delete(Idempotency_keys).where(Idempotency_keys.id.in_(ids)))
+            purged += len(ids)
+            if len(ids) < batch_size:
+                return purged
+
+
+idempotency = Idempotency()
+
+
+idempotency_cli = AppGroup('idempotency', help='Idempotency key store.')
+
+
+@idempotency_cli.command('purge')
+@click.option('--batch-size', type=int, default=1000, show_default=True, help='Keys deleted per transaction.')
+def purge_command(batch_size):
+    """Delete the expired idempotency keys."""
+    click.echo(f"{idempotency.purge_expired(batch_size)} expired idempotency keys deleted.")
@@ -0,0 +1,31 @@
+from sqlalchemy.orm import joinedload, load_only, selectinload
+
+
+def _hop(loader, relationship):
+    # Collections are loaded with selectinload, one extra query per hop whatever the number
+    # of parents. Many-to-one hops are joinedload and ride along in the query of their parent.
+    name = "selectinload" if relationship.property.uselist else "joinedload"
+    if loader is None:
+        return (selectinload if name == "selectinload" else joinedload)(relationship)
+    return getattr(loader, name)(relationship)
+
+
+def load_plan(*paths, only=None):
+    """Loader options for the relationship graph an endpoint serializes.
+
+    Each path is a chain of relationships starting at the queried entity, e.g.
+    ``(Orders.order_books, Order_books.book_description)``; a graph is the list of its
+    root-to-leaf paths. ``only`` maps a model to the column names to load for it, e.g.
+    ``{Book_descriptions: fields}`` for sparse fieldsets, None meaning every column.
+    """
+    only = {model: columns for model, columns in (only or {}).items() if columns}
+    options = []
+    for path in paths:
+        loader = None
+        for relationship in path:
+            loader = _hop(loader, relationship)
+            target = relationship.property.mapper.class_
+            if target in only:
+                loader = loader.options(load_only(*[getattr(target, name) for name in sorted(only[target])]))
+        options.append(loader)
+    return options
@@ -0,0 +1,68 @@
+import base64
+import json
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import DateTime, and_, or_
+
+
+class CursorError(ValueError):
+    pass
+
+
+def encode_cursor(values):
+    # Opaque, url-safe cursor holding the sort key values of the last row on a page
+    values = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    raw = json.dumps(values, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+
+
+def decode_cursor(cursor, columns):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (ValueError, TypeError):
+        raise CursorError("Invalid cursor.")
+    if not isinstance(values, list) or len(values) != len(columns):
+        raise CursorError("Invalid cursor.")
+    try:
+        return [datetime.fromisoformat(value) if isinstance(column.type, DateTime) and value is not None else value
+                for column, value in zip(columns, values)]
+    except (ValueError, TypeError):
+        raise CursorError("Invalid cursor.")
+
+
+def page_size(requested):
+    # Page size asked by the client, capped by PAGE_SIZE_MAX
+    if requested is None:
+        return current_app.config['PAGE_SIZE_DEFAULT']
+    if requested < 1:
+        raise CursorError("limit must be a positive integer.")
+    return min(requested, current_app.config['PAGE_SIZE_MAX'])
+
+
+def _after(columns, values, descending):
+    # (a, b, id) > (x, y, z) written out so it works on every database and uses the composite index
+    column, value = columns[0], values[0]
+    beyond = column < value if descending else column > value
+    if len(columns) == 1:
+        return beyond
+    return or_(beyond, and_(column == value, _after(columns[1:], values[1:], descending)))
+
+
+def keyset_paginate(query, columns, after=None, limit=None, descending=False):
+    """Return one page of ``query`` ordered by ``columns`` and the cursor of the next page.
+
+    The last column has to be unique (usually the primary key) so the order is total.
+    Pages are fetched with ``WHERE (sort key, id) > cursor ... LIMIT n`` instead of an
+    OFFSET, so a deep page costs the same as the first one.
+    """
+    limit = page_size(limit)
+    if after:
+        query = query.where(_after(columns, decode_cursor(after, columns), descending))
+    query = query.order_by(*[column.desc() if descending else column.asc() for column in columns])
+    rows = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([getattr(rows[-1], column.key) for column in columns])
+    return rows, next_cursor
@@ -0,0 +1,93 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from flask import current_app, jsonify
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class HashingBusy(Exception):
+    """Every hashing slot stayed taken for PASSWORD_HASH_WAIT seconds, the request should be retried."""
+
+
+def hash_method(password_hash):
+    # werkzeug stores "<method>$<salt>$<hash>", e.g. "scrypt:32768:8:1$..."
+    return password_hash.split("$", 1)[0]
+
+
+class Passwords:
+    """Hashes and checks passwords with PASSWORD_HASH_METHOD on a pool of PASSWORD_HASH_WORKERS processes.
+
+    scrypt takes tens of milliseconds of CPU, which in a request worker blocks every request
+    behind it. The pool runs the hashes off the request workers, and at most PASSWORD_HASH_QUEUE
+    of them are queued or running per worker: beyond that a request waits PASSWORD_HASH_WAIT
+    seconds for a slot and then gets HashingBusy, so a login burst is answered 503 instead of
+    piling up. PASSWORD_HASH_WORKERS 0 hashes inline in the calling thread.
+
+    The pool bounds the CPU hashing takes, it doesn't free the request worker: a sync
+    gunicorn worker still waits on .result() for its hash, only threaded or async workers
+    serve other requests meanwhile.
+    """
+
+    def init_app(self, app):
+        app.extensions["passwords"] = {
+            "method" : app.config.get("PASSWORD_HASH_METHOD", "scrypt"),
+            "prefix" : None,
+            "workers" : app.config.get("PASSWORD_HASH_WORKERS", 0),
+            "wait" : app.config.get("PASSWORD_HASH_WAIT", 5),
+            "slots" : threading.BoundedSemaphore(app.config.get("PASSWORD_HASH_QUEUE", 64)),
+            "lock" : threading.Lock(),
+            "pool" : None,
+        }
+        app.register_error_handler(HashingBusy, self.busy)
+
+    @staticmethod
+    def busy(error):
+        response = jsonify({"error" : "Too many sign-ins at once, try again shortly."})
+        response.headers["Retry-After"] = "1"
+        return response, 503
+
+    def pool(self, state):
+        # Started on first use, after gunicorn has forked, and again in a child forked from a worker
+        with state["lock"]:
+            pool, pid = state["pool"] or (None, None)
+            if pid != os.getpid():
+                # spawn rather than fork, the worker has threads (cart flusher, fulfillment) running
+                pool = ProcessPoolExecutor(state["workers"], mp_context=multiprocessing.get_context("spawn"))
+                state["pool"] = (pool, os.getpid())
+            return pool
+
+    def run(self, function, *args):
+        state = current_app.extensions["passwords"]
+        if not state["workers"]:
+            return function(*args)
+        if not state["slots"].acquire(timeout=state["wait"]):
+            raise HashingBusy()
+        try:
+            return self.pool(state).submit(function, *args).result()
+        finally:
+            state["slots"].release()
+
+    def hash(self, password):
+        return self.run(generate_password_hash, password, current_app.extensions["passwords"]["method"])
+
+    def check(self, password_hash, password):
+        return self.run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """Whether the hash was made with other parameters than PASSWORD_HASH_METHOD."""
+        state = current_app.extensions["passwords"]
+        if state["prefix"] is None:
+            # "scrypt" is stored as "scrypt:32768:8:1", hashing once spells out the defaults
+            state["prefix"] = hash_method(generate_password_hash("", state["method"]))
+        return hash_method(password_hash) != state["prefix"]
+
+    def shutdown(self, app):
+        state = app.extensions["passwords"]
+        with state["lock"]:
+            if state["pool"] is not None and state["pool"][1] == os.getpid():
+                state["pool"][0].shutdown()
+            state["pool"] = None
+
+
+passwords = Passwords()
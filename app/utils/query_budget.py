@@ -0,0 +1,83 @@
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from flask import current_app, request
+from sqlalchemy import event
+from app.models import db
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+        self.statements = []
+
+
+class QueryCounting:
+    """Counts the SQL statements of the count_queries() blocks open in the executing thread.
+
+    One before_cursor_execute listener per engine, registered when the app starts: adding
+    and removing listeners on a shared engine while other threads run statements isn't
+    safe, and threads never see each other's counters.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def init_app(self, app):
+        with app.app_context():
+            for engine in db.engines.values():
+                event.listen(engine, "before_cursor_execute", self.record)
+
+    def record(self, conn, cursor, statement, parameters, context, executemany):
+        for counter in getattr(self.local, "counters", ()):
+            counter.count += 1
+            counter.statements.append(statement)
+
+    @contextmanager
+    def counting(self):
+        if not hasattr(self.local, "counters"):
+            self.local.counters = []
+        counter = QueryCounter()
+        self.local.counters.append(counter)
+        try:
+            yield counter
+        finally:
+            self.local.counters.remove(counter)
+
+
+query_counting = QueryCounting()
+
+
+def count_queries():
+    """Count the SQL statements sent to the database inside the block, in this thread."""
+    return query_counting.counting()
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def query_budget(budget):
+    """Declare the most SQL statements a view may run, whatever the size of the data.
+
+    With QUERY_BUDGET_MODE "raise" (tests) a view going over its budget raises
+    QueryBudgetExceeded listing the statements, with "warn" it is logged, and with
+    None (production) nothing is counted.
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            mode = current_app.config.get("QUERY_BUDGET_MODE")
+            if not mode:
+                return f(*args, **kwargs)
+            with count_queries() as queries:
+                response = f(*args, **kwargs)
+            if queries.count > budget:
+                message = f"{request.method} {request.path} ran {queries.count} queries, its budget is {budget}:\n" + "\n".join(queries.statements)
+                if mode == "raise":
+                    raise QueryBudgetExceeded(message)
+                current_app.logger.warning(message)
+            return response
+        wrapper.query_budget = budget
+        return wrapper
+    return decorator
@@ -0,0 +1,90 @@
+import json
+import os
+import threading
+from flask import current_app
+
+
+class RateTables:
+    """Tax and shipping rates read from the JSON file at RATES_PATH, reloaded when it changes.
+
+    The file is parsed once into dict lookups and stat'ed on each use; a new version replaces
+    the tables as soon as it is saved. A file that fails to parse is logged and the last good
+    tables stay in use, as they do while the file is missing. Format::
+
+        {"tax": {"default": 0.08,
+                 "aliases": {"USA": "US"},
+                 "countries": {"US": {"default": 0.0, "states": {"CA": 0.0725}}}},
+         "shipping": {"default": 0.0, "methods": {"Out-for-Delivery": 5.99}}}
+
+    Countries and states are matched case-insensitively; a state missing from its country
+    falls back to the country's default, an unknown country to the global default.
+    """
+
+    def init_app(self, app):
+        app.extensions["rates"] = {"lock" : threading.Lock(), "tables" : {}}
+
+    def tables(self):
+        state = current_app.extensions["rates"]
+        path = current_app.config["RATES_PATH"]
+        loaded = state["tables"].get(path)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            # Mid-deploy the file can be briefly missing, the tables already read still hold
+            if loaded is None:
+                raise
+            current_app.logger.warning("Rates file %s is unreadable, keeping the loaded rates.", path)
+            return loaded[1]
+        if loaded is not None and loaded[0] == mtime:
+            return loaded[1]
+        with state["lock"]:
+            loaded = state["tables"].get(path)
+            if loaded is not None and loaded[0] == mtime:
+                return loaded[1]
+            try:
+                with open(path) as rates_file:
+                    tables = self.parse(json.load(rates_file))
+            except (OSError, ValueError, KeyError, TypeError, AttributeError):
+                if loaded is None:
+                    raise
+                current_app.logger.exception("Reloading the rates from %s failed, keeping the previous ones.", path)
+                return loaded[1]
+            state["tables"][path] = (mtime, tables)
+            return tables
+
+    @staticmethod
+    def parse(rates):
+        # Keys upper-cased once here so lookups are a single dict get
+        tax = rates["tax"]
+        countries = {}
+        for country, entry in tax.get("countries", {}).items():
+            countries[country.strip().upper()] = {
+                "default" : float(entry.get("default", tax["default"])),
+                "states" : {state.strip().upper() : float(rate) for state, rate in entry.get("states", {}).items()},
+            }
+        shipping = rates["shipping"]
+        return {
+            "tax_default" : float(tax["default"]),
+            "aliases" : {alias.strip().upper() : country.strip().upper() for alias, country in tax.get("aliases", {}).items()},
+            "countries" : countries,
+            "shipping_default" : float(shipping.get("default", 0.0)),
+            "shipping" : {method : float(cost) for method, cost in shipping.get("methods", {}).items()},
+        }
+
+    def tax_rate(self, country=None, state=None):
+        """Tax rate of an address, the default rate when there is no address."""
+        tables = self.tables()
+        if country is None:
+            return tables["tax_default"]
+        country = country.strip().upper()
+        entry = tables["countries"].get(tables["aliases"].get(country, country))
+        if entry is None:
+            return tables["tax_default"]
+        return entry["states"].get((state or "").strip().upper(), entry["default"])
+
+    def shipping_cost(self, shipping_method):
+        tables = self.tables()
+        return tables["shipping"].get(shipping_method, tables["shipping_default"])
+
+
+rates = RateTables()
@@ -0,0 +1,359 @@
+import html
+import math
+import re
+import threading
+from bisect import bisect_left, insort
+from collections import defaultdict
+from flask import current_app
+from sqlalchemy import DDL, event, inspect, text
+from app.models import db, Book_descriptions
+
+# Indexed columns and their relevance weight
+SEARCH_FIELDS = {
+    "title" : 10.0,
+    "subtitle" : 4.0,
+    "author" : 6.0,
+    "publisher" : 2.0,
+    "description" : 1.0,
+}
+MAX_QUERY_TERMS = 10
+HIGHLIGHT_START = "<mark>"
+HIGHLIGHT_END = "</mark>"
+# Private use characters the engines mark matches with, turned into <mark> once the text is escaped
+MARK_START = "\ue000"
+MARK_END = "\ue001"
+SNIPPET_WORDS = 12
+
+# SQLite: FTS5 table keyed by the book id (rowid), created and dropped together with book_descriptions
+SQLITE_CREATE = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS book_search USING fts5("
+    + ", ".join(SEARCH_FIELDS)
+    + ", tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+)
+SQLITE_DROP = "DROP TABLE IF EXISTS book_search"
+
+# Postgres: generated tsvector column with a GIN index, maintained by the database on every write
+POSTGRES_CREATE = [
+    "ALTER TABLE book_descriptions ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS ("
+    "setweight(to_tsvector('simple', coalesce(title, '')), 'A') || "
+    "setweight(to_tsvector('simple', coalesce(author, '')), 'A') || "
+    "setweight(to_tsvector('simple', coalesce(subtitle, '')), 'B') || "
+    "setweight(to_tsvector('simple', coalesce(publisher, '')), 'C') || "
+    "setweight(to_tsvector('simple', coalesce(description, '')), 'D')) STORED",
+    "CREATE INDEX IF NOT EXISTS ix_book_descriptions_search ON book_descriptions USING GIN (search_vector)",
+]
+
+event.listen(Book_descriptions.__table__, "after_create", DDL(SQLITE_CREATE).execute_if(dialect="sqlite"))
+event.listen(Book_descriptions.__table__, "before_drop", DDL(SQLITE_DROP).execute_if(dialect="sqlite"))
+for statement in POSTGRES_CREATE:
+    event.listen(Book_descriptions.__table__, "after_create", DDL(statement).execute_if(dialect="postgresql"))
+
+
+def tokenize(value):
+    return re.findall(r"\w+", (value or "").lower())
+
+
+def query_terms(q):
+    # Word tokens of a search query, the last one is matched as a prefix
+    return tokenize(q)[:MAX_QUERY_TERMS]
+
+
+def marked_html(value):
+    # Catalog text is escaped before the marks become <mark> tags, imported HTML never comes out as markup
+    if value is None:
+        return None
+    return html.escape(value).replace(MARK_START, HIGHLIGHT_START).replace(MARK_END, HIGHLIGHT_END)
+
+
+def highlight(value, terms):
+    # Wrap every word starting with a query term in <mark>...</mark>, as escaped HTML
+    if not value:
+        return value
+    value = value.replace(MARK_START, "").replace(MARK_END, "")
+    if terms:
+        pattern = re.compile(r"\b(" + "|".join(re.escape(term) for term in terms) + r")\w*", re.IGNORECASE)
+        value = pattern.sub(lambda match: f"{MARK_START}{match.group(0)}{MARK_END}", value)
+    return marked_html(value)
+
+
+def snippet(value, terms):
+    # Highlighted window of SNIPPET_WORDS words around the first match
+    words = (value or "").split()
+    prefixes = tuple(terms)
+    first = next((i for i, word in enumerate(words) if re.sub(r"\W", "", word.lower()).startswith(prefixes)), 0)
+    start = max(first - SNIPPET_WORDS // 3, 0)
+    window = " ".join(words[start:start + SNIPPET_WORDS])
+    prefix = "…" if start > 0 else ""
+    suffix = "…" if start + SNIPPET_WORDS < len(words) else ""
+    return prefix + highlight(window, terms) + suffix
+
+
+class SqliteSearch:
+    def create(self, connection):
+        exists = connection.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'book_search'")).first()
+        connection.execute(text(SQLITE_CREATE))
+        return not exists
+
+    def index(self, books):
+        rows = [{"id": book.id, **{field: getattr(book, field) for field in SEARCH_FIELDS}} for book in books]
+        if not rows:
+            return
+        db.session.execute(text("DELETE FROM book_search WHERE rowid = :id"), [{"id": row["id"]} for row in rows])
+        db.session.execute(
+            text(f"INSERT INTO book_search(rowid, {', '.join(SEARCH_FIELDS)}) VALUES (:id, {', '.join(':' + field for field in SEARCH_FIELDS)})"),
+            rows,
+        )
+
+    def remove(self, book_ids):
+        db.session.execute(text("DELETE FROM book_search WHERE rowid = :id"), [{"id": book_id} for book_id in book_ids])
+
+    def rebuild(self):
+        db.session.execute(text("DELETE FROM book_search"))
+        db.session.execute(text(
+            f"INSERT INTO book_search(rowid, {', '.join(SEARCH_FIELDS)}) "
+            f"SELECT id, {', '.join(SEARCH_FIELDS)} FROM book_descriptions"
+        ))
+
+    def search(self, terms, limit):
+        # Every term must match, the last one as a prefix; bm25() is lower-is-better
+        match = " ".join(f'"{term}"' for term in terms[:-1]) + f' "{terms[-1]}"*'
+        weights = ", ".join(str(weight) for weight in SEARCH_FIELDS.values())
+        highlights = ", ".join(
+            f"highlight(book_search, {i}, '{MARK_START}', '{MARK_END}')" if field != "description"
+            else f"snippet(book_search, {i}, '{MARK_START}', '{MARK_END}', '…', {SNIPPET_WORDS})"
+            for i, field in enumerate(SEARCH_FIELDS)
+        )
+        rows = db.session.execute(text(
+            f"SELECT rowid, -bm25(book_search, {weights}) AS score, {highlights} FROM book_search "
+            "WHERE book_search MATCH :match ORDER BY score DESC LIMIT :limit"
+        ), {"match": match.strip(), "limit": limit}).all()
+        return [(row[0], row[1], dict(zip(SEARCH_FIELDS, map(marked_html, row[2:])))) for row in rows]
+
+
+class PostgresSearch:
+    def create(self, connection):
+        for statement in POSTGRES_CREATE:
+            connection.execute(text(statement))
+        return False
+
+    # The generated column keeps itself up to date, nothing to do on writes
+    def index(self, books):
+        pass
+
+    def remove(self, book_ids):
+        pass
+
+    def rebuild(self):
+        pass
+
+    def search(self, terms, limit):
+        tsquery = " & ".join(terms[:-1] + [f"{terms[-1]}:*"])
+        options = f"StartSel={MARK_START}, StopSel={MARK_END}"
+        highlights = ", ".join(
+            f"ts_headline('simple', {field}, query, '{options}')" if field != "description"
+            else f"ts_headline('simple', {field}, query, '{options}, MaxWords={SNIPPET_WORDS}, MinWords={SNIPPET_WORDS // 2}')"
+            for field in SEARCH_FIELDS
+        )
+        rows = db.session.execute(text(
+            f"SELECT id, ts_rank_cd(search_vector, query) AS score, {highlights} "
+            "FROM book_descriptions, to_tsquery('simple', :tsquery) AS query "
+            "WHERE search_vector @@ query ORDER BY score DESC, id LIMIT :limit"
+        ), {"tsquery": tsquery, "limit": limit}).all()
+        return [(row[0], row[1], dict(zip(SEARCH_FIELDS, map(marked_html, row[2:])))) for row in rows]
+
+
+# Session.info key of the MemorySearch writes waiting for their transaction to commit
+PENDING = "memory_search_pending"
+
+
+@event.listens_for(db.session, "after_commit")
+def apply_pending(session):
+    for backend, book_id, values in session.info.pop(PENDING, ()):
+        backend.apply(book_id, values)
+
+
+@event.listens_for(db.session, "after_rollback")
+def discard_pending(session):
+    session.info.pop(PENDING, None)
+
+
+class MemorySearch:
+    """Pure python inverted index with BM25 ranking, used when the database has no full-text engine.
+
+    The index lives in the worker process. It is built from the table on first use and
+    then kept up to date by index() / remove() from the write routes. Those are held on the
+    session and applied once it commits, a rolled back write never reaches the index.
+    """
+    K1 = 1.2
+    B = 0.75
+    MAX_PREFIX_EXPANSION = 50
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.built = False
+        self.postings = defaultdict(dict)   # term -> {book_id: weighted term frequency}
+        self.terms = []                     # sorted vocabulary for prefix lookups
+        self.doc_terms = {}                 # book_id -> set of terms, to unindex
+        self.doc_lengths = {}               # book_id -> weighted length
+        self.total_length = 0.0
+
+    def create(self, connection):
+        return False
+
+    def _add(self, book_id, values):
+        self._remove(book_id)
+        frequencies = defaultdict(float)
+        for field, weight in SEARCH_FIELDS.items():
+            for term in tokenize(values[field]):
+                frequencies[term] += weight
+        for term, frequency in frequencies.items():
+            if term not in self.postings:
+                insort(self.terms, term)
+            self.postings[term][book_id] = frequency
+        self.doc_terms[book_id] = set(frequencies)
+        self.doc_lengths[book_id] = sum(frequencies.values())
+        self.total_length += self.doc_lengths[book_id]
+
+    def _remove(self, book_id):
+        for term in self.doc_terms.pop(book_id, ()):
+            postings = self.postings[term]
+            postings.pop(book_id, None)
+            if not postings:
+                del self.postings[term]
+                del self.terms[bisect_left(self.terms, term)]
+        self.total_length -= self.doc_lengths.pop(book_id, 0.0)
+
+    def _build(self):
+        if self.built:
+            return
+        for book in db.session.query(Book_descriptions).yield_per(1000):
+            self._add(book.id, {field : getattr(book, field) for field in SEARCH_FIELDS})
+        self.built = True
+
+    def index(self, books):
+        # The values are read now, the books are expired by the time the session commits
+        db.session.info.setdefault(PENDING, []).extend((self, book.id, {field : getattr(book, field) for field in SEARCH_FIELDS}) for book in books)
+
+    def remove(self, book_ids):
+        db.session.info.setdefault(PENDING, []).extend((self, book_id, None) for book_id in book_ids)
+
+    def apply(self, book_id, values):
+        with self.lock:
+            # An index not built yet reads the committed rows when it is
+            if not self.built:
+                return
+            if values is None:
+                self._remove(book_id)
+            else:
+                self._add(book_id, values)
+
+    def rebuild(self):
+        with self.lock:
+            self._reset()
+            self._build()
+
+    def _expand(self, prefix):
+        start = bisect_left(self.terms, prefix)
+        expanded = []
+        for term in self.terms[start:start + self.MAX_PREFIX_EXPANSION]:
+            if not term.startswith(prefix):
+                break
+            expanded.append(term)
+        return expanded
+
+    def search(self, terms, limit):
+        with self.lock:
+            self._build()
+            count = len(self.doc_lengths)
+            if not count:
+                return []
+            average_length = self.total_length / count
+            scores = None
+            for position, term in enumerate(terms):
+                matches = self._expand(term) if position == len(terms) - 1 else [term]
+                term_scores = defaultdict(float)
+                for match in matches:
+                    postings = self.postings.get(match, {})
+                    idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                    for book_id, frequency in postings.items():
+                        norm = frequency + self.K1 * (1 - self.B + self.B * self.doc_lengths[book_id] / average_length)
+                        term_scores[book_id] += idf * frequency * (self.K1 + 1) / norm
+                # Every term has to match
+                if scores is None:
+                    scores = term_scores
+                else:
+                    scores = {book_id: score + term_scores[book_id] for book_id, score in scores.items() if book_id in term_scores}
+            ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:limit]
+        return [(book_id, score, None) for book_id, score in ranked]
+
+
+class BookSearch:
+    """Full-text search over title, subtitle, author, publisher and description.
+
+    SQLite uses FTS5, Postgres a tsvector/GIN index and anything else a pure python index.
+    The write routes call index_book() / remove_book() before committing, so the index
+    is maintained incrementally and never needs a full rebuild. Highlights are escaped
+    HTML with the matches in <mark> tags.
+    """
+
+    def init_app(self, app):
+        app.extensions["book_search"] = None
+
+    @property
+    def backend(self):
+        backend = current_app.extensions.get("book_search")
+        if backend is None:
+            dialect = db.engine.dialect.name
+            if dialect == "sqlite":
+                backend = SqliteSearch()
+            elif dialect == "postgresql":
+                backend = PostgresSearch()
+            else:
+                backend = MemorySearch()
+            current_app.extensions["book_search"] = backend
+        return backend
+
+    def ensure_index(self):
+        # Create the index of a database that existed before search was added and fill it once
+        with db.engine.begin() as connection:
+            created = self.backend.create(connection)
+        if created:
+            self.rebuild()
+
+    def index_book(self, book):
+        self.backend.index([book])
+
+    def index_books(self, books):
+        self.backend.index(books)
+
+    def remove_book(self, book_id):
+        self.backend.remove([book_id])
+
+    def rebuild(self):
+        self.backend.rebuild()
+        db.session.commit()
+
+    def search(self, q, limit, options=()):
+        """Return [(book, score, highlights)] best match first; options are applied to the book query."""
+        terms = query_terms(q)
+        if not terms:
+            return []
+        hits = self.backend.search(terms, limit)
+        books = {book.id: book for book in db.session.query(Book_descriptions).options(*options).where(Book_descriptions.id.in_([hit[0] for hit in hits]))}
+        results = []
+        for book_id, score, highlights in hits:
+            book = books.get(book_id)
+            if book is None:
+                continue
+            if highlights is None:
+                # Columns left out by the options are not highlighted rather than loaded one book at a time
+                unloaded = inspect(book).unloaded
+                highlights = {field: snippet(getattr(book, field), terms) if field == "description" else highlight(getattr(book, field), terms) for field in SEARCH_FIELDS if field not in unloaded}
+            results.append((book, score, highlights))
+        return results
+
+
+search = BookSearch()
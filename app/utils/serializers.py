@@ -0,0 +1,116 @@
+import json
+from collections.abc import Mapping
+from flask import current_app
+from marshmallow import fields, missing
+from marshmallow.decorators import PRE_DUMP, POST_DUMP
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def json_bytes(data):
+    """Encode to compact UTF-8 JSON, with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def json_response(data, status=200):
+    # Like jsonify() without key sorting or pretty printing
+    return current_app.response_class(json_bytes(data) + b"\n", status=status, mimetype="application/json")
+
+
+def _converter(field):
+    """Python expression turning ``v`` into the field's dumped value, or None when the field is not compiled."""
+    if getattr(field, "as_string", False):
+        return None
+    kind = type(field)
+    if kind is fields.String:
+        return "v if v is None or v.__class__ is str else str(v)"
+    if kind is fields.Integer:
+        return "v if v is None or v.__class__ is int else int(v)"
+    if kind is fields.Float:
+        return "v if v is None or v.__class__ is float else float(v)"
+    if kind in (fields.DateTime, fields.Date, fields.Time) and field.format in field.SERIALIZATION_FUNCS:
+        return "None if v is None else {helper}(v)"
+    if kind is fields.Nested:
+        return "None if v is None else {helper}(v)"
+    return None
+
+
+def compile_dump(schema):
+    """Generate a function dumping one object exactly like ``schema.dump(obj, many=False)``.
+
+    Every field is read with a plain attribute lookup and converted inline. Field types
+    without a known conversion go through their own ``serialize()``. Returns None when the
+    schema has dump hooks, those have to run through marshmallow.
+    """
+    if schema._hooks[PRE_DUMP] or schema._hooks[POST_DUMP]:
+        return None
+    namespace = {"missing": missing, "accessor": schema.get_attribute}
+    lines = ["def dump(obj):", "    r = {}"]
+    for index, (name, field) in enumerate(schema.dump_fields.items()):
+        key = field.data_key if field.data_key is not None else name
+        attribute = field.attribute or name
+        expression = _converter(field) if attribute.isidentifier() else None
+        helper = f"helper_{index}"
+        if expression and isinstance(field, fields.Nested):
+            nested = compile_dump(field.schema)
+            if nested is None:
+                expression = None
+            elif field.many or field.schema.many:
+                namespace[helper] = lambda values, dump=nested: [dump(value) for value in values]
+            else:
+                namespace[helper] = nested
+        elif expression and "{helper}" in expression:
+            namespace[helper] = field.SERIALIZATION_FUNCS[field.format]
+        if expression:
+            lines.append(f"    v = obj.{attribute}")
+            lines.append(f"    r[{key!r}] = " + expression.format(helper=helper))
+        else:
+            namespace[f"field_{index}"] = field
+            lines.append(f"    v = field_{index}.serialize({name!r}, obj, accessor=accessor)")
+            lines.append(f"    if v is not missing:")
+            lines.append(f"        r[{key!r}] = v")
+    lines.append("    return r")
+    exec(compile("\n".join(lines), f"<dump {type(schema).__name__}>", "exec"), namespace)
+    return namespace["dump"]
+
+
+class CompiledSchema:
+    """A marshmallow schema instance whose dump() is compiled once into a specialized function.
+
+    It is a drop-in replacement for the schema: dump(), dumps() and jsonify() use the
+    compiled function, everything else (load, validate, fields, ...) is the wrapped schema's.
+    Mappings, and schemas with dump hooks, are dumped by marshmallow itself.
+    """
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.many = schema.many
+        self._dump = compile_dump(schema)
+
+    def __getattr__(self, name):
+        return getattr(self.schema, name)
+
+    def dump(self, obj, *, many=None):
+        many = self.many if many is None else bool(many)
+        if self._dump is None or isinstance(obj, Mapping):
+            return self.schema.dump(obj, many=many)
+        if many and obj is not None:
+            dump = self._dump
+            return [dump(item) for item in obj]
+        return self._dump(obj)
+
+    def dumps(self, obj, *, many=None):
+        """Dump straight to JSON bytes."""
+        return json_bytes(self.dump(obj, many=many))
+
+    def jsonify(self, obj, *, many=None):
+        return current_app.response_class(self.dumps(obj, many=many) + b"\n", mimetype="application/json")
+
+
+def compiled(schema):
+    return schema if isinstance(schema, CompiledSchema) else CompiledSchema(schema)
@@ -0,0 +1,45 @@
+import json
+import zlib
+from datetime import datetime
+from flask import current_app, request, stream_with_context
+
+EXPORT_BATCH_SIZE = 1000
+
+
+def since_arg():
+    """The ``since`` query parameter as a datetime, None when absent; raises ValueError when malformed."""
+    since = request.args.get("since")
+    if not since:
+        return None
+    try:
+        return datetime.fromisoformat(since)
+    except ValueError:
+        raise ValueError("since must be an ISO 8601 date or datetime.")
+
+
+def gzip_stream(chunks):
+    # Compress on the fly, yielding compressed bytes as soon as zlib has some
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk.encode())
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def ndjson_response(records):
+    """Stream an iterable of dicts as NDJSON, gzipped when the client accepts it.
+
+    Nothing is buffered: each record is encoded when the WSGI server asks for the next
+    chunk, so memory stays flat whatever the size of the export. Pass a generator that runs
+    its query itself: the view's session is closed by the time the body is streamed.
+    """
+    body = (json.dumps(record, default=str) + "\n" for record in records)
+    gzipped = "gzip" in request.accept_encodings
+    if gzipped:
+        body = gzip_stream(body)
+    response = current_app.response_class(stream_with_context(body), mimetype="application/x-ndjson")
+    response.vary.add("Accept-Encoding")
+    if gzipped:
+        response.headers["Content-Encoding"] = "gzip"
+    return response
@@ -0,0 +1,23 @@
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from app.models import db
+
+
+def upsert(model, rows, index_elements, set_=None):
+    """Single statement INSERT of rows that updates the rows already there instead of failing.
+
+    ``index_elements`` are the columns of the unique index the rows conflict on, ``set_``
+    is called with the row that failed to insert (``excluded`` on SQLite and Postgres,
+    ``inserted`` on MySQL) and returns the columns to update, e.g.
+    ``lambda new: {"quantity" : Cart_books.quantity + new.quantity}``. Without ``set_`` the
+    conflicting rows are left alone.
+    """
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ("mysql", "mariadb"):
+        statement = mysql.insert(model).values(rows)
+        # MySQL has no DO NOTHING, setting a column to itself is the usual no-op
+        values = set_(statement.inserted) if set_ else {index_elements[0] : getattr(model, index_elements[0])}
+        return statement.on_duplicate_key_update(values)
+    statement = (postgresql if dialect == "postgresql" else sqlite).insert(model).values(rows)
+    if set_ is None:
+        return statement.on_conflict_do_nothing(index_elements=index_elements)
+    return statement.on_conflict_do_update(index_elements=index_elements, set_=set_(statement.excluded))
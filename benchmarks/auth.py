@@ -0,0 +1,69 @@
+"""Overhead of token_required per request, verifying every token against the verified token cache.
+
+Run from the repository root:
+
+    python -m benchmarks.auth [--requests 20000] [--sessions 100] [--repeat 5]
+
+Requests cycle through the tokens of --sessions users, the way a few active sessions send
+request after request. Only the decorator is timed, inside a request context, no database
+is needed. PyJWT is measured too when it is installed.
+"""
+import argparse
+import importlib.util
+import time
+from app import create_app
+from app.utils.auth import auth, encode_token, token_required, JWT_BACKENDS
+
+
+@token_required
+def view():
+    return "ok"
+
+
+def best_of(repeat, function):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def measure(backend, cache_size, headers, requests, repeat):
+    app = create_app("TestingConfig")
+    app.config.update(JWT_BACKEND=backend, TOKEN_CACHE_SIZE=cache_size)
+    auth.init_app(app)
+    contexts = [app.test_request_context(headers={"Authorization" : header}) for header in headers]
+
+    def run(call_view=True):
+        for i in range(requests):
+            with contexts[i % len(contexts)]:
+                if call_view:
+                    view()
+
+    elapsed = best_of(repeat, run)
+    # Pushing the request context is paid by every request anyway, only the decorator is counted
+    floor = best_of(repeat, lambda: run(call_view=False))
+    with app.app_context():
+        stats = auth.stats()
+    return (elapsed - floor) / requests * 1e6, stats["hit_rate"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--sessions", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    headers = [f"Bearer {encode_token(user_id)}" for user_id in range(args.sessions)]
+    backends = [name for name in JWT_BACKENDS if name != "pyjwt" or importlib.util.find_spec("jwt")]
+    print(f"{'backend':<8} {'cache':>6} {'us/request':>11} {'speedup':>8} {'hit rate':>9}")
+    for backend in backends:
+        baseline, _ = measure(backend, 0, headers, args.requests, args.repeat)
+        print(f"{backend:<8} {'off':>6} {baseline:>11.1f} {'1.0x':>8} {'-':>9}")
+        cached, hit_rate = measure(backend, 10000, headers, args.requests, args.repeat)
+        print(f"{backend:<8} {'on':>6} {cached:>11.1f} {baseline / cached:>7.1f}x {hit_rate:>9.2%}")
+
+
+if __name__ == "__main__":
+    main()
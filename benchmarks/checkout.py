@@ -0,0 +1,67 @@
+"""Checkouts per second with concurrent clients.
+
+Run from the repository root:
+
+    python -m benchmarks.checkout [--users 200] [--threads 8] [--books 3]
+
+Every user checks out their own cart, all carts compete for the stock of the same books,
+and the stock left at the end is checked against the quantities ordered. Uses the
+TestingConfig database, which is dropped and recreated.
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+from app import create_app
+from app.models import db, Users, Addresses, Payments, Carts, Cart_books, Book_descriptions, Order_books
+from app.utils.auth import encode_token
+
+
+def seed(users, books, stock):
+    book_rows = [Book_descriptions(title=f"Book{i}", subtitle="Sub", author="Author", publisher="Pub", published_date="2020-01-01", description="Desc", isbn=f"{i:013d}", image_link="img", language="EN", price=10.0 + i, stock_quantity=stock, averageRating=4.0, ratingsCount=1) for i in range(books)]
+    db.session.add_all(book_rows)
+    checkouts = []
+    for i in range(users):
+        user = Users(first_name="Bench", last_name=str(i), email=f"bench{i}@email.com", password="hash", phone="+1234567890")
+        address = Addresses(line1="1 Main St", city="City", state="ST", country="Land", zipcode="12345", users=[user])
+        payment = Payments(user=user, card_number="4111111111111111", cvv=123, expiry_month=1, expiry_year=2030)
+        cart = Carts(user=user, cart_books=[Cart_books(book_description=book, quantity=1 + i % 2) for book in book_rows])
+        db.session.add_all([user, address, payment, cart])
+        checkouts.append((user, cart, address, payment))
+    db.session.commit()
+    return [(user.id, f"/orders/{cart.id}/address/{address.id}/payment/{payment.id}") for user, cart, address, payment in checkouts]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--books", type=int, default=3)
+    parser.add_argument("--stock", type=int, help="Copies of each book, enough for every cart by default; lower it to race for the last copies.")
+    args = parser.parse_args()
+    app = create_app("TestingConfig")
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        checkouts = seed(args.users, args.books, args.stock if args.stock is not None else args.users * 2)
+        stock_before = db.session.query(db.func.sum(Book_descriptions.stock_quantity)).scalar()
+    client = app.test_client()
+
+    def run(checkout):
+        user_id, url = checkout
+        return client.post(url, json={"shipping_method": "InStore"}, headers={"Authorization": f"Bearer {encode_token(user_id)}"}).status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.threads) as pool:
+        statuses = list(pool.map(run, checkouts))
+    elapsed = time.perf_counter() - start
+    with app.app_context():
+        stock_after = db.session.query(db.func.sum(Book_descriptions.stock_quantity)).scalar()
+        ordered = db.session.query(db.func.sum(Order_books.quantity)).scalar() or 0
+    succeeded = statuses.count(201)
+    print(f"{succeeded}/{len(statuses)} checkouts in {elapsed:.2f}s with {args.threads} threads: {succeeded / elapsed:,.0f} checkouts/s")
+    print(f"failed: { {status: statuses.count(status) for status in set(statuses) if status != 201} or 'none'}")
+    print(f"stock consistent: {stock_before - stock_after == ordered} ({ordered} copies ordered)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""Logins per second per core, with the password hashed inline and on the process pool.
+
+Run from the repository root:
+
+    python -m benchmarks.passwords [--logins 200] [--threads 8] [--method scrypt:32768:8:1]
+
+Only the password check of a login is timed, the rest of the request is noise next to it.
+Inline, --threads request threads check passwords in the worker process itself; with the
+pool they hand the checks to --workers processes, one per core by default.
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.security import generate_password_hash
+from app import create_app
+from app.utils.passwords import passwords
+
+
+def measure(method, workers, logins, threads):
+    app = create_app("TestingConfig")
+    app.config.update(PASSWORD_HASH_METHOD=method, PASSWORD_HASH_WORKERS=workers, PASSWORD_HASH_QUEUE=threads)
+    passwords.init_app(app)
+    stored = generate_password_hash("correct horse", method)
+
+    def login(_):
+        with app.app_context():
+            assert passwords.check(stored, "correct horse")
+
+    with ThreadPoolExecutor(threads) as requests:
+        # Starts the pool processes outside the timing
+        list(requests.map(login, range(threads)))
+        start = time.perf_counter()
+        list(requests.map(login, range(logins)))
+        elapsed = time.perf_counter() - start
+    passwords.shutdown(app)
+    return logins / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--method", default="scrypt:32768:8:1")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    print(f"{args.method}, {args.threads} request threads")
+    print(f"{'hashing':<12} {'cores':>5} {'logins/s':>9} {'per core':>9}")
+    inline = measure(args.method, 0, args.logins, args.threads)
+    print(f"{'inline':<12} {1:>5} {inline:>9.1f} {inline:>9.1f}")
+    pooled = measure(args.method, args.workers, args.logins, args.threads)
+    print(f"{'pool':<12} {args.workers:>5} {pooled:>9.1f} {pooled / args.workers:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""Dump throughput of the compiled serializers against plain marshmallow.
+
+Run from the repository root:
+
+    python -m benchmarks.serializers [--objects 1000] [--repeat 5]
+
+Objects are built in memory, no database is needed.
+"""
+import argparse
+import json
+import time
+from datetime import datetime
+from app import create_app
+from app.models import Users, Reviews, Orders, Book_descriptions
+from app.utils.serializers import compiled, json_bytes
+from app.blueprints.book_descriptions.schemas import BookDescriptionSchema
+from app.blueprints.book_reviews.schemas import ReviewUserSchema
+from app.blueprints.orders.schemas import OrderSchema
+
+
+def make_objects(count):
+    books, orders, reviews = [], [], []
+    for i in range(count):
+        user = Users(id=i, first_name=f"First{i}", last_name=f"Last{i}", email=f"user{i}@email.com", password="hash", phone="+1234567890", created_at=datetime.now())
+        book = Book_descriptions(id=i, title=f"Title {i}", subtitle="Subtitle", author="Author", publisher="Publisher", published_date="2020-01-01", description="Lorem ipsum " * 300, isbn=f"{i:013d}", page_count=320, image_link="https://example.com/cover.jpg", language="EN", price=19.99, stock_quantity=20, averageRating=4.5, ratingsCount=120, updated_at=datetime.now())
+        books.append(book)
+        orders.append(Orders(id=i, user_id=i, payment_id=i, address_id=i, created_at=datetime.now(), status="Pending", shipping_method="InStore", subtotal=19.99, tax=1.6, shipping_cost=0, total=21.59))
+        reviews.append(Reviews(id=i, user=user, book_description=book, rating=4.0, comment="A good read.", created_at=datetime.now(), updated_at=datetime.now()))
+    return {"book": (BookDescriptionSchema, books), "order": (OrderSchema, orders), "review": (ReviewUserSchema, reviews)}
+
+
+def best_of(repeat, function):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--objects", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    with create_app("TestingConfig").app_context():
+        print(f"{'schema':<8} {'marshmallow/s':>14} {'compiled/s':>12} {'speedup':>8} {'with JSON':>10}")
+        for name, (schema_class, objects) in make_objects(args.objects).items():
+            schema = schema_class(many=True)
+            fast = compiled(schema_class(many=True))
+            assert fast.dump(objects) == schema.dump(objects)
+            slow_time = best_of(args.repeat, lambda: json.dumps(schema.dump(objects)).encode())
+            fast_time = best_of(args.repeat, lambda: json_bytes(fast.dump(objects)))
+            dump_time = best_of(args.repeat, lambda: schema.dump(objects))
+            compiled_dump_time = best_of(args.repeat, lambda: fast.dump(objects))
+            print(
+                f"{name:<8} {args.objects / dump_time:>14,.0f} {args.objects / compiled_dump_time:>12,.0f} "
+                f"{dump_time / compiled_dump_time:>7.1f}x {slow_time / fast_time:>9.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
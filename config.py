@@ -3,18 +3,153 @@ class DevelopmentConfig:
     # set the database
     SQLALCHEMY_DATABASE_URI = 'sqlite:///book_store_app.db'
     DEBUG = True
+    # SimpleCache is an in-process LRU, RedisCache is shared by every worker, NullCache disables caching
     CACHE_TYPE = "SimpleCache"
-    CACHE_DEFAULT_TIMEOUT = 200
+    # 0 = cached responses live until a write invalidates them or they are evicted
+    CACHE_DEFAULT_TIMEOUT = 0
+    CACHE_MAX_BYTES = 64 * 1024 * 1024
+    # Longest a SimpleCache entry lives whatever its timeout: each worker invalidates only its own
+    # entries, this bounds how stale the other workers get. 0 = no bound, fine for a single process
+    CACHE_LOCAL_TIMEOUT = 0
+    # Seconds the pages listing many books keep their stock figures, cart holds and checkouts
+    # only drop the views of their own books
+    CACHE_STOCK_TIMEOUT = 30
+    PAGE_SIZE_DEFAULT = 20
+    PAGE_SIZE_MAX = 100
+    IMPORT_CHUNK_SIZE = 1000
+    # Tax rates by country / state and shipping cost by shipping method, reloaded when the file changes
+    RATES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rates.json")
+    # Seconds a book added to a cart stays held for it
+    RESERVATION_TTL = 900
+    RESERVATION_SWEEP_BATCH = 500
+    # Seconds a response is replayed for a retried Idempotency-Key
+    IDEMPOTENCY_TTL = 24 * 60 * 60
+    # Seconds before the claim of a request that never finished can be taken over
+    IDEMPOTENCY_LOCK_TIMEOUT = 60
+    # Seconds a concurrent duplicate waits for the first request before answering 409
+    IDEMPOTENCY_WAIT = 10
+    # "database" writes cart edits to cart_books, "memory" (per worker) or "sqlite" (a file in the
+    # instance folder shared by the workers of the host) keep live carts there and write them behind
+    CART_STORE = "database"
+    CART_STORE_PATH = "carts.db"
+    # Seconds between background flushes, the most edits a "memory" store loses if a worker dies
+    CART_FLUSH_INTERVAL = 5
+    CART_FLUSH_BATCH = 200
+    # "jose" or "pyjwt" (pip install pyjwt, faster) verifies the bearer tokens
+    JWT_BACKEND = "jose"
+    # Verified tokens remembered per worker until they expire, 0 verifies every request
+    TOKEN_CACHE_SIZE = 10000
+    # werkzeug hash method and cost, stored hashes made with another are rehashed at login
+    PASSWORD_HASH_METHOD = "scrypt:32768:8:1"
+    # Processes hashing passwords per worker, 0 hashes in the request thread
+    PASSWORD_HASH_WORKERS = 2
+    # Hashes queued or running per worker, beyond that a request waits PASSWORD_HASH_WAIT
+    # seconds for a slot before answering 503
+    PASSWORD_HASH_QUEUE = 32
+    PASSWORD_HASH_WAIT = 2
+    # Background fulfillment (flask orders fulfill): threads claiming orders, orders claimed per
+    # transaction and seconds an idle worker waits before polling again
+    FULFILLMENT_WORKERS = 2
+    FULFILLMENT_BATCH = 100
+    FULFILLMENT_INTERVAL = 5
+    # Seconds an order stays Processing, when it can still be cancelled, before it ships
+    FULFILLMENT_PROCESSING_TIME = 5 * 60
+    # Accounts with more order lines, orders, reviews and favorites than this are deleted by the
+    # purge job (flask users purge), USER_PURGE_CHUNK rows per transaction
+    USER_PURGE_THRESHOLD = 5000
+    USER_PURGE_CHUNK = 1000
+    # Seconds a Running purge may go without committing a chunk before another worker takes it
+    # over, and how many times a job is run in all when it fails or its worker dies
+    USER_PURGE_LEASE = 10 * 60
+    USER_PURGE_ATTEMPTS = 3
+    # Views going over their @query_budget: "raise", "warn" (logged) or None (not counted)
+    QUERY_BUDGET_MODE = "warn"
     
 
 class TestingConfig:
     SQLALCHEMY_DATABASE_URI = 'sqlite:///testing_book_store_app.db'
     DEBUG = True
     CACHE_TYPE = "SimpleCache"
-    CACHE_DEFAULT_TIMEOUT = 200
+    CACHE_DEFAULT_TIMEOUT = 0
+    CACHE_MAX_BYTES = 1024 * 1024
+    CACHE_LOCAL_TIMEOUT = 0
+    CACHE_STOCK_TIMEOUT = 30
     TESTING = True
+    PAGE_SIZE_DEFAULT = 20
+    PAGE_SIZE_MAX = 100
+    IMPORT_CHUNK_SIZE = 1000
+    RATES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rates.json")
+    # Seconds a book added to a cart stays held for it
+    RESERVATION_TTL = 900
+    RESERVATION_SWEEP_BATCH = 500
+    # Seconds a response is replayed for a retried Idempotency-Key
+    IDEMPOTENCY_TTL = 24 * 60 * 60
+    # Seconds before the claim of a request that never finished can be taken over
+    IDEMPOTENCY_LOCK_TIMEOUT = 60
+    # Seconds a concurrent duplicate waits for the first request before answering 409
+    IDEMPOTENCY_WAIT = 10
+    CART_STORE = "database"
+    CART_STORE_PATH = "testing_carts.db"
+    # No background flusher, tests flush the cart store themselves
+    CART_FLUSH_INTERVAL = 0
+    CART_FLUSH_BATCH = 200
+    JWT_BACKEND = "jose"
+    TOKEN_CACHE_SIZE = 10000
+    # Cheap and inline, the tests sign in a lot
+    PASSWORD_HASH_METHOD = "pbkdf2:sha256:1000"
+    PASSWORD_HASH_WORKERS = 0
+    PASSWORD_HASH_QUEUE = 32
+    PASSWORD_HASH_WAIT = 2
+    FULFILLMENT_WORKERS = 2
+    FULFILLMENT_BATCH = 100
+    FULFILLMENT_INTERVAL = 5
+    FULFILLMENT_PROCESSING_TIME = 0
+    USER_PURGE_THRESHOLD = 5000
+    USER_PURGE_CHUNK = 1000
+    USER_PURGE_LEASE = 10 * 60
+    USER_PURGE_ATTEMPTS = 3
+    QUERY_BUDGET_MODE = "raise"
 
 
 class ProductionConfig:
     SQLALCHEMY_DATABASE_URI = os.environ.get('SQLALCHEMY_DATABASE_URI') or 'sqlite:///book_store_app.db'
-    CACHE_TYPE = "SimpleCache"
+    # Every gunicorn worker has its own SimpleCache, use RedisCache when running more than one;
+    # until then CACHE_LOCAL_TIMEOUT keeps the other workers' entries from going stale for good
+    CACHE_TYPE = os.environ.get('CACHE_TYPE') or "SimpleCache"
+    CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL')
+    CACHE_DEFAULT_TIMEOUT = 0
+    CACHE_MAX_BYTES = 64 * 1024 * 1024
+    CACHE_LOCAL_TIMEOUT = 60
+    CACHE_STOCK_TIMEOUT = 30
+    PAGE_SIZE_DEFAULT = 20
+    PAGE_SIZE_MAX = 100
+    IMPORT_CHUNK_SIZE = 1000
+    RATES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rates.json")
+    # Seconds a book added to a cart stays held for it
+    RESERVATION_TTL = 900
+    RESERVATION_SWEEP_BATCH = 500
+    # Seconds a response is replayed for a retried Idempotency-Key
+    IDEMPOTENCY_TTL = 24 * 60 * 60
+    # Seconds before the claim of a request that never finished can be taken over
+    IDEMPOTENCY_LOCK_TIMEOUT = 60
+    # Seconds a concurrent duplicate waits for the first request before answering 409
+    IDEMPOTENCY_WAIT = 10
+    CART_STORE = os.environ.get('CART_STORE') or "database"
+    CART_STORE_PATH = "carts.db"
+    CART_FLUSH_INTERVAL = 5
+    CART_FLUSH_BATCH = 200
+    JWT_BACKEND = "jose"
+    TOKEN_CACHE_SIZE = 10000
+    PASSWORD_HASH_METHOD = "scrypt:32768:8:1"
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or 2)
+    PASSWORD_HASH_QUEUE = 32
+    PASSWORD_HASH_WAIT = 2
+    FULFILLMENT_WORKERS = 2
+    FULFILLMENT_BATCH = 100
+    FULFILLMENT_INTERVAL = 5
+    FULFILLMENT_PROCESSING_TIME = 5 * 60
+    USER_PURGE_THRESHOLD = 5000
+    USER_PURGE_CHUNK = 1000
+    USER_PURGE_LEASE = 10 * 60
+    USER_PURGE_ATTEMPTS = 3
+    QUERY_BUDGET_MODE = None
\ No newline at end of file
@@ -1,5 +1,7 @@
 from app import create_app
 from app.models import db
+from app.utils.migrations import upgrade_database
+from app.utils.search import search
 
 
 # Create app
@@ -11,6 +13,10 @@ with app.app_context():
     # db.drop_all()
     # Create all tables from models
     db.create_all()
+    # Add new columns and indexes to a database created by an older version
+    upgrade_database()
+    # Create and fill the full-text index if this database doesn't have one yet
+    search.ensure_index()
 
 # Run the app
 # app.run()
\ No newline at end of file
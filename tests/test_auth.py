@@ -0,0 +1,114 @@
+import importlib.util
+import time
+import unittest
+from datetime import datetime, timedelta, timezone
+from flask import request
+from jose import jwt
+from app import create_app
+from app.models import db, Users, Addresses, Payments
+from werkzeug.security import generate_password_hash
+from app.utils.auth import auth, encode_token, SECRET_KEY, current_user, ownership
+
+class TestAuth(unittest.TestCase):
+	def setUp(self):
+		self.app = create_app('TestingConfig')
+		with self.app.app_context():
+			db.drop_all()
+			db.create_all()
+			user = Users(first_name="Auth", last_name="User", email="auth@email.com", password=generate_password_hash('1234'), phone="+1234567890")
+			db.session.add(user)
+			db.session.commit()
+			self.user_id = user.id
+		self.client = self.app.test_client()
+
+	def get_cart(self, header):
+		return self.client.get("/carts", headers={"Authorization": header} if header is not None else {})
+
+	def stats(self):
+		with self.app.app_context():
+			return auth.stats()
+
+	def test_malformed_headers(self):
+		self.assertEqual(self.get_cart(None).status_code, 401)
+		# Used to crash with an IndexError
+		for header in ["Bearer", "Bearer ", encode_token(self.user_id), f"Token {encode_token(self.user_id)}", "Bearer a b"]:
+			response = self.get_cart(header)
+			self.assertEqual(response.status_code, 401, header)
+			self.assertIn("error", response.get_json())
+		self.assertEqual(self.get_cart("Bearer not.a.token").get_json(), {"message": "invalid token"})
+		self.assertEqual(self.get_cart(f"bearer  {encode_token(self.user_id)}").status_code, 200)
+
+	def test_verified_tokens_are_remembered(self):
+		header = f"Bearer {encode_token(self.user_id)}"
+		for _ in range(3):
+			self.assertEqual(self.get_cart(header).status_code, 200)
+		self.assertEqual(self.stats(), {"size": 1, "hits": 2, "misses": 1, "evictions": 0, "hit_rate": 0.6667})
+		# A forged token with the same claims is verified, not served from the cache
+		forged = jwt.encode({"sub": str(self.user_id), "exp": datetime.now(timezone.utc) + timedelta(hours=1)}, "another key", algorithm="HS256")
+		self.assertEqual(self.get_cart(f"Bearer {forged}").status_code, 401)
+
+	def test_remembered_until_expiry(self):
+		token = jwt.encode({"sub": str(self.user_id), "exp": datetime.now(timezone.utc) + timedelta(seconds=1)}, SECRET_KEY, algorithm="HS256")
+		self.assertEqual(self.get_cart(f"Bearer {token}").status_code, 200)
+		self.assertEqual(self.get_cart(f"Bearer {token}").status_code, 200)
+		# python-jose only rejects it once the whole second after exp has passed
+		time.sleep(2.1)
+		self.assertEqual(self.get_cart(f"Bearer {token}").status_code, 403)
+		self.assertEqual(self.stats()["size"], 0)
+
+	def test_bounded(self):
+		self.app.extensions["auth"]["tokens"].max_size = 2
+		for user_id in range(3):
+			self.get_cart(f"Bearer {encode_token(user_id)}")
+		self.assertEqual(self.stats()["size"], 2)
+		self.assertEqual(self.stats()["evictions"], 1)
+
+	def test_cache_disabled(self):
+		self.app.config["TOKEN_CACHE_SIZE"] = 0
+		auth.init_app(self.app)
+		header = f"Bearer {encode_token(self.user_id)}"
+		self.get_cart(header)
+		self.get_cart(header)
+		self.assertEqual(self.stats()["hit_rate"], None)
+
+	def test_unknown_backend(self):
+		self.app.config["JWT_BACKEND"] = "nope"
+		with self.assertRaises(ValueError):
+			auth.init_app(self.app)
+
+	@unittest.skipUnless(importlib.util.find_spec("jwt"), "PyJWT is not installed")
+	def test_pyjwt_backend(self):
+		self.app.config["JWT_BACKEND"] = "pyjwt"
+		auth.init_app(self.app)
+		self.assertEqual(self.get_cart(f"Bearer {encode_token(self.user_id)}").status_code, 200)
+		self.assertEqual(self.get_cart("Bearer not.a.token").status_code, 401)
+
+	def test_current_user_loaded_once(self):
+		with self.app.test_request_context():
+			request.user_id = str(self.user_id)
+			user = current_user()
+			self.assertEqual(user.id, self.user_id)
+			# Served from the request from then on, even when the row changes under it
+			db.session.expunge(user)
+			self.assertIs(current_user(), user)
+
+	def test_ownership(self):
+		with self.app.app_context():
+			other = Users(first_name="Other", last_name="User", email="other@email.com", password=generate_password_hash('1234'), phone="+1234567891")
+			address = Addresses(line1="1 Main St", city="Austin", state="TX", zipcode="73301", country="US")
+			db.session.add_all([other, address])
+			db.session.flush()
+			user = db.session.get(Users, self.user_id)
+			user.addresses.append(address)
+			payment = Payments(user_id=other.id, card_number="4111111111111111", cvv=123, expiry_month=12, expiry_year=2030)
+			db.session.add(payment)
+			db.session.commit()
+			self.assertEqual(tuple(ownership(Addresses, address.id, self.user_id)), (True, True, True))
+			self.assertEqual(tuple(ownership(Addresses, address.id, other.id)), (True, True, False))
+			self.assertEqual(tuple(ownership(Payments, payment.id, other.id)), (True, True, True))
+			self.assertEqual(tuple(ownership(Payments, payment.id, self.user_id)), (True, True, False))
+			self.assertEqual(tuple(ownership(Payments, payment.id + 1, self.user_id)), (True, False, False))
+			self.assertEqual(tuple(ownership(Payments, payment.id, 999)), (False, True, False))
+
+if __name__ == "__main__":
+	unittest.main()
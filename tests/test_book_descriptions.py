@@ -1,6 +1,17 @@
 import unittest
+import json
+import os
+import tempfile
+import gzip
+from datetime import timedelta
+from sqlalchemy import update
 from app import create_app
-from app.models import db, Book_descriptions
+from app.models import db, Book_descriptions, Categories
+from app.utils.query_budget import count_queries
+from app.utils.migrations import upgrade_database
+from app.blueprints.book_descriptions.routes import CATALOG_QUERY_BUDGET
+from app.utils.search import search, MemorySearch
+from app.blueprints.book_descriptions.schemas import book_options
 
 class TestBookDescriptions(unittest.TestCase):
 	def setUp(self):
@@ -37,9 +48,59 @@ class TestBookDescriptions(unittest.TestCase):
 		response = self.client.get("/book_descriptions")
 		self.assertEqual(response.status_code, 200)
 		data = response.get_json()
-		self.assertIsInstance(data, list)
-		self.assertGreaterEqual(len(data), 1)
-		self.assertIn("title", data[0])
+		self.assertIsInstance(data["data"], list)
+		self.assertGreaterEqual(len(data["data"]), 1)
+		self.assertIn("title", data["data"][0])
+		self.assertIsNone(data["next_cursor"])
+
+	def test_get_book_descriptions_pagination(self):
+		with self.app.app_context():
+			for i, price in enumerate([30.0, 20.0, 20.0, 40.0]):
+				db.session.add(Book_descriptions(title=f"Page{i}", subtitle="Sub", author="Author", publisher="Pub", published_date=f"202{i}-01-01", description="Desc", isbn=f"99900000000{i}", image_link="img", language="EN", price=price, stock_quantity=1, averageRating=4.0, ratingsCount=1))
+			db.session.commit()
+		# Walk every page sorted by price descending
+		prices, cursor = [], None
+		while True:
+			url = "/book_descriptions?sort=-price&limit=2" + (f"&after={cursor}" if cursor else "")
+			data = self.client.get(url).get_json()
+			self.assertLessEqual(len(data["data"]), 2)
+			prices += [book["price"] for book in data["data"]]
+			cursor = data["next_cursor"]
+			if not cursor:
+				break
+		self.assertEqual(prices, [40.0, 30.0, 20.0, 20.0, 10.0])
+		# Page size is capped, below the 5 books seeded so the cap is what stops the page
+		self.app.config["PAGE_SIZE_MAX"] = 3
+		response_cap = self.client.get("/book_descriptions?limit=1000")
+		self.assertEqual(len(response_cap.get_json()["data"]), 3)
+		# Unknown sort and broken cursor
+		self.assertEqual(self.client.get("/book_descriptions?sort=title").status_code, 400)
+		self.assertEqual(self.client.get("/book_descriptions?after=notacursor").status_code, 400)
+		self.assertEqual(self.client.get("/book_descriptions?limit=0").status_code, 400)
+
+	def test_get_book_descriptions_fields(self):
+		# Only the picked columns are selected and sent, the id always is
+		with self.app.app_context(), count_queries() as queries:
+			response = self.client.get("/book_descriptions?fields=title,price&facets=false")
+		self.assertEqual(set(response.get_json()["data"][0]), {"id", "title", "price"})
+		self.assertNotIn("book_descriptions.description", queries.statements[0])
+		response_exclude = self.client.get("/book_descriptions?exclude=description,image_link")
+		book = response_exclude.get_json()["data"][0]
+		self.assertNotIn("description", book)
+		self.assertIn("isbn", book)
+		response_single = self.client.get(f"/book_descriptions/{self.book_id}?fields=title")
+		self.assertEqual(response_single.get_json()["data"], {"id": self.book_id, "title": "Book1"})
+		# Each field set is its own representation
+		self.assertNotEqual(response_single.headers["ETag"], self.client.get(f"/book_descriptions/{self.book_id}").headers["ETag"])
+		with self.app.app_context():
+			search.rebuild()
+		response_search = self.client.get("/book_descriptions/search?q=book1&fields=title")
+		self.assertEqual(response_search.get_json()["data"][0]["book"], {"id": self.book_id, "title": "Book1"})
+		self.assertEqual(set(response_search.get_json()["data"][0]["highlights"]), {"title"})
+		# Unknown fields, or both parameters
+		self.assertEqual(self.client.get("/book_descriptions?fields=title,nope").status_code, 400)
+		self.assertEqual(self.client.get("/book_descriptions?fields=title&exclude=price").status_code, 400)
+		self.assertEqual(self.client.get(f"/book_descriptions/{self.book_id}?exclude=nope").status_code, 400)
 
 	def test_get_single_book_description(self):
 		url = f"/book_descriptions/{self.book_id}"
@@ -90,3 +151,188 @@ class TestBookDescriptions(unittest.TestCase):
 		response2 = self.client.delete(url)
 		self.assertEqual(response2.status_code, 404)
 		self.assertIn("error", response2.get_json())
+
+	def test_search_book_descriptions(self):
+		payload = {"title": "The Hobbit", "subtitle": "There and Back Again", "author": "Tolkien", "publisher": "Allen", "published_date": "1937-09-21", "description": "A hobbit goes on an adventure with dwarves", "isbn": "9780000000001", "image_link": "img", "language": "EN", "price": 15.0, "stock_quantity": 5, "averageRating": 4.8, "ratingsCount": 2}
+		book_id = self.client.post("/book_descriptions", json=payload).get_json()["id"]
+		# Prefix match on the last term, highlighted
+		response = self.client.get("/book_descriptions/search?q=hobb")
+		self.assertEqual(response.status_code, 200)
+		data = response.get_json()["data"]
+		self.assertEqual(len(data), 1)
+		self.assertEqual(data[0]["book"]["id"], book_id)
+		self.assertIn("<mark>Hobbit</mark>", data[0]["highlights"]["title"])
+		# Every term has to match
+		self.assertEqual(self.client.get("/book_descriptions/search?q=tolkien dwarves").get_json()["data"][0]["book"]["id"], book_id)
+		self.assertEqual(self.client.get("/book_descriptions/search?q=tolkien book1").get_json()["data"], [])
+		# Updates and deletes keep the index in sync
+		payload["title"] = "The Silmarillion"
+		self.client.put(f"/book_descriptions/{book_id}", json=payload)
+		self.assertEqual(self.client.get("/book_descriptions/search?q=silmar").get_json()["data"][0]["book"]["id"], book_id)
+		self.assertEqual(self.client.get("/book_descriptions/search?q=hobbit goes").get_json()["data"][0]["book"]["id"], book_id)
+		self.client.delete(f"/book_descriptions/{book_id}")
+		self.assertEqual(self.client.get("/book_descriptions/search?q=silmar").get_json()["data"], [])
+		# Missing query
+		self.assertEqual(self.client.get("/book_descriptions/search").status_code, 400)
+
+	def test_search_memory_backend(self):
+		with self.app.app_context():
+			self.app.extensions["book_search"] = MemorySearch()
+			db.session.add(Book_descriptions(title="Python Cookbook", subtitle="Recipes", author="Beazley", publisher="Pub", published_date="2013-01-01", description="Python recipes", isbn="9780000000002", image_link="img", language="EN", price=10.0, stock_quantity=1, averageRating=4.0, ratingsCount=1))
+			db.session.add(Book_descriptions(title="Cooking", subtitle="Food", author="Chef", publisher="Pub", published_date="2013-01-01", description="Not about python at all", isbn="9780000000003", image_link="img", language="EN", price=10.0, stock_quantity=1, averageRating=4.0, ratingsCount=1))
+			db.session.commit()
+			results = search.search("python coo", 10)
+			# Title matches outrank description matches
+			self.assertEqual([book.title for book, score, highlights in results], ["Python Cookbook", "Cooking"])
+			self.assertEqual(results[0][2]["title"], "<mark>Python</mark> <mark>Cookbook</mark>")
+			# Columns the options leave out are not highlighted
+			db.session.expunge_all()
+			trimmed = search.search("python", 10, options=book_options(frozenset({"id", "title"})))
+			self.assertEqual(set(trimmed[0][2]), {"title"})
+			# Writes reach the index when they commit, not when they roll back
+			search.remove_book(results[0][0].id)
+			db.session.rollback()
+			self.assertEqual(len(search.search("python", 10)), 2)
+			search.remove_book(results[0][0].id)
+			db.session.commit()
+			self.assertEqual(len(search.search("python", 10)), 1)
+			book = Book_descriptions(title="Python Tricks", subtitle="Tips", author="Bader", publisher="Pub", published_date="2017-01-01", description="Tips", isbn="9780000000004", image_link="img", language="EN", price=10.0, stock_quantity=1, averageRating=4.0, ratingsCount=1)
+			db.session.add(book)
+			db.session.flush()
+			search.index_book(book)
+			db.session.rollback()
+			self.assertEqual(len(search.search("python", 10)), 1)
+
+	def test_search_highlights_are_escaped(self):
+		payload = {"title": "<script>alert(1)</script> Dune", "subtitle": "<b>Sub</b>", "author": "Herbert & Co", "publisher": "Chilton", "published_date": "1965-08-01", "description": "Dune <img src=x onerror=alert(1)> desert", "isbn": "9780000000005", "image_link": "img", "language": "EN", "price": 15.0, "stock_quantity": 5, "averageRating": 4.8, "ratingsCount": 2}
+		self.client.post("/book_descriptions", json=payload)
+		highlights = self.client.get("/book_descriptions/search?q=dune").get_json()["data"][0]["highlights"]
+		self.assertEqual(highlights["title"], "&lt;script&gt;alert(1)&lt;/script&gt; <mark>Dune</mark>")
+		self.assertNotIn("<img", highlights["description"])
+		self.assertIn("<mark>Dune</mark>", highlights["description"])
+		with self.app.app_context():
+			self.app.extensions["book_search"] = MemorySearch()
+			book, score, highlights = search.search("dune", 10)[0]
+		self.assertEqual(highlights["title"], "&lt;script&gt;alert(1)&lt;/script&gt; <mark>Dune</mark>")
+		self.assertEqual(highlights["author"], "Herbert &amp; Co")
+		self.assertNotIn("<img", highlights["description"])
+
+	def test_get_book_descriptions_filters_and_facets(self):
+		with self.app.app_context():
+			fiction = Categories(title="Fiction")
+			science = Categories(title="Science")
+			books = [
+				Book_descriptions(title="Novel", subtitle="Sub", author="Author", publisher="Pub", published_date="2020-01-01", description="Desc", isbn="9990000000010", image_link="img", language="EN", price=25.0, stock_quantity=0, averageRating=4.5, ratingsCount=1),
+				Book_descriptions(title="Roman", subtitle="Sub", author="Author", publisher="Pub", published_date="2020-01-01", description="Desc", isbn="9990000000011", image_link="img", language="FR", price=30.0, stock_quantity=3, averageRating=3.0, ratingsCount=1),
+			]
+			books[0].categories.append(fiction)
+			books[1].categories.extend([fiction, science])
+			db.session.add_all(books)
+			db.session.commit()
+			fiction_id, science_id = fiction.id, science.id
+		data = self.client.get(f"/book_descriptions?category={fiction_id}&facets=true").get_json()
+		self.assertEqual(sorted(book["title"] for book in data["data"]), ["Novel", "Roman"])
+		self.assertEqual(data["facets"]["categories"], [{"id": fiction_id, "title": "Fiction", "count": 2}, {"id": science_id, "title": "Science", "count": 1}])
+		self.assertEqual(data["facets"]["languages"], [{"language": "EN", "count": 1}, {"language": "FR", "count": 1}])
+		data = self.client.get("/book_descriptions?language=EN&min_price=20&max_price=26").get_json()
+		self.assertEqual([book["title"] for book in data["data"]], ["Novel"])
+		data = self.client.get(f"/book_descriptions?category={fiction_id}&in_stock=true&min_rating=2").get_json()
+		self.assertEqual([book["title"] for book in data["data"]], ["Roman"])
+		self.assertNotIn("facets", self.client.get("/book_descriptions").get_json())
+		self.assertEqual(self.client.get("/book_descriptions?category=abc").status_code, 400)
+		self.assertEqual(self.client.get("/book_descriptions?min_price=cheap").status_code, 400)
+		# Page plus one query per facet, whatever the filters
+		with self.app.app_context():
+			with count_queries() as counter:
+				self.client.get(f"/book_descriptions?category={fiction_id},{science_id}&language=EN,FR&min_price=1&in_stock=1&sort=-price&facets=true")
+			self.assertGreater(counter.count, 0)
+			self.assertLessEqual(counter.count, CATALOG_QUERY_BUDGET)
+
+	def test_get_single_book_description_etag(self):
+		url = f"/book_descriptions/{self.book_id}"
+		response = self.client.get(url)
+		etag = response.headers["ETag"]
+		self.assertIn("no-cache", response.headers["Cache-Control"])
+		self.assertIn("Last-Modified", response.headers)
+		# Unchanged: 304 without a body, decided by a single aggregate query
+		with self.app.app_context():
+			with count_queries() as counter:
+				response_nm = self.client.get(url, headers={"If-None-Match": etag})
+			self.assertEqual(counter.count, 1)
+		self.assertEqual(response_nm.status_code, 304)
+		self.assertEqual(response_nm.data, b"")
+		self.assertEqual(response_nm.headers["ETag"], etag)
+		# Adding a category changes the version
+		with self.app.app_context():
+			category = Categories(title="Fiction")
+			db.session.add(category)
+			db.session.commit()
+			category_id = category.id
+		self.client.put(f"/book_descriptions/{self.book_id}/add_category/{category_id}")
+		response_changed = self.client.get(url, headers={"If-None-Match": etag})
+		self.assertEqual(response_changed.status_code, 200)
+		self.assertNotEqual(response_changed.headers["ETag"], etag)
+		# Not found is not conditional
+		self.assertEqual(self.client.get("/book_descriptions/9999", headers={"If-None-Match": etag}).status_code, 404)
+
+	def test_import_book_descriptions(self):
+		book = {"title": "Imported", "subtitle": "Sub", "author": "Feed Author", "publisher": "Pub", "published_date": "2021-01-01", "description": "Desc", "image_link": "img", "language": "EN", "averageRating": 4.0, "ratingsCount": 2}
+		lines = [
+			json.dumps({**book, "isbn": "5550000000001"}),
+			json.dumps({**book, "isbn": "5550000000002", "price": 19.5}),
+			"not json",
+			json.dumps({"title": "No isbn"}),
+			json.dumps({**book, "isbn": "5550000000001"}),
+			json.dumps({**book, "isbn": "1234567890123", "title": "Already there"}),
+		]
+		self.app.config["IMPORT_CHUNK_SIZE"] = 4
+		response = self.client.post("/book_descriptions/import", data="\n".join(lines), content_type="application/x-ndjson")
+		self.assertEqual(response.status_code, 200)
+		events = [json.loads(line) for line in response.data.decode().splitlines()]
+		self.assertEqual([event["line"] for event in events if event["type"] == "error"], [3, 4])
+		self.assertEqual(len([event for event in events if event["type"] == "progress"]), 2)
+		self.assertEqual(events[-1], {"type": "summary", "processed": 6, "inserted": 2, "updated": 0, "skipped": 2, "failed": 2})
+		with self.app.app_context():
+			self.assertEqual(db.session.query(Book_descriptions).count(), 3)
+			self.assertEqual(db.session.query(Book_descriptions).where(Book_descriptions.isbn == "1234567890123").one().title, "Book1")
+		self.assertEqual(len(self.client.get("/book_descriptions/search?q=feed").get_json()["data"]), 2)
+		# CSV with upserts
+		csv_feed = "title,subtitle,author,publisher,published_date,description,isbn,image_link,language,averageRating,ratingsCount,page_count\n"
+		csv_feed += "Renamed,Sub,Author,Pub,2020-01-01,Desc,1234567890123,img,EN,5.0,1,\n"
+		response = self.client.post("/book_descriptions/import?on_conflict=update", data=csv_feed, content_type="text/csv")
+		self.assertEqual(json.loads(response.data.decode().splitlines()[-1])["updated"], 1)
+		self.assertEqual(self.client.get(f"/book_descriptions/{self.book_id}").get_json()["data"]["title"], "Renamed")
+		self.assertEqual(self.client.post("/book_descriptions/import?format=xml", data="").status_code, 400)
+
+	def test_import_book_descriptions_command(self):
+		path = os.path.join(tempfile.mkdtemp(), "feed.jsonl")
+		with open(path, "w") as feed:
+			feed.write(json.dumps({"title": "Cli", "subtitle": "Sub", "author": "A", "publisher": "P", "published_date": "2021", "description": "D", "isbn": "5550000000009", "image_link": "img", "language": "EN", "averageRating": 4.0, "ratingsCount": 2}))
+		result = self.app.test_cli_runner().invoke(args=["books", "import", path])
+		self.assertIn("summary: 1 rows, 1 inserted", result.output)
+
+	def test_export_book_descriptions(self):
+		response = self.client.get("/book_descriptions/export")
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(response.mimetype, "application/x-ndjson")
+		records = [json.loads(line) for line in response.data.decode().splitlines()]
+		self.assertEqual([record["id"] for record in records], [self.book_id])
+		# Incremental pull
+		with self.app.app_context():
+			since = db.session.get(Book_descriptions, self.book_id).updated_at + timedelta(seconds=1)
+		self.assertEqual(self.client.get(f"/book_descriptions/export?since={since.isoformat()}").data, b"")
+		self.assertEqual(self.client.get("/book_descriptions/export?since=yesterday").status_code, 400)
+		# Gzipped on the fly when accepted
+		response_gz = self.client.get("/book_descriptions/export", headers={"Accept-Encoding": "gzip"})
+		self.assertEqual(response_gz.headers["Content-Encoding"], "gzip")
+		self.assertEqual(json.loads(gzip.decompress(response_gz.data))["id"], self.book_id)
+
+	def test_export_since_after_upgrade(self):
+		# Rows from before updated_at existed are dated by the upgrade, so an incremental pull sees them
+		with self.app.app_context():
+			since = db.session.get(Book_descriptions, self.book_id).updated_at
+			db.session.execute(update(Book_descriptions).values(updated_at=None))
+			db.session.commit()
+			upgrade_database()
+		records = self.client.get(f"/book_descriptions/export?since={since.isoformat()}").data.decode().splitlines()
+		self.assertEqual([json.loads(line)["id"] for line in records], [self.book_id])
@@ -1,4 +1,6 @@
 import unittest
+import json
+from datetime import datetime
 from app import create_app
 from app.models import db, Users, Reviews, Book_descriptions
 from werkzeug.security import generate_password_hash
@@ -37,9 +39,13 @@ class TestBookReviews(unittest.TestCase):
 		headers = {"Authorization": f"Bearer {self.token}"}
 		url = f"/reviews/{self.book_id}"
 		payload = {"rating": 4.5, "comment": "Great book!"}
+		before = datetime.now()
 		response = self.client.post(url, json=payload, headers=headers)
 		self.assertEqual(response.status_code, 201)
 		self.assertIn("rating", response.get_json())
+		# Dated when written, not when the models were imported
+		with self.app.app_context():
+			self.assertGreaterEqual(db.session.get(Reviews, response.get_json()["id"]).created_at, before)
 		# Duplicate review
 		response_dup = self.client.post(url, json=payload, headers=headers)
 		self.assertEqual(response_dup.status_code, 400)
@@ -67,6 +73,30 @@ class TestBookReviews(unittest.TestCase):
 		response_nf = self.client.get("/reviews/book/9999")
 		self.assertEqual(response_nf.status_code, 404)
 
+	def test_get_reviews_by_book_etag(self):
+		headers = {"Authorization": f"Bearer {self.token}"}
+		url = f"/reviews/book/{self.book2_id}"
+		etag = self.client.get(url).headers["ETag"]
+		self.assertEqual(self.client.get(url, headers={"If-None-Match": etag}).status_code, 304)
+		# Editing the review changes the version
+		self.client.put(f"/reviews/{self.review_id}", json={"rating": 3.0, "comment": "Changed my mind"}, headers=headers)
+		response = self.client.get(url, headers={"If-None-Match": etag})
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(response.get_json()["reviews"][0]["comment"], "Changed my mind")
+		etag = response.headers["ETag"]
+		# So does renaming the reviewer
+		self.client.put("/users", json={"first_name": "Renamed", "last_name": "User", "email": "reviewtest@email.com", "password": "1234", "phone": "+1234567890"}, headers=headers)
+		response = self.client.get(url, headers={"If-None-Match": etag})
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(response.get_json()["reviews"][0]["user"]["first_name"], "Renamed")
+
+	def test_export_reviews(self):
+		response = self.client.get("/reviews/export")
+		self.assertEqual(response.status_code, 200)
+		records = [json.loads(line) for line in response.data.decode().splitlines()]
+		self.assertEqual([record["id"] for record in records], [self.review_id])
+		self.assertEqual(self.client.get("/reviews/export?since=2999-01-01").data, b"")
+
 	def test_get_all_reviews(self):
 		response = self.client.get("/reviews/all")
 		self.assertEqual(response.status_code, 200)
@@ -0,0 +1,89 @@
+import unittest
+from unittest import mock
+from app import create_app
+from app.models import db, Categories, Book_descriptions, Users
+from app.utils.cache import LRUBackend, cache
+from app.utils.auth import encode_token
+from werkzeug.security import generate_password_hash
+
+class TestCache(unittest.TestCase):
+	def setUp(self):
+		self.app = create_app('TestingConfig')
+		with self.app.app_context():
+			db.drop_all()
+			db.create_all()
+			self.category = Categories(title="Fiction")
+			db.session.add(self.category)
+			db.session.commit()
+			self.category_id = self.category.id
+		self.client = self.app.test_client()
+
+	def test_read_is_cached_until_a_write(self):
+		self.assertEqual(len(self.client.get("/categories").get_json()), 1)
+		# A change that bypasses the write routes is not seen...
+		with self.app.app_context():
+			db.session.add(Categories(title="Hidden"))
+			db.session.commit()
+		self.assertEqual(len(self.client.get("/categories").get_json()), 1)
+		# ...until a write route invalidates the tag
+		self.client.post("/categories", json={"title": "Science"})
+		self.assertEqual(len(self.client.get("/categories").get_json()), 3)
+		# Query strings are cached separately
+		self.assertEqual(self.client.get("/book_descriptions?limit=5").get_json()["data"], [])
+
+	def test_category_write_invalidates_book_detail(self):
+		with self.app.app_context():
+			book = Book_descriptions(title="Book1", subtitle="Sub1", author="Author1", publisher="Pub1", published_date="2020-01-01", description="Desc", isbn="1234567890123", image_link="img", language="EN", price=10.0, stock_quantity=10, averageRating=5.0, ratingsCount=1)
+			book.categories.append(db.session.get(Categories, self.category_id))
+			db.session.add(book)
+			db.session.commit()
+			book_id = book.id
+		self.assertEqual(self.client.get(f"/book_descriptions/{book_id}").get_json()["categories"][0]["title"], "Fiction")
+		self.client.put(f"/categories/{self.category_id}", json={"title": "Fantasy"})
+		self.assertEqual(self.client.get(f"/book_descriptions/{book_id}").get_json()["categories"][0]["title"], "Fantasy")
+
+	def test_cart_hold_only_drops_the_book_views(self):
+		with self.app.app_context():
+			user = Users(first_name="Cart", last_name="User", email="cart@email.com", password=generate_password_hash('1234'), phone="+1234567890")
+			book = Book_descriptions(title="Book1", subtitle="Sub1", author="Author1", publisher="Pub1", published_date="2020-01-01", description="Desc", isbn="1234567890123", image_link="img", language="EN", price=10.0, stock_quantity=10, averageRating=5.0, ratingsCount=1)
+			db.session.add_all([user, book])
+			db.session.commit()
+			user_id, book_id = user.id, book.id
+			versions = cache.backend.get_versions(["books"])
+		self.assertEqual(self.client.get("/book_descriptions").get_json()["data"][0]["stock_quantity"], 10)
+		self.assertEqual(self.client.get(f"/book_descriptions/{book_id}").get_json()["data"]["stock_quantity"], 10)
+		response = self.client.put(f"/carts/add_book/{book_id}", headers={"Authorization": f"Bearer {encode_token(user_id)}"})
+		self.assertEqual(response.status_code, 200)
+		# The book's own view is fresh, the catalog keeps its entries until CACHE_STOCK_TIMEOUT
+		self.assertEqual(self.client.get(f"/book_descriptions/{book_id}").get_json()["data"]["stock_quantity"], 9)
+		self.assertEqual(self.client.get("/book_descriptions").get_json()["data"][0]["stock_quantity"], 10)
+		with self.app.app_context():
+			self.assertEqual(cache.backend.get_versions(["books"]), versions)
+
+	def test_lru_backend_evicts_by_size(self):
+		backend = LRUBackend(max_bytes=10)
+		backend.set("a", b"aaaa", 0)
+		backend.set("b", b"bbbb", 0)
+		backend.get("a")
+		backend.set("c", b"cccc", 0)
+		# "b" was the least recently used
+		self.assertIsNone(backend.get("b"))
+		self.assertEqual(backend.get("a"), b"aaaa")
+		self.assertEqual(backend.get("c"), b"cccc")
+		self.assertLessEqual(backend.size, 10)
+		# Values larger than the whole cache are not stored
+		backend.set("d", b"d" * 11, 0)
+		self.assertIsNone(backend.get("d"))
+		backend.bump(["books"])
+		self.assertEqual(backend.get_versions(["books", "reviews"]), [1, 0])
+
+	def test_lru_backend_bounds_the_timeout(self):
+		backend = LRUBackend(max_bytes=100, max_timeout=60)
+		with mock.patch("app.utils.cache.time.monotonic", return_value=1000.0):
+			backend.set("forever", b"a", 0)
+			backend.set("long", b"b", 3600)
+			backend.set("short", b"c", 30)
+		with mock.patch("app.utils.cache.time.monotonic", return_value=1045.0):
+			self.assertEqual([backend.get(key) for key in ("forever", "long", "short")], [b"a", b"b", None])
+		with mock.patch("app.utils.cache.time.monotonic", return_value=1061.0):
+			self.assertEqual([backend.get(key) for key in ("forever", "long")], [None, None])
@@ -0,0 +1,86 @@
+import os
+import unittest
+from app import create_app
+from app.models import db, Users, Carts, Cart_books, Addresses, Payments, Book_descriptions
+from app.utils.cart_store import cart_store, SqliteBackend
+from werkzeug.security import generate_password_hash
+from app.utils.auth import encode_token
+
+class TestCartStore(unittest.TestCase):
+	cart_store_type = "memory"
+
+	def setUp(self):
+		self.app = create_app('TestingConfig')
+		self.app.config["CART_STORE"] = self.cart_store_type
+		self.path = os.path.join(self.app.instance_path, self.app.config["CART_STORE_PATH"])
+		cart_store.init_app(self.app)
+		with self.app.app_context():
+			db.drop_all()
+			db.create_all()
+			user = Users(first_name="Store", last_name="User", email="store@email.com", password=generate_password_hash('1234'), phone="+1234567890")
+			book = Book_descriptions(title="Book1", subtitle="Sub1", author="Author1", publisher="Pub1", published_date="2020-01-01", description="Desc", isbn="1234567890123", image_link="img", language="EN", price=10.0, stock_quantity=10, averageRating=5.0, ratingsCount=1)
+			db.session.add_all([user, book])
+			db.session.commit()
+			address = Addresses(line1="123 Main St", city="TestCity", state="TS", country="TestLand", zipcode="12345")
+			address.users.append(user)
+			db.session.add(address)
+			payment = Payments(user_id=user.id, card_number="4111111111111111", cvv=123, expiry_month=1, expiry_year=2030)
+			db.session.add(payment)
+			db.session.commit()
+			self.user_id, self.book_id, self.address_id, self.payment_id = user.id, book.id, address.id, payment.id
+		self.client = self.app.test_client()
+		self.headers = {"Authorization": f"Bearer {encode_token(self.user_id)}"}
+
+	def tearDown(self):
+		for suffix in ("", "-wal", "-shm"):
+			if os.path.exists(self.path + suffix):
+				os.remove(self.path + suffix)
+
+	def cart_books(self):
+		with self.app.app_context():
+			return [(line.book_description_id, line.quantity) for line in db.session.query(Cart_books)]
+
+	def test_edits_are_written_behind(self):
+		url = f"/carts/add_book/{self.book_id}"
+		self.client.put(url, headers=self.headers)
+		self.client.put(url, headers=self.headers)
+		# Read from the store, not written yet; the stock is held right away
+		self.assertEqual(self.client.get("/carts", headers=self.headers).get_json()["cart_books"][0]["quantity"], 2)
+		self.assertEqual(self.client.get("/users/carts", headers=self.headers).get_json()["user_cart"]["cart_books"][0]["quantity"], 2)
+		self.assertEqual(self.cart_books(), [])
+		with self.app.app_context():
+			self.assertEqual(db.session.get(Book_descriptions, self.book_id).stock_quantity, 8)
+			self.assertEqual(cart_store.flush(), 1)
+			self.assertEqual(cart_store.flush(), 0)
+		self.assertEqual(self.cart_books(), [(self.book_id, 2)])
+		self.assertEqual(self.client.put(f"/carts/remove_book/{self.book_id}", headers=self.headers).get_json()["message"], "The book quantity decreased")
+		self.assertEqual(self.cart_books(), [(self.book_id, 2)])
+		response = self.client.patch("/carts", json={"items": [{"book_description_id": self.book_id, "quantity": 2}]}, headers=self.headers)
+		self.assertEqual(response.get_json()["cart_books"], [{"book_description_id": self.book_id, "quantity": 3}])
+		self.assertEqual(self.client.put("/carts/remove_book/9999", headers=self.headers).status_code, 404)
+
+	def test_checkout_flushes_the_cart(self):
+		self.client.put(f"/carts/add_book/{self.book_id}", headers=self.headers)
+		with self.app.app_context():
+			cart_id = db.session.query(Carts).one().id
+			cart_store.flush()
+		# Not flushed yet when the order is placed
+		self.client.put(f"/carts/add_book/{self.book_id}", headers=self.headers)
+		response = self.client.post(f"/orders/{cart_id}/address/{self.address_id}/payment/{self.payment_id}", json={"shipping_method": "InStore"}, headers=self.headers)
+		self.assertEqual(response.status_code, 201)
+		self.assertEqual(response.get_json()["order_books"][0]["quantity"], 2)
+		with self.app.app_context():
+			self.assertEqual(db.session.get(Book_descriptions, self.book_id).stock_quantity, 8)
+			self.assertIsNone(cart_store.get(self.user_id))
+		self.assertEqual(self.client.get("/carts", headers=self.headers).get_json()["message"], "There is no cart for you")
+
+class TestSqliteCartStore(TestCartStore):
+	cart_store_type = "sqlite"
+
+	def test_edits_survive_a_worker_crash(self):
+		self.client.put(f"/carts/add_book/{self.book_id}", headers=self.headers)
+		# Another worker opening the file finds the cart still to flush
+		with self.app.app_context():
+			self.app.extensions["cart_store"]["backend"] = SqliteBackend(self.path)
+			self.assertEqual(cart_store.flush(), 1)
+		self.assertEqual(self.cart_books(), [(self.book_id, 1)])
@@ -1,6 +1,10 @@
 import unittest
 from app import create_app
-from app.models import db, Users, Carts, Cart_books, Book_descriptions
+from datetime import datetime, timedelta
+from app.models import db, Users, Cart_books, Book_descriptions, Reservations, Addresses
+from app.blueprints.carts.reservations import sweep_expired
+from app.blueprints.carts.routes import add_book_to_cart, quote_cart_totals
+from app.utils.query_budget import count_queries
 from werkzeug.security import generate_password_hash
 from app.utils.auth import encode_token
 
@@ -36,6 +40,10 @@ class TestCarts(unittest.TestCase):
 		data = response2.get_json()
 		self.assertIn("cart_info", data)
 		self.assertIn("cart_books", data)
+		# Sparse book fields
+		response_fields = self.client.get("/carts?fields=title,price", headers=headers)
+		self.assertEqual(response_fields.get_json()["cart_books"][0]["book"], {"id": self.book_id, "title": "Book1", "price": 10.0})
+		self.assertEqual(self.client.get("/carts?fields=nope", headers=headers).status_code, 400)
 		# Remove book so cart is empty
 		self.client.put(f"/carts/remove_book/{self.book_id}", headers=headers)
 		response3 = self.client.get("/carts", headers=headers)
@@ -86,3 +94,101 @@ class TestCarts(unittest.TestCase):
 		# Unauthorized
 		response_unauth = self.client.put(f"/carts/remove_book/{self.book_id}")
 		self.assertEqual(response_unauth.status_code, 401)
+
+	def test_reservations(self):
+		headers = {"Authorization": f"Bearer {self.token}"}
+		url = f"/carts/add_book/{self.book_id}"
+		self.client.put(url, headers=headers)
+		self.client.put(url, headers=headers)
+		with self.app.app_context():
+			self.assertEqual(db.session.get(Book_descriptions, self.book_id).stock_quantity, 8)
+			self.assertEqual(db.session.query(Reservations).one().quantity, 2)
+		self.client.put(f"/carts/remove_book/{self.book_id}", headers=headers)
+		with self.app.app_context():
+			self.assertEqual(db.session.get(Book_descriptions, self.book_id).stock_quantity, 9)
+			self.assertEqual(db.session.query(Reservations).one().quantity, 1)
+			# Sold out: nothing is added
+			db.session.get(Book_descriptions, self.book_id).stock_quantity = 0
+			db.session.commit()
+		response = self.client.put(url, headers=headers)
+		self.assertEqual(response.status_code, 409)
+		with self.app.app_context():
+			self.assertEqual(db.session.query(Cart_books).one().quantity, 1)
+			self.assertEqual(db.session.query(Reservations).one().quantity, 1)
+
+	def test_sweep_expired_reservations(self):
+		headers = {"Authorization": f"Bearer {self.token}"}
+		self.client.put(f"/carts/add_book/{self.book_id}", headers=headers)
+		with self.app.app_context():
+			# Not expired yet
+			self.assertEqual(sweep_expired(), 0)
+			self.assertEqual(sweep_expired(batch_size=1, now=datetime.now() + timedelta(seconds=self.app.config["RESERVATION_TTL"] + 1)), 1)
+			self.assertEqual(db.session.query(Reservations).count(), 0)
+			self.assertEqual(db.session.get(Book_descriptions, self.book_id).stock_quantity, 10)
+		# The book stays in the cart, removing it doesn't give back stock twice
+		self.client.put(f"/carts/remove_book/{self.book_id}", headers=headers)
+		with self.app.app_context():
+			self.assertEqual(db.session.get(Book_descriptions, self.book_id).stock_quantity, 10)
+		result = self.app.test_cli_runner().invoke(args=["carts", "sweep-reservations"])
+		self.assertIn("0 expired reservations released.", result.output)
+
+	def test_add_book_is_one_upsert(self):
+		headers = {"Authorization": f"Bearer {self.token}"}
+		url = f"/carts/add_book/{self.book_id}"
+		self.client.put(url, headers=headers)
+		with self.app.app_context(), count_queries() as queries:
+			self.assertEqual(self.client.put(url, headers=headers).status_code, 200)
+		self.assertLessEqual(queries.count, add_book_to_cart.query_budget)
+		self.assertEqual(sum("INSERT INTO cart_books" in statement for statement in queries.statements), 1)
+		with self.app.app_context():
+			self.assertEqual(db.session.query(Cart_books).one().quantity, 2)
+
+	def test_update_cart(self):
+		headers = {"Authorization": f"Bearer {self.token}"}
+		with self.app.app_context():
+			book2 = Book_descriptions(title="Book2", subtitle="Sub2", author="Author2", publisher="Pub2", published_date="2021-01-01", description="Desc2", isbn="9876543210987", image_link="img2", language="EN", price=15.0, stock_quantity=1, averageRating=4.0, ratingsCount=2)
+			db.session.add(book2)
+			db.session.commit()
+			book2_id = book2.id
+		response = self.client.patch("/carts", json={"items": [{"book_description_id": self.book_id, "quantity": 3}, {"book_description_id": book2_id, "quantity": 1}]}, headers=headers)
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(response.get_json()["cart_books"], [{"book_description_id": self.book_id, "quantity": 3}, {"book_description_id": book2_id, "quantity": 1}])
+		response = self.client.patch("/carts", json={"items": [{"book_description_id": self.book_id, "quantity": -1}, {"book_description_id": book2_id, "quantity": -1}]}, headers=headers)
+		self.assertEqual(response.get_json()["cart_books"], [{"book_description_id": self.book_id, "quantity": 2}])
+		with self.app.app_context():
+			self.assertEqual(db.session.get(Book_descriptions, self.book_id).stock_quantity, 8)
+			self.assertEqual(db.session.get(Book_descriptions, book2_id).stock_quantity, 1)
+		# All or nothing: book2 has one copy left, so the first book isn't added either
+		response = self.client.patch("/carts", json={"items": [{"book_description_id": self.book_id, "quantity": 1}, {"book_description_id": book2_id, "quantity": 2}]}, headers=headers)
+		self.assertEqual(response.status_code, 409)
+		self.assertEqual(self.client.patch("/carts", json={"items": [{"book_description_id": 9999, "quantity": 1}]}, headers=headers).status_code, 404)
+		self.assertEqual(self.client.patch("/carts", json={"items": [{"book_description_id": book2_id, "quantity": -1}]}, headers=headers).status_code, 404)
+		self.assertEqual(self.client.patch("/carts", json={"items": [{"book_description_id": self.book_id, "quantity": 0}]}, headers=headers).status_code, 400)
+		self.assertEqual(self.client.patch("/carts", json={"items": []}, headers=headers).status_code, 400)
+		with self.app.app_context():
+			self.assertEqual(db.session.query(Cart_books).one().quantity, 2)
+			self.assertEqual(db.session.get(Book_descriptions, self.book_id).stock_quantity, 8)
+
+	def test_quote_cart(self):
+		headers = {"Authorization": f"Bearer {self.token}"}
+		self.assertEqual(self.client.get("/carts/quote", headers=headers).get_json(), {"message": "There is no cart for you"})
+		with self.app.app_context():
+			address = Addresses(line1="1 Market St", city="San Francisco", state="ca", country="USA", zipcode="94105")
+			address.users.append(db.session.get(Users, self.user_id))
+			other = Addresses(line1="2 Main St", city="Town", state="ON", country="Canada", zipcode="00000")
+			db.session.add_all([address, other])
+			db.session.commit()
+			address_id, other_id = address.id, other.id
+		self.client.patch("/carts", json={"items": [{"book_description_id": self.book_id, "quantity": 3}]}, headers=headers)
+		with self.app.app_context(), count_queries() as queries:
+			response = self.client.get(f"/carts/quote?address_id={address_id}&shipping_method=Out-for-Delivery", headers=headers)
+		self.assertEqual(response.status_code, 200)
+		data = response.get_json()
+		self.assertEqual(data["lines"], [{"book_description_id": self.book_id, "quantity": 3, "price": 10.0, "line_total": 30.0}])
+		# California rate through the USA alias, case-insensitive state
+		self.assertEqual((data["subtotal"], data["tax"], data["shipping_cost"], data["total"]), (30.0, 2.18, 5.99, 38.17))
+		self.assertLessEqual(queries.count, quote_cart_totals.query_budget)
+		# Default rate without an address
+		self.assertEqual(self.client.get("/carts/quote", headers=headers).get_json()["tax"], 2.4)
+		self.assertEqual(self.client.get(f"/carts/quote?address_id={other_id}", headers=headers).status_code, 404)
+		self.assertEqual(self.client.get("/carts/quote?shipping_method=Teleport", headers=headers).status_code, 400)
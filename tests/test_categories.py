@@ -1,6 +1,7 @@
 import unittest
 from app import create_app
-from app.models import db, Categories
+import json
+from app.models import db, Categories, Book_descriptions
 
 class TestCategories(unittest.TestCase):
 	def setUp(self):
@@ -71,3 +72,26 @@ class TestCategories(unittest.TestCase):
 		response2 = self.client.delete(url)
 		self.assertEqual(response2.status_code, 404)
 		self.assertIn("error", response2.get_json())
+
+	def test_get_categories_etag(self):
+		etag = self.client.get("/categories").headers["ETag"]
+		self.assertEqual(self.client.get("/categories", headers={"If-None-Match": etag}).status_code, 304)
+		self.client.put(f"/categories/{self.category_id}", json={"title": "Fantasy"})
+		response = self.client.get("/categories", headers={"If-None-Match": etag})
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(response.get_json()[0]["title"], "Fantasy")
+		new_etag = response.headers["ETag"]
+		self.client.delete(f"/categories/{self.category_id}")
+		self.assertEqual(self.client.get("/categories", headers={"If-None-Match": new_etag}).status_code, 200)
+
+	def test_export_categories(self):
+		with self.app.app_context():
+			book = Book_descriptions(title="Book1", subtitle="Sub1", author="Author1", publisher="Pub1", published_date="2020-01-01", description="Desc", isbn="1234567890123", image_link="img", language="EN", price=10.0, stock_quantity=10, averageRating=5.0, ratingsCount=1)
+			db.session.add(book)
+			db.session.add(Categories(title="Empty"))
+			db.session.commit()
+			book_id = book.id
+		self.client.put(f"/book_descriptions/{book_id}/add_category/{self.category_id}")
+		response = self.client.get("/categories/export")
+		records = [json.loads(line) for line in response.data.decode().splitlines()]
+		self.assertEqual([(record["title"], record["book_ids"]) for record in records], [("Fiction", [book_id]), ("Empty", [])])
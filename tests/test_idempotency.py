@@ -0,0 +1,82 @@
+import unittest
+from datetime import datetime, timedelta
+from app import create_app
+from app.models import db, Users, Carts, Cart_books, Addresses, Payments, Book_descriptions, Orders, Idempotency_keys
+from werkzeug.security import generate_password_hash
+from app.utils.auth import encode_token
+
+class TestIdempotency(unittest.TestCase):
+	def setUp(self):
+		self.app = create_app('TestingConfig')
+		with self.app.app_context():
+			db.drop_all()
+			db.create_all()
+			user = Users(first_name="Retry", last_name="User", email="retry@email.com", password=generate_password_hash('1234'), phone="+1234567890")
+			book = Book_descriptions(title="Book1", subtitle="Sub1", author="Author1", publisher="Pub1", published_date="2020-01-01", description="Desc", isbn="1234567890123", image_link="img", language="EN", price=10.0, stock_quantity=10, averageRating=5.0, ratingsCount=1)
+			db.session.add_all([user, book])
+			db.session.commit()
+			address = Addresses(line1="123 Main St", city="TestCity", state="TS", country="TestLand", zipcode="12345")
+			address.users.append(user)
+			db.session.add(address)
+			payment = Payments(user_id=user.id, card_number="4111111111111111", cvv=123, expiry_month=1, expiry_year=2030)
+			db.session.add(payment)
+			db.session.commit()
+			self.user_id, self.book_id, self.address_id, self.payment_id = user.id, book.id, address.id, payment.id
+		self.client = self.app.test_client()
+		self.headers = {"Authorization": f"Bearer {encode_token(self.user_id)}", "Idempotency-Key": "retry-1"}
+
+	def test_retried_add_book_is_replayed(self):
+		url = f"/carts/add_book/{self.book_id}"
+		first = self.client.put(url, headers=self.headers)
+		retry = self.client.put(url, headers=self.headers)
+		self.assertEqual(first.status_code, 200)
+		self.assertEqual(retry.status_code, 200)
+		self.assertEqual(retry.get_json(), first.get_json())
+		self.assertEqual(retry.headers["Idempotent-Replayed"], "true")
+		with self.app.app_context():
+			self.assertEqual(db.session.query(Cart_books).one().quantity, 1)
+			self.assertEqual(db.session.get(Book_descriptions, self.book_id).stock_quantity, 9)
+		# A new key is a new request
+		self.client.put(url, headers={**self.headers, "Idempotency-Key": "retry-2"})
+		with self.app.app_context():
+			self.assertEqual(db.session.query(Cart_books).one().quantity, 2)
+		# Same key, different request
+		response = self.client.put(f"/carts/remove_book/{self.book_id}", headers=self.headers)
+		self.assertEqual(response.status_code, 422)
+		self.assertEqual(self.client.put(url, headers={**self.headers, "Idempotency-Key": ""}).status_code, 400)
+
+	def test_retried_checkout_creates_one_order(self):
+		self.client.put(f"/carts/add_book/{self.book_id}", headers={"Authorization": self.headers["Authorization"]})
+		with self.app.app_context():
+			cart_id = db.session.query(Carts).one().id
+		url = f"/orders/{cart_id}/address/{self.address_id}/payment/{self.payment_id}"
+		first = self.client.post(url, json={"shipping_method": "InStore"}, headers=self.headers)
+		retry = self.client.post(url, json={"shipping_method": "InStore"}, headers=self.headers)
+		self.assertEqual(first.status_code, 201)
+		self.assertEqual(retry.status_code, 201)
+		self.assertEqual(retry.get_json()["order_info"]["id"], first.get_json()["order_info"]["id"])
+		with self.app.app_context():
+			self.assertEqual(db.session.query(Orders).count(), 1)
+
+	def test_in_progress_and_abandoned_keys(self):
+		self.app.config["IDEMPOTENCY_WAIT"] = 0.05
+		url = f"/carts/add_book/{self.book_id}"
+		with self.app.app_context():
+			# Claimed by a request that is still running
+			self.client.put(url, headers=self.headers)
+			db.session.query(Idempotency_keys).update({"status_code": None, "body": None})
+			db.session.commit()
+		response = self.client.put(url, headers=self.headers)
+		self.assertEqual(response.status_code, 409)
+		self.assertEqual(response.headers["Retry-After"], "1")
+		with self.app.app_context():
+			# Its request died, the claim is taken over once it expires
+			db.session.query(Idempotency_keys).update({"expires_at": datetime.now() - timedelta(seconds=1)})
+			db.session.commit()
+		self.assertEqual(self.client.put(url, headers=self.headers).status_code, 200)
+		with self.app.app_context():
+			self.assertEqual(db.session.query(Cart_books).one().quantity, 2)
+			db.session.query(Idempotency_keys).update({"expires_at": datetime.now() - timedelta(seconds=1)})
+			db.session.commit()
+		result = self.app.test_cli_runner().invoke(args=["idempotency", "purge"])
+		self.assertIn("1 expired idempotency keys deleted.", result.output)
@@ -1,6 +1,16 @@
+import json
+import threading
+import time
 import unittest
+from unittest import mock
+from datetime import datetime, timedelta
+from sqlalchemy import select, func
+from sqlalchemy.exc import OperationalError, IntegrityError
 from app import create_app
-from app.models import db, Users, Carts, Cart_books, Addresses, Payments, Book_descriptions
+from app.models import db, Users, Carts, Cart_books, Addresses, Payments, Book_descriptions, Orders, Order_books, Reservations
+from app.utils.query_budget import count_queries
+from app.blueprints.orders.routes import get_all_orders, create_order, get_order
+from app.blueprints.orders.fulfillment import transition, transition_order, TransitionError, fulfill, start_workers, FulfillmentStats
 from werkzeug.security import generate_password_hash
 from app.utils.auth import encode_token
 
@@ -40,6 +50,7 @@ class TestOrders(unittest.TestCase):
             db.session.add(self.cart_book)
             db.session.commit()
         self.token = encode_token(self.user_id)
+        self.headers = {"Authorization": f"Bearer {self.token}"}
         self.client = self.app.test_client()
 
     def test_create_order(self):
@@ -57,6 +68,90 @@ class TestOrders(unittest.TestCase):
             cart = db.session.get(Carts, self.cart_id)
             self.assertIsNone(cart)
 
+    def test_get_order_from_line_snapshots(self):
+        headers = {"Authorization": f"Bearer {self.token}"}
+        url = f"/orders/{self.cart_id}/address/{self.address_id}/payment/{self.payment_id}"
+        order_id = self.client.post(url, json={"shipping_method": "InStore"}, headers=headers).get_json()["order_info"]["id"]
+        # Editing the book afterwards doesn't rewrite what was sold
+        with self.app.app_context():
+            book = db.session.get(Book_descriptions, self.book_id)
+            book.price, book.title = 99.0, "Book1 (2nd edition)"
+            db.session.commit()
+        with self.app.app_context(), count_queries() as queries:
+            response = self.client.get(f"/orders/{order_id}", headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()["order_books"], [
+            {"book": {"id": self.book_id, "title": "Book1", "author": "Author1", "isbn": "1234567890123", "image_link": "img", "price": 10.0}, "quantity": 2}
+        ])
+        self.assertLessEqual(queries.count, get_order.query_budget)
+        fields = self.client.get(f"/orders/{order_id}?fields=title,price", headers=headers).get_json()
+        self.assertEqual(fields["order_books"][0]["book"], {"id": self.book_id, "title": "Book1", "price": 10.0})
+        self.assertEqual(self.client.get("/orders/999", headers=headers).status_code, 404)
+        self.assertEqual(self.client.get(f"/orders/{order_id}", headers={"Authorization": f"Bearer {encode_token(999)}"}).status_code, 400)
+
+    def test_backfill_snapshots(self):
+        with self.app.app_context():
+            order = Orders(user_id=self.user_id, payment_id=self.payment_id, address_id=self.address_id)
+            order.order_books = [Order_books(book_description_id=self.book_id, quantity=1) for _ in range(3)]
+            db.session.add(order)
+            db.session.commit()
+        result = self.app.test_cli_runner().invoke(args=["orders", "backfill-snapshots", "--chunk-size", "2"])
+        self.assertIn("3 order lines filled in.", result.output)
+        with self.app.app_context():
+            lines = db.session.scalars(select(Order_books)).all()
+            self.assertEqual({(line.title, line.unit_price, line.isbn) for line in lines}, {("Book1", 10.0, "1234567890123")})
+        self.assertIn("0 order lines filled in.", self.app.test_cli_runner().invoke(args=["orders", "backfill-snapshots"]).output)
+
+    def test_create_order_totals_and_stock(self):
+        headers = {"Authorization": f"Bearer {self.token}"}
+        url = f"/orders/{self.cart_id}/address/{self.address_id}/payment/{self.payment_id}"
+        # Client sent totals are ignored
+        with self.app.app_context(), count_queries() as queries:
+            response = self.client.post(url, json={"shipping_method": "Out-for-Delivery", "total": 0.01}, headers=headers)
+        self.assertEqual(response.status_code, 201)
+        self.assertLessEqual(queries.count, create_order.query_budget)
+        order = response.get_json()["order_info"]
+        self.assertEqual((order["subtotal"], order["tax"], order["shipping_cost"], order["total"]), (20.0, 1.6, 5.99, 27.59))
+        self.assertEqual(order["status"], "Pending")
+        with self.app.app_context():
+            self.assertEqual(db.session.get(Book_descriptions, self.book_id).stock_quantity, 8)
+            self.assertEqual(db.session.query(Order_books).where(Order_books.order_id == order["id"]).one().quantity, 2)
+
+    def test_create_order_with_reservations(self):
+        headers = {"Authorization": f"Bearer {self.token}"}
+        # One of the two copies was reserved when it was added, the other reservation expired
+        self.client.put(f"/carts/add_book/{self.book_id}", headers=headers)
+        with self.app.app_context():
+            self.assertEqual(db.session.get(Book_descriptions, self.book_id).stock_quantity, 9)
+        url = f"/orders/{self.cart_id}/address/{self.address_id}/payment/{self.payment_id}"
+        response = self.client.post(url, json={"shipping_method": "InStore"}, headers=headers)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.get_json()["order_books"][0]["quantity"], 3)
+        with self.app.app_context():
+            self.assertEqual(db.session.get(Book_descriptions, self.book_id).stock_quantity, 7)
+            self.assertEqual(db.session.query(Reservations).count(), 0)
+
+    def test_create_order_out_of_stock(self):
+        headers = {"Authorization": f"Bearer {self.token}"}
+        url = f"/orders/{self.cart_id}/address/{self.address_id}/payment/{self.payment_id}"
+        with self.app.app_context():
+            db.session.get(Book_descriptions, self.book_id).stock_quantity = 1
+            db.session.commit()
+        response = self.client.post(url, json={"shipping_method": "InStore"}, headers=headers)
+        self.assertEqual(response.status_code, 409)
+        # Nothing was written: no order, same stock, the cart is still there
+        with self.app.app_context():
+            self.assertEqual(db.session.query(Orders).count(), 0)
+            self.assertEqual(db.session.get(Book_descriptions, self.book_id).stock_quantity, 1)
+            self.assertIsNotNone(db.session.get(Carts, self.cart_id))
+        # An emptied cart can't be checked out
+        with self.app.app_context():
+            db.session.query(Cart_books).delete()
+            db.session.commit()
+        response_empty = self.client.post(url, json={"shipping_method": "InStore"}, headers=headers)
+        self.assertEqual(response_empty.status_code, 400)
+        self.assertEqual(response_empty.get_json()["error"], "Your cart is empty.")
+
     def test_create_order_errors(self):
         headers = {"Authorization": f"Bearer {self.token}"}
         order_payload = {"shipping_method": "InStore", "subtotal": 20.0, "tax": 2.0, "shipping_cost": 5.0, "total": 27.0, "status": "Pending"}
@@ -112,6 +207,15 @@ class TestOrders(unittest.TestCase):
         response = self.client.post(url, json=invalid_payload, headers=headers)
         self.assertEqual(response.status_code, 201)
 
+    def test_create_order_database_errors(self):
+        headers = {"Authorization": f"Bearer {self.token}"}
+        url = f"/orders/{self.cart_id}/address/{self.address_id}/payment/{self.payment_id}"
+        for error, status in [(OperationalError("SELECT", {}, Exception("database is locked")), 503), (IntegrityError("INSERT", {}, Exception("UNIQUE constraint failed")), 409)]:
+            with mock.patch("app.blueprints.orders.routes.checkout", side_effect=error):
+                response = self.client.post(url, json={"shipping_method": "InStore"}, headers=headers)
+            self.assertEqual(response.status_code, status)
+            self.assertIn("error", response.get_json())
+
     def test_delete_order(self):
         headers = {"Authorization": f"Bearer {self.token}"}
         # Create order first
@@ -172,13 +276,199 @@ class TestOrders(unittest.TestCase):
         url = f"/orders/{self.cart_id}/address/{self.address_id}/payment/{self.payment_id}"
         self.client.post(url, json=order_payload, headers=headers)
         # Get all orders
-        response = self.client.get("/orders")
+        response = self.client.get("/orders", headers=self.headers)
         self.assertEqual(response.status_code, 200)
-        data = response.get_json()
+        data = response.get_json()["data"]
         self.assertIsInstance(data, list)
         self.assertGreaterEqual(len(data), 1)
         self.assertIn("order_info", data[0])
         self.assertIn("order_books", data[0])
+        # Every user's orders, not for anonymous callers
+        self.assertEqual(self.client.get("/orders").status_code, 401)
+
+    def test_get_all_orders_query_budget(self):
+        # Loading more orders and books must not add queries, @query_budget raises in tests if it does
+        with self.app.app_context():
+            books = [Book_descriptions(title=f"Book{i}", subtitle="Sub", author="Author", publisher="Pub", published_date="2020-01-01", description="Desc", isbn=f"99900000000{i}", image_link="img", language="EN", price=10.0, stock_quantity=10, averageRating=5.0, ratingsCount=1) for i in range(3)]
+            db.session.add_all(books)
+            for i in range(5):
+                order = Orders(user_id=self.user_id, payment_id=self.payment_id, address_id=self.address_id)
+                order.order_books = [Order_books(book_description=book, quantity=1) for book in books]
+                db.session.add(order)
+            db.session.commit()
+        with self.app.app_context(), count_queries() as queries:
+            response = self.client.get("/orders", headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.get_json()["data"]), 5)
+        self.assertEqual(sum(len(order["order_books"]) for order in response.get_json()["data"]), 15)
+        self.assertLessEqual(queries.count, get_all_orders.query_budget)
+
+    def add_orders(self):
+        with self.app.app_context():
+            book = db.session.get(Book_descriptions, self.book_id)
+            orders = [
+                Orders(user_id=self.user_id, payment_id=self.payment_id, address_id=self.address_id, status=status, shipping_method=shipping_method, created_at=datetime(2024, month, 1))
+                for month, status, shipping_method in [(1, "Pending", "InStore"), (2, "Shipped", "Delivered"), (3, "Shipped", "InStore"), (4, "Cancelled", "InStore")]
+            ]
+            for order in orders:
+                order.order_books = [Order_books(book_description=book, quantity=2, unit_price=10.0, title="Book1", author="Author1", isbn="1234567890123", image_link="img")]
+            db.session.add_all(orders)
+            db.session.commit()
+            return [order.id for order in orders]
+
+    def test_get_all_orders_filters_and_cursor(self):
+        ids = self.add_orders()
+        data = self.client.get("/orders?status=Shipped", headers=self.headers).get_json()
+        self.assertEqual([order["order_info"]["id"] for order in data["data"]], [ids[2], ids[1]])
+        data = self.client.get("/orders?status=Shipped&shipping_method=InStore", headers=self.headers).get_json()
+        self.assertEqual([order["order_info"]["id"] for order in data["data"]], [ids[2]])
+        data = self.client.get(f"/orders?user_id={self.user_id}&since=2024-02-01&until=2024-04-01", headers=self.headers).get_json()
+        self.assertEqual([order["order_info"]["id"] for order in data["data"]], [ids[2], ids[1]])
+        # Newest first, walked with the cursor
+        first = self.client.get("/orders?limit=3", headers=self.headers).get_json()
+        self.assertEqual([order["order_info"]["id"] for order in first["data"]], [ids[3], ids[2], ids[1]])
+        second = self.client.get(f"/orders?limit=3&after={first['next_cursor']}", headers=self.headers).get_json()
+        self.assertEqual([order["order_info"]["id"] for order in second["data"]], [ids[0]])
+        self.assertIsNone(second["next_cursor"])
+        self.assertEqual(self.client.get("/orders?status=Lost", headers=self.headers).status_code, 400)
+        self.assertEqual(self.client.get("/orders?user_id=me", headers=self.headers).status_code, 400)
+        self.assertEqual(self.client.get("/orders?after=nope", headers=self.headers).status_code, 400)
+
+    def test_export_orders(self):
+        ids = self.add_orders()
+        response = self.client.get("/orders/export?status=Shipped,Cancelled", headers={"Authorization": f"Bearer {self.token}"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        records = [json.loads(line) for line in response.data.decode().splitlines()]
+        # Oldest first, each order once with its lines
+        self.assertEqual([record["id"] for record in records], ids[1:])
+        self.assertEqual(records[0]["order_books"], [{"book_description_id": self.book_id, "title": "Book1", "unit_price": 10.0, "quantity": 2}])
+        self.assertEqual(self.client.get("/orders/export?shipping_method=Teleport", headers={"Authorization": f"Bearer {self.token}"}).status_code, 400)
+        self.assertEqual(self.client.get("/orders/export").status_code, 401)
+
+    def test_cancel_processing_order(self):
+        headers = {"Authorization": f"Bearer {self.token}"}
+        order_id = self.add_orders()[0]
+        with self.app.app_context():
+            moved = transition([order_id], "Processing")
+            db.session.commit()
+        self.assertEqual(moved, 1)
+        response = self.client.delete(f"/orders/{order_id}", headers=headers)
+        self.assertEqual(response.status_code, 200)
+        with self.app.app_context():
+            order = db.session.get(Orders, order_id)
+            # Committed, with the time it happened
+            self.assertEqual(order.status, "Cancelled")
+            self.assertIsNotNone(order.cancelled_at)
+        # Cancelled is final
+        self.assertEqual(self.client.delete(f"/orders/{order_id}", headers=headers).status_code, 400)
+
+    def stock(self):
+        with self.app.app_context():
+            return db.session.get(Book_descriptions, self.book_id).stock_quantity
+
+    def test_cancel_returns_stock(self):
+        headers = {"Authorization": f"Bearer {self.token}"}
+        url = f"/orders/{self.cart_id}/address/{self.address_id}/payment/{self.payment_id}"
+        before = self.stock()
+        order_id = self.client.post(url, json={"shipping_method": "InStore"}, headers=headers).get_json()["order_info"]["id"]
+        taken = before - self.stock()
+        self.assertGreater(taken, 0)
+        # Cancelling a Processing order gives its copies back
+        with self.app.app_context():
+            transition([order_id], "Processing")
+            db.session.commit()
+        self.assertEqual(self.client.delete(f"/orders/{order_id}", headers=headers).status_code, 200)
+        self.assertEqual(self.stock(), before)
+        # Only once, the order is Cancelled already
+        self.assertEqual(self.client.delete(f"/orders/{order_id}", headers=headers).status_code, 400)
+        with self.app.app_context():
+            self.assertEqual(transition([order_id], "Cancelled"), 0)
+            db.session.commit()
+        self.assertEqual(self.stock(), before)
+
+    def test_delete_pending_order_returns_stock(self):
+        headers = {"Authorization": f"Bearer {self.token}"}
+        url = f"/orders/{self.cart_id}/address/{self.address_id}/payment/{self.payment_id}"
+        before = self.stock()
+        # The book is cached with the stock in it
+        self.assertEqual(self.client.get(f"/book_descriptions/{self.book_id}").status_code, 200)
+        order_id = self.client.post(url, json={"shipping_method": "InStore"}, headers=headers).get_json()["order_info"]["id"]
+        self.assertLess(self.stock(), before)
+        self.assertEqual(self.client.delete(f"/orders/{order_id}", headers=headers).status_code, 200)
+        self.assertEqual(self.stock(), before)
+        self.assertEqual(self.client.get(f"/book_descriptions/{self.book_id}").get_json()["data"]["stock_quantity"], before)
+
+    def test_transitions(self):
+        ids = self.add_orders()
+        with self.app.app_context():
+            # Only the Pending order may start processing, Shipped and Cancelled ones are left alone
+            self.assertEqual(transition(ids, "Processing"), 1)
+            db.session.commit()
+            shipped = db.session.get(Orders, ids[1])
+            with self.assertRaises(TransitionError):
+                transition_order(shipped, "Cancelled")
+            transition_order(shipped, "Returned")
+            db.session.commit()
+            self.assertEqual(db.session.get(Orders, ids[1]).status, "Returned")
+            self.assertEqual(db.session.get(Orders, ids[0]).status, "Processing")
+
+    def test_fulfill(self):
+        ids = self.add_orders()
+        with self.app.app_context():
+            transition([ids[2]], "Returned")
+            db.session.commit()
+            stats = FulfillmentStats()
+            # FULFILLMENT_PROCESSING_TIME is 0 in tests, a pass takes a Pending order all the way
+            self.assertEqual(fulfill(stats=stats), 2)
+            order = db.session.get(Orders, ids[0])
+            self.assertEqual(order.status, "Shipped")
+            self.assertLessEqual(order.created_at, order.processing_at)
+            self.assertLessEqual(order.processing_at, order.shipped_at)
+            self.assertEqual(set(stats.snapshot()), {"Pending -> Processing", "Processing -> Shipped"})
+            self.assertEqual(fulfill(), 0)
+
+    def test_fulfill_waits_for_processing_time(self):
+        ids = self.add_orders()
+        self.app.config["FULFILLMENT_PROCESSING_TIME"] = 60
+        with self.app.app_context():
+            self.assertEqual(fulfill(batch_size=10), 1)
+            self.assertEqual(db.session.get(Orders, ids[0]).status, "Processing")
+            self.assertEqual(fulfill(batch_size=10, now=datetime.now() + timedelta(minutes=2)), 1)
+            self.assertEqual(db.session.get(Orders, ids[0]).status, "Shipped")
+
+    def test_fulfillment_workers(self):
+        with self.app.app_context():
+            for _ in range(20):
+                db.session.add(Orders(user_id=self.user_id, payment_id=self.payment_id, address_id=self.address_id))
+            db.session.commit()
+        stop = threading.Event()
+        threads = start_workers(self.app, workers=3, batch_size=4, interval=0.05, stop=stop)
+        try:
+            for _ in range(100):
+                with self.app.app_context():
+                    if not db.session.scalar(select(func.count()).where(Orders.status != "Shipped")):
+                        break
+                time.sleep(0.05)
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+        with self.app.app_context():
+            self.assertEqual(db.session.scalar(select(func.count()).where(Orders.status == "Shipped")), 20)
+
+    def test_fulfillment_metrics(self):
+        self.add_orders()
+        response = self.client.get("/orders/fulfillment", headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        queues = response.get_json()["queues"]
+        self.assertEqual(queues["Pending"]["depth"], 1)
+        self.assertGreater(queues["Pending"]["oldest_age_seconds"], 0)
+        self.assertEqual(queues["Processing"], {"depth": 0, "oldest_age_seconds": None})
+        self.assertEqual(self.client.get("/orders/fulfillment").status_code, 401)
+        result = self.app.test_cli_runner().invoke(args=["orders", "fulfill"])
+        self.assertIn("Processing -> Shipped", result.output)
+        self.assertEqual(self.client.get("/orders/fulfillment", headers=self.headers).get_json()["queues"]["Pending"]["depth"], 0)
 
 if __name__ == "__main__":
     unittest.main()
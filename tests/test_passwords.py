@@ -0,0 +1,80 @@
+import threading
+import unittest
+from app import create_app
+from app.models import db, Users
+from werkzeug.security import generate_password_hash, check_password_hash
+from app.utils.auth import encode_token
+from app.utils.passwords import passwords
+
+class TestPasswords(unittest.TestCase):
+	def setUp(self):
+		self.app = create_app('TestingConfig')
+		with self.app.app_context():
+			db.drop_all()
+			db.create_all()
+			user = Users(first_name="Hash", last_name="User", email="hash@email.com", password=generate_password_hash('1234', "pbkdf2:sha256:1000"), phone="+1234567890")
+			db.session.add(user)
+			db.session.commit()
+			self.user_id = user.id
+		self.client = self.app.test_client()
+
+	def stored_hash(self):
+		with self.app.app_context():
+			return db.session.get(Users, self.user_id).password
+
+	def login(self, password='1234'):
+		return self.client.post("/users/login", json={"email": "hash@email.com", "password": password})
+
+	def update_profile(self, password=None):
+		payload = {"first_name": "Hash", "last_name": "User", "email": "hash@email.com", "phone": "+1234567890"}
+		if password is not None:
+			payload["password"] = password
+		return self.client.put("/users", json=payload, headers={"Authorization": f"Bearer {encode_token(self.user_id)}"})
+
+	def test_login_keeps_a_current_hash(self):
+		stored = self.stored_hash()
+		self.assertEqual(self.login().status_code, 200)
+		self.assertEqual(self.stored_hash(), stored)
+
+	def test_login_rehashes_with_new_parameters(self):
+		self.app.extensions["passwords"]["method"] = "pbkdf2:sha256:2000"
+		self.assertEqual(self.login().status_code, 200)
+		stored = self.stored_hash()
+		self.assertTrue(stored.startswith("pbkdf2:sha256:2000$"))
+		self.assertTrue(check_password_hash(stored, '1234'))
+		# A wrong password doesn't touch it
+		self.app.extensions["passwords"]["method"] = "pbkdf2:sha256:3000"
+		self.app.extensions["passwords"]["prefix"] = None
+		self.assertEqual(self.login('4321').status_code, 400)
+		self.assertEqual(self.stored_hash(), stored)
+
+	def test_profile_update_without_password_keeps_it(self):
+		stored = self.stored_hash()
+		self.assertEqual(self.update_profile().status_code, 200)
+		self.assertEqual(self.stored_hash(), stored)
+		self.assertEqual(self.login('1234').status_code, 200)
+		self.assertEqual(self.update_profile('5678').status_code, 200)
+		self.assertNotEqual(self.stored_hash(), stored)
+		self.assertEqual(self.login('5678').status_code, 200)
+
+	def test_busy(self):
+		state = self.app.extensions["passwords"]
+		state["workers"], state["wait"], state["slots"] = 1, 0, threading.BoundedSemaphore(1)
+		state["slots"].acquire()
+		try:
+			response = self.login()
+		finally:
+			state["slots"].release()
+		self.assertEqual(response.status_code, 503)
+		self.assertEqual(response.headers["Retry-After"], "1")
+
+	def test_process_pool(self):
+		self.app.extensions["passwords"]["workers"] = 1
+		try:
+			self.assertEqual(self.login().status_code, 200)
+			self.assertEqual(self.login('4321').status_code, 400)
+		finally:
+			passwords.shutdown(self.app)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,55 @@
+import threading
+import unittest
+from app import create_app
+from app.models import db, Book_descriptions
+from sqlalchemy import event
+from app.utils.query_budget import query_budget, QueryBudgetExceeded, count_queries, query_counting
+
+class TestQueryBudget(unittest.TestCase):
+	def setUp(self):
+		self.app = create_app('TestingConfig')
+		with self.app.app_context():
+			db.drop_all()
+			db.create_all()
+			db.session.add_all([Book_descriptions(title=f"Book{i}", subtitle="Sub", author="Author", publisher="Pub", published_date="2020-01-01", description="Desc", isbn=f"99900000000{i}", image_link="img", language="EN", price=10.0, stock_quantity=10, averageRating=5.0, ratingsCount=1) for i in range(3)])
+			db.session.commit()
+
+		# One query per book, the N+1 the budget is there to catch
+		@self.app.route('/n_plus_one')
+		@query_budget(2)
+		def n_plus_one():
+			ids = db.session.scalars(db.select(Book_descriptions.id)).all()
+			return {"titles" : [db.session.get(Book_descriptions, book_id).title for book_id in ids]}
+		self.client = self.app.test_client()
+
+	def test_over_budget_raises(self):
+		with self.assertRaises(QueryBudgetExceeded) as raised:
+			self.client.get("/n_plus_one")
+		self.assertIn("ran 4 queries, its budget is 2", str(raised.exception))
+
+	def test_over_budget_warns(self):
+		self.app.config["QUERY_BUDGET_MODE"] = "warn"
+		with self.assertLogs(self.app.logger, level="WARNING"):
+			response = self.client.get("/n_plus_one")
+		self.assertEqual(response.status_code, 200)
+
+	def test_not_counted_in_production(self):
+		self.app.config["QUERY_BUDGET_MODE"] = None
+		self.assertEqual(self.client.get("/n_plus_one").status_code, 200)
+
+	def test_threads_count_their_own_queries(self):
+		# One listener for the life of the app, requests don't add or remove any
+		with self.app.app_context():
+			self.assertTrue(event.contains(db.engine, "before_cursor_execute", query_counting.record))
+		counted = {}
+		def request_thread(name, queries):
+			with self.app.app_context(), count_queries() as counter:
+				for _ in range(queries):
+					db.session.scalars(db.select(Book_descriptions.id)).all()
+				counted[name] = counter.count
+		threads = [threading.Thread(target=request_thread, args=(name, queries)) for name, queries in [("one", 1), ("five", 5)]]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertEqual(counted, {"one": 1, "five": 5})
@@ -0,0 +1,51 @@
+import json
+import os
+import tempfile
+import unittest
+from app import create_app
+from app.utils.rates import rates
+
+
+class TestRates(unittest.TestCase):
+	def setUp(self):
+		self.app = create_app('TestingConfig')
+		self.path = os.path.join(tempfile.mkdtemp(), "rates.json")
+		self.write({"tax": {"default": 0.1, "aliases": {"USA": "US"}, "countries": {"US": {"default": 0.05, "states": {"NY": 0.04}}}}, "shipping": {"default": 1.0, "methods": {"InStore": 0.0}}})
+		self.app.config["RATES_PATH"] = self.path
+
+	def write(self, tables, mtime=None):
+		with open(self.path, "w") as rates_file:
+			json.dump(tables, rates_file) if isinstance(tables, dict) else rates_file.write(tables)
+		if mtime is not None:
+			os.utime(self.path, ns=(mtime, mtime))
+
+	def test_lookups(self):
+		with self.app.app_context():
+			self.assertEqual(rates.tax_rate("usa", " ny "), 0.04)
+			self.assertEqual(rates.tax_rate("US", "CA"), 0.05)
+			self.assertEqual(rates.tax_rate("Elsewhere", "NY"), 0.1)
+			self.assertEqual(rates.tax_rate(), 0.1)
+			self.assertEqual(rates.shipping_cost("InStore"), 0.0)
+			self.assertEqual(rates.shipping_cost("Delayed"), 1.0)
+
+	def test_reloaded_when_the_file_changes(self):
+		with self.app.app_context():
+			self.assertEqual(rates.tax_rate(), 0.1)
+			self.write({"tax": {"default": 0.2}, "shipping": {}}, mtime=os.stat(self.path).st_mtime_ns + 10**9)
+			self.assertEqual(rates.tax_rate("US", "NY"), 0.2)
+			# A broken file keeps the last good tables
+			self.write("{not json", mtime=os.stat(self.path).st_mtime_ns + 10**9)
+			self.assertEqual(rates.tax_rate(), 0.2)
+
+	def test_missing_file_keeps_the_loaded_tables(self):
+		with self.app.app_context():
+			self.assertEqual(rates.tax_rate(), 0.1)
+			os.remove(self.path)
+			self.assertEqual(rates.tax_rate("US", "NY"), 0.04)
+			# Nothing read yet, there are no rates to fall back on
+			self.app.config["RATES_PATH"] = self.path + ".missing"
+			with self.assertRaises(OSError):
+				rates.tax_rate()
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+import json
+from datetime import datetime
+from marshmallow import post_dump
+from app import create_app
+from app.extensions import ma
+from app.models import db, Users, Reviews, Orders, Book_descriptions
+from app.utils.serializers import compiled, CompiledSchema
+from app.blueprints.book_descriptions.schemas import BookDescriptionSchema, projected
+from app.blueprints.book_reviews.schemas import ReviewUserSchema, UserReviewSchema
+from app.blueprints.orders.schemas import OrderSchema
+
+class TestSerializers(unittest.TestCase):
+	def setUp(self):
+		self.app = create_app('TestingConfig')
+		with self.app.app_context():
+			db.drop_all()
+			db.create_all()
+		self.user = Users(id=1, first_name="Test", last_name="User", email="test@email.com", password="hash", phone="+1234567890", created_at=datetime(2026, 1, 2, 3, 4, 5))
+		self.book = Book_descriptions(id=1, title="Book1", subtitle="Sub1", author="Author1", publisher="Pub1", published_date="2020-01-01", description="Desc", isbn="1234567890123", image_link="img", language="EN", price=10, stock_quantity=10, averageRating=5.0, ratingsCount=1, page_count=None)
+		self.review = Reviews(id=1, user=self.user, book_description=self.book, rating=4, comment="Nice!", created_at=datetime(2026, 1, 2), updated_at=None)
+
+	def test_same_output_as_marshmallow(self):
+		order = Orders(id=1, user_id=1, payment_id=1, address_id=1, created_at=datetime(2026, 1, 2), status="Pending", shipping_method="InStore", subtotal=10, tax=1.5, shipping_cost=0, total=11.5)
+		for schema, obj in [
+			(BookDescriptionSchema(), self.book),
+			(OrderSchema(), order),
+			(ReviewUserSchema(), self.review),
+			(UserReviewSchema(exclude=["book_description.description"]), self.review),
+		]:
+			expected = schema.dump(obj)
+			self.assertEqual(compiled(schema).dump(obj), expected)
+			# Same types too, e.g. the integer price of a new book is dumped as a float
+			self.assertEqual(json.dumps(compiled(schema).dump(obj)), json.dumps(expected))
+		self.assertEqual(compiled(BookDescriptionSchema(many=True)).dump([self.book, self.book]), BookDescriptionSchema(many=True).dump([self.book, self.book]))
+
+	def test_projected_schemas(self):
+		schema = projected(BookDescriptionSchema, frozenset({"id", "title"}))
+		self.assertIsInstance(schema, CompiledSchema)
+		self.assertIs(projected(BookDescriptionSchema, frozenset({"id", "title"})), schema)
+		self.assertEqual(schema.dump(self.book), {"id": 1, "title": "Book1"})
+		self.assertEqual(json.loads(schema.dumps(self.book)), {"id": 1, "title": "Book1"})
+
+	def test_drop_in_compatible(self):
+		schema = compiled(BookDescriptionSchema())
+		# Loading and mappings go through marshmallow
+		self.assertEqual(schema.load({"title": "T", "subtitle": "S", "author": "A", "publisher": "P", "published_date": "2020", "description": "D", "isbn": "1", "image_link": "i", "language": "EN", "averageRating": 1.0, "ratingsCount": 1})["title"], "T")
+		self.assertEqual(schema.dump({"id": 2, "title": "From a dict"}), {"id": 2, "title": "From a dict"})
+		with self.app.test_request_context():
+			response = schema.jsonify(self.book)
+		self.assertEqual(response.get_json()["isbn"], "1234567890123")
+		# Schemas with dump hooks are not compiled
+		class HookedSchema(ma.SQLAlchemyAutoSchema):
+			class Meta:
+				model = Book_descriptions
+			@post_dump
+			def shout(self, data, **kwargs):
+				data["title"] = data["title"].upper()
+				return data
+		self.assertEqual(compiled(HookedSchema()).dump(self.book)["title"], "BOOK1")
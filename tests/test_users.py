@@ -1,8 +1,12 @@
+import json
 import unittest
 from app import create_app
-from app.models import Users, db
+from unittest import mock
+from datetime import datetime
+from app.models import Users, Reviews, Favorites, Book_descriptions, Addresses, Payments, Orders, Order_books, Carts, Cart_books, db
 from werkzeug.security import generate_password_hash, check_password_hash
 from app.utils.auth import encode_token
+from app.blueprints.users.purge import purge_accounts, claim_purge, PURGE_STEPS
 
 
 class TestUsers(unittest.TestCase):
@@ -15,6 +19,7 @@ class TestUsers(unittest.TestCase):
             db.session.add(self.user)
             db.session.commit()
         self.token = encode_token(1) #encoding a token for my starter designed user
+        self.headers = {"Authorization": f"Bearer {self.token}"}
         self.client = self.app.test_client()
 
     def test_create_user(self):
@@ -99,12 +104,45 @@ class TestUsers(unittest.TestCase):
 
     def test_get_all_users(self):
         # Get all users
-        response = self.client.get("/users")
+        response = self.client.get("/users", headers=self.headers)
         self.assertEqual(response.status_code, 200)
-        data = response.get_json()
+        data = response.get_json()["data"]
         self.assertIsInstance(data, list)
         self.assertGreaterEqual(len(data), 1)
         self.assertEqual(data[0]["email"], "tester@email.com")
+        self.assertNotIn("password", data[0])
+        # Signed in only
+        self.assertEqual(self.client.get("/users").status_code, 401)
+        self.assertEqual(self.client.get("/users/export").status_code, 401)
+
+    def test_user_directory(self):
+        with self.app.app_context():
+            for day, email in [(2, "anna@email.com"), (3, "andy@email.com"), (4, "bob@email.com")]:
+                db.session.add(Users(first_name="Dir", last_name="User", email=email, password=generate_password_hash('1234'), phone="+1234567890", created_at=datetime(2026, 1, day)))
+            db.session.commit()
+        # Newest first, page by page
+        page = self.client.get("/users?limit=2", headers=self.headers).get_json()
+        self.assertEqual([user["email"] for user in page["data"]], ["tester@email.com", "bob@email.com"])
+        page = self.client.get(f"/users?limit=2&after={page['next_cursor']}", headers=self.headers).get_json()
+        self.assertEqual([user["email"] for user in page["data"]], ["andy@email.com", "anna@email.com"])
+        self.assertIsNone(page["next_cursor"])
+        # An email prefix lists by email
+        page = self.client.get("/users?email=an&limit=1", headers=self.headers).get_json()
+        self.assertEqual([user["email"] for user in page["data"]], ["andy@email.com"])
+        page = self.client.get(f"/users?email=an&after={page['next_cursor']}", headers=self.headers).get_json()
+        self.assertEqual([user["email"] for user in page["data"]], ["anna@email.com"])
+        page = self.client.get("/users?since=2026-01-03&until=2026-01-04", headers=self.headers).get_json()
+        self.assertEqual([user["email"] for user in page["data"]], ["andy@email.com"])
+        self.assertEqual(self.client.get("/users?since=yesterday", headers=self.headers).status_code, 400)
+        self.assertEqual(self.client.get("/users?after=nope", headers=self.headers).status_code, 400)
+
+    def test_export_users(self):
+        response = self.client.get("/users/export", headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        users = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([user["email"] for user in users], ["tester@email.com"])
+        self.assertNotIn("password", users[0])
 
     def test_get_user_profile(self):
         # Valid request with token
@@ -155,6 +193,147 @@ class TestUsers(unittest.TestCase):
         response_no_token = self.client.delete("/users")
         self.assertEqual(response_no_token.status_code, 401)
 
+    def add_history(self, orders):
+        # A user 1 account with orders of two lines, a review, a favorite, a card, an address of
+        # their own and one shared with user 2
+        with self.app.app_context():
+            other = Users(first_name="Other", last_name="User", email="other@email.com", password=generate_password_hash('1234'), phone="+1234567890")
+            book = Book_descriptions(title="Book1", subtitle="Sub1", author="Author1", publisher="Pub1", published_date="2020-01-01", description="Desc", isbn="1234567890123", image_link="img", language="EN", price=10.0, stock_quantity=10, averageRating=5.0, ratingsCount=1)
+            own, shared = Addresses(line1="1 Own St", city="TestCity", state="TS", country="TestLand", zipcode="12345"), Addresses(line1="2 Shared St", city="TestCity", state="TS", country="TestLand", zipcode="12345")
+            payment = Payments(user_id=1, card_number="4111111111111111", cvv=123, expiry_month=1, expiry_year=2030)
+            db.session.add_all([other, book, own, shared, payment])
+            db.session.flush()
+            user = db.session.get(Users, 1)
+            user.addresses.extend([own, shared])
+            other.addresses.append(shared)
+            for _ in range(orders):
+                order = Orders(user_id=1, address_id=own.id, payment_id=payment.id, total=20.0)
+                order.order_books.extend([Order_books(book_description_id=book.id, quantity=1), Order_books(book_description_id=book.id, quantity=1)])
+                db.session.add(order)
+            db.session.add_all([Reviews(user_id=1, book_description_id=book.id, rating=4.0, comment="Good"), Favorites(user_id=1, book_description_id=book.id)])
+            db.session.commit()
+            return other.id, own.id, shared.id
+
+    def assert_account_gone(self, other_id, own_id, shared_id):
+        with self.app.app_context():
+            self.assertIsNone(db.session.get(Users, 1))
+            for model in [Orders, Order_books, Reviews, Favorites, Payments]:
+                self.assertEqual(db.session.query(model).count(), 0, model.__name__)
+            self.assertIsNone(db.session.get(Addresses, own_id))
+            self.assertEqual([address.id for address in db.session.get(Users, other_id).addresses], [shared_id])
+
+    def test_delete_user_history(self):
+        ids = self.add_history(orders=3)
+        headers = {"Authorization": f"Bearer {self.token}"}
+        response = self.client.delete("/users", headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assert_account_gone(*ids)
+        self.assertEqual(self.client.get("/users/deletion", headers=headers).status_code, 404)
+
+    def test_delete_large_user_in_background(self):
+        ids = self.add_history(orders=3)
+        self.app.config.update(USER_PURGE_THRESHOLD=5)
+        headers = {"Authorization": f"Bearer {self.token}"}
+        response = self.client.delete("/users", headers=headers)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.get_json()["deletion"]["status"], "Pending")
+        # The account can't be used while it waits for the purge
+        self.assertEqual(self.client.get("/users/profile", headers=headers).status_code, 404)
+        self.assertEqual(self.client.post("/users/login", json={"email": "tester@email.com", "password": "1234"}).status_code, 400)
+        self.assertEqual(self.client.delete("/users", headers=headers).status_code, 404)
+        # Nor write rows the purge would have to chase
+        with self.app.app_context():
+            book_id = db.session.query(Book_descriptions.id).scalar()
+        self.assertEqual(self.client.post(f"/favorites/{book_id}", headers=headers).status_code, 404)
+        self.assertEqual(self.client.put(f"/favorites/{book_id}", headers=headers).status_code, 404)
+        self.assertEqual(self.client.post(f"/reviews/{book_id}", json={"rating": 5, "comment": "Late"}, headers=headers).status_code, 404)
+        self.assertEqual(self.client.put(f"/carts/add_book/{book_id}", headers=headers).status_code, 404)
+        with self.app.app_context():
+            self.assertEqual([purge.status for purge in purge_accounts(chunk_size=2)], ["Done"])
+        self.assert_account_gone(*ids)
+        deletion = self.client.get("/users/deletion", headers=headers).get_json()
+        self.assertEqual(deletion["status"], "Done")
+        # 3 orders and their 6 lines, review, favorite, card, own address, 2 links and the user
+        self.assertEqual(deletion["rows_deleted"], 16)
+
+    def schedule_purge(self):
+        self.add_history(orders=3)
+        self.app.config.update(USER_PURGE_THRESHOLD=5)
+        self.assertEqual(self.client.delete("/users", headers=self.headers).status_code, 202)
+
+    def test_purge_taken_over_from_a_dead_worker(self):
+        self.schedule_purge()
+        with self.app.app_context():
+            # The worker that claimed the job died after it
+            purge_id = claim_purge()
+            self.assertEqual(purge_accounts(chunk_size=2), [])
+            # Once its lease is over another worker picks it up
+            self.app.config.update(USER_PURGE_LEASE=0)
+            purges = purge_accounts(chunk_size=2)
+            self.assertEqual([(purge.id, purge.status, purge.attempts) for purge in purges], [(purge_id, "Done", 2)])
+        self.assertEqual(self.client.get("/users/deletion", headers=self.headers).get_json()["status"], "Done")
+
+    def test_failed_purge_is_retried(self):
+        self.schedule_purge()
+        def broken(user_id, limit):
+            raise RuntimeError("database went away")
+        steps = [("broken", broken)] + PURGE_STEPS
+        with self.app.app_context():
+            with mock.patch("app.blueprints.users.purge.PURGE_STEPS", steps):
+                purges = purge_accounts(chunk_size=2)
+            # Run USER_PURGE_ATTEMPTS times in all, then left Failed
+            self.assertEqual([purge.status for purge in purges], ["Failed"] * 3)
+            self.assertEqual(purge_accounts(chunk_size=2), [])
+            self.app.config.update(USER_PURGE_ATTEMPTS=4)
+            self.assertEqual([purge.status for purge in purge_accounts(chunk_size=2)], ["Done"])
+        self.assertEqual(self.client.get("/users/deletion", headers=self.headers).get_json()["status"], "Done")
+
+    def checkout(self):
+        # One order checked out from a cart and still Pending, one already Shipped; returns the book and its stock before
+        with self.app.app_context():
+            book = Book_descriptions(title="Book1", subtitle="Sub1", author="Author1", publisher="Pub1", published_date="2020-01-01", description="Desc", isbn="1234567890123", image_link="img", language="EN", price=10.0, stock_quantity=10, averageRating=5.0, ratingsCount=1)
+            address = Addresses(line1="1 Own St", city="TestCity", state="TS", country="TestLand", zipcode="12345")
+            payment = Payments(user_id=1, card_number="4111111111111111", cvv=123, expiry_month=1, expiry_year=2030)
+            address.users.append(db.session.get(Users, 1))
+            db.session.add_all([book, address, payment])
+            db.session.flush()
+            cart = Carts(user_id=1)
+            cart.cart_books.append(Cart_books(book_description_id=book.id, quantity=3))
+            shipped = Orders(user_id=1, address_id=address.id, payment_id=payment.id, total=10.0, status="Shipped")
+            shipped.order_books.append(Order_books(book_description_id=book.id, quantity=1))
+            db.session.add_all([cart, shipped])
+            db.session.commit()
+            ids = (book.id, cart.id, address.id, payment.id)
+        response = self.client.post(f"/orders/{ids[1]}/address/{ids[2]}/payment/{ids[3]}", json={"shipping_method": "InStore"}, headers=self.headers)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.stock(ids[0]), 7)
+        return ids[0]
+
+    def stock(self, book_id):
+        with self.app.app_context():
+            return db.session.get(Book_descriptions, book_id).stock_quantity
+
+    def cached_stock(self, book_id):
+        return self.client.get(f"/book_descriptions/{book_id}").get_json()["data"]["stock_quantity"]
+
+    def test_delete_user_returns_stock(self):
+        book_id = self.checkout()
+        self.assertEqual(self.cached_stock(book_id), 7)
+        self.assertEqual(self.client.delete("/users", headers=self.headers).status_code, 200)
+        # The Pending order's copies are back, the Shipped one's are gone with it
+        self.assertEqual(self.stock(book_id), 10)
+        self.assertEqual(self.cached_stock(book_id), 10)
+
+    def test_purge_returns_stock(self):
+        book_id = self.checkout()
+        self.assertEqual(self.cached_stock(book_id), 7)
+        self.app.config.update(USER_PURGE_THRESHOLD=1)
+        self.assertEqual(self.client.delete("/users", headers=self.headers).status_code, 202)
+        with self.app.app_context():
+            self.assertEqual([purge.status for purge in purge_accounts(chunk_size=1)], ["Done"])
+        self.assertEqual(self.stock(book_id), 10)
+        self.assertEqual(self.cached_stock(book_id), 10)
+
     def test_update_user_profile(self):
         # Valid update
         headers = {"Authorization": f"Bearer {self.token}"}
@@ -222,6 +401,19 @@ class TestUsers(unittest.TestCase):
         self.assertIsInstance(data["user_reviews"], list)
         self.assertEqual(data["user"]["email"], "tester@email.com")
 
+        # Sparse fields of the reviewed books
+        with self.app.app_context():
+            book = Book_descriptions(title="Book1", subtitle="Sub1", author="Author1", publisher="Pub1", published_date="2020-01-01", description="Desc", isbn="1234567890123", image_link="img", language="EN", price=10.0, stock_quantity=10, averageRating=5.0, ratingsCount=1)
+            db.session.add(book)
+            db.session.commit()
+            db.session.add(Reviews(user_id=1, book_description_id=book.id, rating=4.0, comment="Good"))
+            db.session.commit()
+        response_fields = self.client.get("/users/reviews?exclude=description,image_link", headers=headers)
+        review = response_fields.get_json()["user_reviews"][0]
+        self.assertEqual(review["comment"], "Good")
+        self.assertIn("title", review["book_description"])
+        self.assertNotIn("description", review["book_description"])
+
         # Missing token
         response_no_token = self.client.get("/users/reviews")
         self.assertEqual(response_no_token.status_code, 401)
@@ -256,6 +448,34 @@ class TestUsers(unittest.TestCase):
         response_no_token = self.client.get("/users/orders")
         self.assertEqual(response_no_token.status_code, 401)
 
+    def test_get_user_orders_history(self):
+        headers = {"Authorization": f"Bearer {self.token}"}
+        with self.app.app_context():
+            book = Book_descriptions(title="Book1", subtitle="Sub1", author="Author1", publisher="Pub1", published_date="2020-01-01", description="Desc", isbn="1234567890123", image_link="img", language="EN", price=10.0, stock_quantity=10, averageRating=5.0, ratingsCount=1)
+            address = Addresses(line1="123 Main St", city="TestCity", state="TS", country="TestLand", zipcode="12345")
+            payment = Payments(user_id=1, card_number="4111111111111111", cvv=123, expiry_month=1, expiry_year=2030)
+            db.session.add_all([book, address, payment])
+            db.session.commit()
+            for day, status, total, quantity in [(1, "Shipped", 20.0, 2), (2, "Cancelled", 10.0, 1), (3, "Pending", 30.0, 3)]:
+                order = Orders(user_id=1, address_id=address.id, payment_id=payment.id, created_at=datetime(2026, 1, day), status=status, total=total)
+                order.order_books.append(Order_books(book_description_id=book.id, quantity=quantity))
+                db.session.add(order)
+            db.session.commit()
+        response = self.client.get("/users/orders?limit=2", headers=headers)
+        self.assertEqual(response.status_code, 200)
+        data = response.get_json()
+        # Cancelled orders don't count in the spend
+        self.assertEqual(data["summary"], {"order_count": 3, "lifetime_spend": 50.0, "items_purchased": 5})
+        self.assertEqual([order["order_info"]["status"] for order in data["user_orders"]], ["Pending", "Cancelled"])
+        next_page = self.client.get(f"/users/orders?limit=2&after={data['next_cursor']}", headers=headers).get_json()
+        self.assertEqual([order["order_info"]["status"] for order in next_page["user_orders"]], ["Shipped"])
+        self.assertIsNone(next_page["next_cursor"])
+        filtered = self.client.get("/users/orders?status=Shipped,Pending&since=2026-01-02", headers=headers).get_json()
+        self.assertEqual([order["order_info"]["status"] for order in filtered["user_orders"]], ["Pending"])
+        self.assertEqual(self.client.get("/users/orders?status=Lost", headers=headers).status_code, 400)
+        self.assertEqual(self.client.get("/users/orders?until=yesterday", headers=headers).status_code, 400)
+        self.assertEqual(self.client.get("/users/orders?after=nope", headers=headers).status_code, 400)
+
     def test_get_user_cart(self):
         # Valid request with token
         headers = {"Authorization": f"Bearer {self.token}"}